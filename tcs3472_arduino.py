@@ -1,20 +1,38 @@
 #! /usr/bin/env nix-shell
 #! nix-shell -i python3 -p "python3.withPackages (p: with p; [pyserial tkinter numpy])"
 
-import sys
-import math
-import serial
-from time import sleep
-import tkinter
-from tkinter import N, E, W, S, X, Y, LEFT, IntVar, Label
 import threading
-import re
-import numpy, numpy.linalg
+import queue
+import numpy
 import tempfile
 import datetime
-
-def run_gui(serial_device):
-  tcs_count = 6
+import time
+import argparse
+import functools
+from tcs3472_display import StripChart, DisplayPipeline, TRANSFORMS, make_transform
+from tcs3472_recording import SampleTsvWriter, StepRecordingWriter, CaptureWriter, MODE_NAMES
+from tcs3472_replay import Replay
+from tcs3472_calibration import CalibrationRegistry, DEFAULT_CALIBRATION_FILE, MODES as calibration_modes
+from tcs3472_latency import LatencyStats
+from tcs3472_boards import BoardSet, SENSORS_PER_BOARD
+from tcs3472_sweep import StepCollector, integration_seconds
+from tcs3472_stats import StreamingStats
+
+def run_gui(serial_devices, calibration, replay=None, capture=None, latency=None, latency_dump=None, sweep_options={},
+    display_scale="linear", display_options={}):
+  # serial_devices: list of URLs, one for each Arduino; sensor i of the n-th one is shown as sensor n*6+i
+  # display_scale: one of TRANSFORMS, display_options: their parameters (base, floor, gamma)
+  # sweep_options: arguments for StepCollector, i.e. when a csvgen step is done
+  # latency: LatencyStats or None to disable it, latency_dump: file for the latency statistics at exit
+  import tkinter
+  from tkinter import N, E, W, S, X, LEFT, IntVar, Label
+
+  if replay is None:
+    boards = BoardSet(serial_devices, capture=capture)
+    tcs_count = boards.sensor_count
+  else:
+    boards = None
+    tcs_count = replay.sensor_count
 
   root = tkinter.Tk()
   root.title("Color Sensor Test")
@@ -30,15 +48,45 @@ def run_gui(serial_device):
   settings = tkinter.Frame(root)
   settings.grid(column=0, row=row, sticky=(N, E, W, S), columnspan=tcs_count)
   row += 1
-  logscale = IntVar(value=0)
-  tkinter.Checkbutton(settings, variable=logscale, text="logarithmic scale").pack(side=LEFT)
+  display_scale = tkinter.StringVar(value=display_scale)
+  Label(settings, text="scale:").pack(side=LEFT)
+  tkinter.OptionMenu(settings, display_scale, *TRANSFORMS).pack(side=LEFT)
+  bt_reference = tkinter.Button(settings, text="Set reference")
+  bt_reference.pack(side=LEFT)
   raw_values = IntVar(value=0)
   tkinter.Checkbutton(settings, variable=raw_values, text="show raw values (without correction)").pack(side=LEFT)
-
-  clear_old_graphs = lambda *args: canvas.delete("lines")
+  calibration_mode = tkinter.StringVar(value=calibration.mode)
+  Label(settings, text="calibration:").pack(side=LEFT)
+  tkinter.OptionMenu(settings, calibration_mode, *calibration_modes).pack(side=LEFT)
+  frame_stats_text = tkinter.StringVar(value="")
+  Label(settings, textvariable=frame_stats_text).pack(side=LEFT)
+  calibration_mode.trace_variable("w", lambda *args: calibration.set_mode(calibration_mode.get()))
+
+  chart = StripChart(canvas, tcs_count)
+  clear_old_graphs = lambda *args: chart.clear()
   canvas.bind("<Configure>", clear_old_graphs)
-  logscale.trace_variable("w", clear_old_graphs)
+  display_scale.trace_variable("w", clear_old_graphs)
+
+  global display_reference
+  display_reference = None
+  pipeline = DisplayPipeline(calibration, None, chart, tcs_count)
+  def update_transform(*args):
+    pipeline.transform = make_transform(display_scale.get(), tcs_count, reference=display_reference, **display_options)
+  update_transform()
+  display_scale.trace_variable("w", update_transform)
+  def set_reference(*args):
+    # "Set reference" uses the latest values of each sensor for the normalized scale
+    global display_reference
+    display_reference = pipeline.latest_values.copy()
+    print("reference for normalized scale: " + ", ".join("(%.0f, %.0f, %.0f, %.0f)" % tuple(v) for v in display_reference))
+    if display_scale.get() == "normalized":
+      update_transform()
+      chart.clear()
+    else:
+      display_scale.set("normalized")
+  bt_reference.configure(command=set_reference)
   raw_values.trace_variable("w", clear_old_graphs)
+  calibration_mode.trace_variable("w", clear_old_graphs)
 
   ledvars = []
   for i in range(tcs_count):
@@ -66,6 +114,8 @@ def run_gui(serial_device):
   color_as_text.configure(state = "readonly")
   row += 1
 
+  ratio_stats = StreamingStats(tcs_count, ("r/c", "g/c", "b/c", "c"))
+  ratio_formats = ("%4.2f", "%4.2f", "%4.2f", "%5.0f")
   ratios = tkinter.Frame(root)
   ratios.grid(column=0, row=row, sticky=(N, E, W, S), columnspan=tcs_count)
   row += 1
@@ -73,20 +123,36 @@ def run_gui(serial_device):
   tkinter.Entry(ratios, textvariable=ratio_text).pack(side=LEFT, fill=X, expand=True)
   collect_ratios = IntVar(value=0)
   tkinter.Checkbutton(ratios, variable=collect_ratios, text="update").pack(side=LEFT)
+  ratio_window = tkinter.StringVar(value="cumulative")
+  tkinter.OptionMenu(ratios, ratio_window, *ratio_stats.WINDOWS).pack(side=LEFT)
   bt_clear_ratios = tkinter.Button(ratios, text="Clear")
   bt_clear_ratios.pack(side=LEFT)
   bt_print_ratios = tkinter.Button(ratios, text="Print to console")
   bt_print_ratios.pack(side=LEFT)
-
-  global avg_ratios
-  avg_ratios = [[0, 0, 0, 0, 0] for i in range(tcs_count)]
+  bt_export_ratios = tkinter.Button(ratios, text="Export")
+  bt_export_ratios.pack(side=LEFT)
+
+  # mean±std of red/clear, green/clear, blue/clear and clear, the text is updated at most every ratio_display_interval seconds
+  ratio_display_interval = 0.5
+  global last_ratio_display
+  last_ratio_display = 0
+  def show_ratios(*args):
+    global last_ratio_display
+    last_ratio_display = time.monotonic()
+    ratio_text.set(ratio_stats.text(ratio_window.get(), ratio_formats))
+  ratio_window.trace_variable("w", show_ratios)
   def clear_ratios(*args):
-    global avg_ratios
-    avg_ratios = [[0, 0, 0, 0, 0] for i in range(tcs_count)]
+    ratio_stats.clear()
+    show_ratios()
   bt_clear_ratios.configure(command=clear_ratios)
   def print_ratios(*args):
-    print("ratios: " + ratio_text.get())
+    print("ratios (%s): %s" % (ratio_window.get(), ratio_stats.text(ratio_window.get(), ratio_formats)))
   bt_print_ratios.configure(command=print_ratios)
+  def export_ratios(*args):
+    path = "tcs-ratios--%s.tsv" % datetime.datetime.now().strftime("%Y-%m-%d--%H-%M-%S")
+    ratio_stats.export(path)
+    print("ratios written to %s" % path)
+  bt_export_ratios.configure(command=export_ratios)
 
   csvgen = tkinter.Frame(root)
   csvgen.grid(column=0, row=row, sticky=(N, E, W, S), columnspan=tcs_count)
@@ -101,6 +167,24 @@ def run_gui(serial_device):
   bt_start_csvgen = tkinter.Button(csvgen, text="Start")
   bt_start_csvgen.pack(side=LEFT)
 
+  if latency is not None:
+    latency_frame = tkinter.Frame(root)
+    latency_frame.grid(column=0, row=row, sticky=(N, E, W, S), columnspan=tcs_count)
+    row += 1
+    latency_text = tkinter.StringVar(value="latency: no data, yet")
+    Label(latency_frame, textvariable=latency_text, font="TkFixedFont", justify=LEFT).pack(side=LEFT)
+    def dump_latency(*args):
+      path = latency_dump
+      if path is None:
+        path = "tcs-latency--%s.json" % datetime.datetime.now().strftime("%Y-%m-%d--%H-%M-%S")
+      latency.dump(path)
+      print("latency statistics written to %s" % path)
+    tkinter.Button(latency_frame, text="Dump", command=dump_latency).pack(side=LEFT)
+    def update_latency_text():
+      latency_text.set(latency.summary(latency.rates()) or "latency: no data, yet")
+      root.after(1000, update_latency_text)
+    root.after(1000, update_latency_text)
+
   color_window = tkinter.Toplevel(bg="orange")
   color_window.title("Color for test with monitor")
   color_window.withdraw()
@@ -111,18 +195,42 @@ def run_gui(serial_device):
       color_window.withdraw()
   actuator_var.trace_variable("w", on_actuator_var_changed)
 
-  global ok_count
-  ok_count = 0
+  global pending_commands
+  pending_commands = 0  # settings that haven't been confirmed by the Arduinos, yet
+  global last_setting_time
+  last_setting_time = 0  # time.time() of the last confirmation
+  global applying_values
+  applying_values = False  # True while apply_values() sets the variables to what the Arduinos have sent
+  # present according to the Arduino (None if we don't know) and time.time() of the last sample
+  sensor_present = [None] * tcs_count
+  last_seen = [0.0] * tcs_count
+  def live_sensors(now):
+    return [i for i in range(tcs_count) if (sensor_present[i] if sensor_present[i] is not None else now - last_seen[i] < 3.0)]
+
+  collector = StepCollector(tcs_count, **sweep_options)
   global csvgen_state
   csvgen_state = 0
-  def update_csvgen(sensor_index, raw, values):
+  def update_csvgen(samples, raw, values):
+    # returns True if at least one record has been written
+    if csvgen_state == 0:  # not active
+      return False
+    written = False
+    for sensor_index, t, r, v in zip(samples["sensor"].tolist(), samples["time"].tolist(), raw.tolist(), values.tolist()):
+      written = update_csvgen_sample(sensor_index, t, r, v) or written
+    return written
+
+  def begin_collecting(now, changed):
+    # changed: time.time() when the actuator has been changed, the auto-poll of the Arduino may add 50 ms
+    global csvgen_state
+    csvgen_state = 3
+    collector.start(live_sensors(now), changed + integration_seconds(integration_time.get()) + 0.05, now)
+
+  def update_csvgen_sample(sensor_index, timestamp, raw, values):
     global csvgen_state
-    global csvgen_data
     global csvgen_step
     global csvgen_rgb
     global csvgen_file
-    global csvgen_expected_oks
-    global ok_count
+    now = time.time()
 
     if csvgen_state == 0:  # not active
       return
@@ -130,28 +238,24 @@ def run_gui(serial_device):
       csvgen_step += 1
       csvgen_progress_text.set("step %d" % csvgen_step)
       if (actuator_var.get() == 0 and csvgen_step >= 256) or (actuator_var.get() == 3 and csvgen_step >= 4) or csvgen_step >= 256*7:
-        print("csvgen done, data written to %s" % csvgen_file.name)
+        print("csvgen done, data written to %s (use tcs3472_recording.py to convert it to TSV)" % csvgen_file.name)
         csvgen_state = 0
         csvgen_progress_text.set("done")
         csvgen_file.close()
         bt_start_csvgen.configure(text="Start")
       elif actuator_var.get() == 0:
-        ok_count = 0
         if csvgen_step != integration_time.get():
           integration_time.set(csvgen_step)
-          csvgen_expected_oks = tcs_count
           csvgen_state = 2
         else:
-          csvgen_state = 3
+          begin_collecting(now, now)
         csvgen_rgb = (csvgen_step, 0, 0)
       elif actuator_var.get() == 3:
-        ok_count = 0
         if csvgen_step != gain.get():
           gain.set(csvgen_step)
-          csvgen_expected_oks = tcs_count
           csvgen_state = 2
         else:
-          csvgen_state = 3
+          begin_collecting(now, now)
         csvgen_rgb = (csvgen_step, 0, 0)
       else:
         if csvgen_step < 256:     # ramp up red   -> red
@@ -173,25 +277,21 @@ def run_gui(serial_device):
         csvgen_rgb = (r, g, b)
 
         if actuator_var.get() == 1:
-          ok_count = 0
-          csvgen_expected_oks = 0
           if r != led_red.get():
             led_red.set(r)
-            csvgen_expected_oks += 1
           if g != led_green.get():
             led_green.set(g)
-            csvgen_expected_oks += 1
           if b != led_blue.get():
             led_blue.set(b)
-            csvgen_expected_oks += 1
           csvgen_state = 2
         else:
           color_window.configure(bg="#%02x%02x%02x"%(r, g, b))
-          csvgen_state = 3  # no need to wait for ok from Arduino
+          begin_collecting(now, now)  # no need to wait for ok from Arduino
     elif csvgen_state == 2:  # wait for ok from Arduino
-      #FIXME timeout and set again?
-      if ok_count >= csvgen_expected_oks:
-        csvgen_state = 3
+      # The commands are sent again if there is no reply and they are done (maybe failed) after a few tries
+      # so this doesn't wait forever.
+      if pending_commands == 0:
+        begin_collecting(now, last_setting_time)
     elif csvgen_state == 3:  # collect measurements
       pass  # handled below so we don't lose one measurement when switching to this state
     else:
@@ -199,324 +299,434 @@ def run_gui(serial_device):
       csvgen_state = 0
 
     if csvgen_state == 3:  # collect measurements
-      csvgen_data[sensor_index].append((raw, values))
+      # only the sensors that are present, see StepCollector for when we have enough samples
+      collector.add(sensor_index, timestamp, raw, values)
 
-      #FIXME skip sensors that don't provide any data, e.g. are not connected
-      if min(len(vs) for vs in csvgen_data) >= 3:
+      if collector.done(now):
+        missing = collector.timed_out()
+        if missing:
+          print("csvgen step %d: no stable values for sensors %s after %.1f s" % (csvgen_step, missing, now - collector.start_time))
         if csvgen_step == 0:
-          time = datetime.datetime.now().strftime("%Y-%m-%d--%H-%M-%S")
-          csvgen_file = tempfile.NamedTemporaryFile(prefix="tcstest%d--%s--" % (actuator_var.get(), time), suffix=".csv", delete=False, dir=".", mode="w")
+          time_str = datetime.datetime.now().strftime("%Y-%m-%d--%H-%M-%S")
+          f = tempfile.NamedTemporaryFile(prefix="tcstest%d--%s--" % (actuator_var.get(), time_str), suffix=".tcsrec", delete=False, dir=".", mode="wb")
+          header = {
+            "sensor_count": tcs_count,
+            "settings": dict(zip(("mode", "itime", "gain", "ws2812.r", "ws2812.g", "ws2812.b"),
+              (v.get() for v in (actuator_var, integration_time, gain, led_red, led_green, led_blue)))),
+            "sweep": { "mode": MODE_NAMES[actuator_var.get()], "started": time_str, "compensated": raw_values.get() == 0, "calibration": calibration.mode,
+              "sensors": sorted(collector.expected), "step_done": collector.settings },
+          }
+          csvgen_file = StepRecordingWriter(f, header)
           print("csvgen data will be written to %s" % csvgen_file.name)
-          with open(csvgen_file.name + ".txt", "w") as f:
-            f.write("mode=%d\nitime=%d\ngain=%d\nws2812.r=%d\nws2812.g=%d\nws2812.b=%d\n"
-              % tuple(v.get() for v in (actuator_var, integration_time, gain, led_red, led_green, led_blue)))
-          cells = ["mode", "step", "r", "g", "b"]
-          for i in range(tcs_count):
-            cells.extend(("sensor%d.raw_c1"%i, "sensor%d.raw_r1"%i, "sensor%d.raw_g1"%i, "sensor%d.raw_b1"%i, "sensor%d.raw_c2"%i, "sensor%d.raw_r2"%i, "sensor%d.raw_g2"%i, "sensor%d.raw_b2"%i))
-            cells.extend(("sensor%d.c1"%i, "sensor%d.r1"%i, "sensor%d.g1"%i, "sensor%d.b1"%i, "sensor%d.c2"%i, "sensor%d.r2"%i, "sensor%d.g2"%i, "sensor%d.b2"%i))
-            cells.extend(("sensor%d.c"%i, "sensor%d.r"%i, "sensor%d.g"%i, "sensor%d.b"%i))
-          csvgen_file.write("\t".join(cells) + "\n")
-        cells = []
-        if actuator_var.get() == 0:
-          cells.append("itime")
-        elif actuator_var.get() == 1:
-          cells.append("WS2812")
-        elif actuator_var.get() == 2:
-          cells.append("monitor")
-        elif actuator_var.get() == 3:
-          cells.append("gain")
-        else:
-          cells.append("??")
-        cells.append(csvgen_step)
-        cells.extend(csvgen_rgb)
-        for d in csvgen_data:
-          for i in [1, 2]:
-            cells.extend(d[i][0])  # raw
-          for i in [1, 2]:
-            cells.extend(d[i][1])  # maybe compensated
-          avg = (sum(v[1][j] for v in d[1:]) / len(d[1:]) for j in range(4))
-          cells.extend(avg)
-        csvgen_file.write("\t".join(map(str, cells)) + "\n")
-        csvgen_file.flush()
+        record = csvgen_file.new_record()
+        record["mode"] = actuator_var.get()
+        record["step"] = csvgen_step
+        record["rgb"] = csvgen_rgb
+        collector.fill_record(record)  # values are maybe compensated, NaN for sensors without samples
+        csvgen_file.write(record)
 
         csvgen_state = 1
-        for v in csvgen_data:
-          v.clear()
+        return True
 
 
   def csvgen_start(*args):
     global csvgen_state
-    global csvgen_data
     global csvgen_step
+    global csvgen_file
     if csvgen_state == 0:
-      csvgen_data = [[] for _ in range(tcs_count)]
       csvgen_step = -1
+      csvgen_file = None
       csvgen_state = 1
       bt_start_csvgen.configure(text="Abort")
     else:
       csvgen_state = 0
+      if csvgen_file is not None:
+        csvgen_file.close()
       csvgen_progress_text.set("aborted")
       bt_start_csvgen.configure(text="Start")
   bt_start_csvgen.configure(command=csvgen_start)
 
-  global prev, prevs
-  prev = (0, 0, 0, 0)
+  global prevs
   prevs = [(0, 0, 0, 0) for i in range(tcs_count)]
-  def on_sensor_data(sensor_index, clear, red, green, blue):
-    raw = (clear, red, green, blue)
-
-    if clear > 0 and collect_ratios.get() != 0:
-      avg_ratios[sensor_index][0] += 1
-      avg_ratios[sensor_index][1] += red/clear
-      avg_ratios[sensor_index][2] += green/clear
-      avg_ratios[sensor_index][3] += blue/clear
-      avg_ratios[sensor_index][4] += clear
-
-      ratio_text.set(", ".join("(%4.2f, %4.2f, %4.2f, %5.0f)" % (x[1]/x[0], x[2]/x[0], x[3]/x[0], x[4]/x[0]) for x in avg_ratios if x[0] > 0))
-
-    if raw_values.get() == 0:
-      # Test wavelength from the TCS34725 datasheet match WS2812D-F8 to within 10 nm so these values should be a good match.
-      # This is the "Optical Characteristics" data from the datasheet. We are using the average of min and max because the
-      # typical value isn't specified.
-      # https://cdn-shop.adafruit.com/datasheets/TCS34725.pdf
-      rgb_to_tcs_datasheet = numpy.transpose(numpy.array(((0.8+1.1, 0+0.14, 0.05+0.24), (0.04+0.25, 0.60+0.85, 0.10+0.45), (0.00+0.15, 0.10+0.42, 0.65+0.88)))/2)
-      # gain=0, itime=255 (max), WS2812 at maximum, width of Pro Micro above the sensor, average over 5 seconds, other light sources are less than 1/1000 for the clear value
-      rgb_to_tcs__sensor0_a = numpy.transpose(numpy.array((
-        (0.93, 0.04, 0.09),  # value/clear for red,   clear=17003
-        (0.09, 0.63, 0.25),  # value/clear for green, clear=13293
-        (0.01, 0.22, 0.78),  # value/clear for blue,  clear=14130
-      )))
-      rgb_to_tcs__sensor1_a = numpy.transpose(numpy.array((
-        (0.88, 0.06, 0.09),  # value/clear for red,   clear=8294
-        (0.09, 0.66, 0.27),  # value/clear for green, clear=7944
-        (0.01, 0.25, 0.79),  # value/clear for blue,  clear=10477
-      )))
-      rgb_to_tcs__sensor2_a = numpy.transpose(numpy.array((
-        (0.84, 0.04, 0.08),  # value/clear for red,   clear=10294
-        (0.09, 0.55, 0.22),  # value/clear for green, clear=8298
-        (0.01, 0.20, 0.65),  # value/clear for blue,  clear=11842
-      )))
-      # same as before bug gain=1 and other light sources are below 10 counts
-      rgb_to_tcs__sensor0_b = numpy.transpose(numpy.array((
-        (0.92, 0.04, 0.09),  # value/clear for red,   clear=54716
-        (0.09, 0.63, 0.24),  # value/clear for green, clear=39902
-        (0.01, 0.22, 0.77),  # value/clear for blue,  clear=49474
-      )))
-      rgb_to_tcs__sensor1_b = numpy.transpose(numpy.array((
-        (0.88, 0.06, 0.09),  # value/clear for red,   clear=33426
-        (0.09, 0.67, 0.27),  # value/clear for green, clear=38158
-        (0.01, 0.25, 0.79),  # value/clear for blue,  clear=49202
-      )))
-      rgb_to_tcs__sensor2_b = numpy.transpose(numpy.array((
-        (0.84, 0.04, 0.08),  # value/clear for red,   clear=43874
-        (0.09, 0.55, 0.22),  # value/clear for green, clear=27910
-        (0.01, 0.19, 0.66),  # value/clear for blue,  clear=44301
-      )))
-      # same as before bug gain=2, itime=160, distance is the *length* of a Pro Micro, and other light sources are below 50 counts
-      rgb_to_tcs__sensor0_c = numpy.transpose(numpy.array((
-        (0.93, 0.04, 0.09),  # value/clear for red,   clear=55809
-        (0.09, 0.64, 0.25),  # value/clear for green, clear=41563
-        (0.01, 0.22, 0.78),  # value/clear for blue,  clear=55916
-      )))
-      rgb_to_tcs__sensor1_c = numpy.transpose(numpy.array((
-        (0.89, 0.06, 0.09),  # value/clear for red,   clear=36620
-        (0.09, 0.66, 0.27),  # value/clear for green, clear=41630
-        (0.01, 0.25, 0.78),  # value/clear for blue,  clear=48462
-      )))
-      rgb_to_tcs__sensor2_c = numpy.transpose(numpy.array((
-        (0.84, 0.04, 0.08),  # value/clear for red,   clear=43001
-        (0.09, 0.54, 0.23),  # value/clear for green, clear=43740
-        (0.01, 0.19, 0.66),  # value/clear for blue,  clear=58406
-      )))
-      # same as before bug gain=3, itime=255 for red and green, itime=240 for blue, distance is 9cm over the middle sensor (sensor 1), and other light sources are below 100 counts
-      rgb_to_tcs__sensor0_d = numpy.transpose(numpy.array((
-        (0.92, 0.04, 0.07),  # value/clear for red,   clear=29655
-        (0.09, 0.62, 0.22),  # value/clear for green, clear=46442
-        (0.01, 0.21, 0.75),  # value/clear for blue,  clear=63688
-      )))
-      rgb_to_tcs__sensor1_d = numpy.transpose(numpy.array((
-        (0.90, 0.06, 0.09),  # value/clear for red,   clear=17412
-        (0.09, 0.66, 0.26),  # value/clear for green, clear=52489
-        (0.01, 0.25, 0.79),  # value/clear for blue,  clear=65535
-      )))
-      rgb_to_tcs__sensor2_d = numpy.transpose(numpy.array((
-        (0.88, 0.06, 0.09),  # value/clear for red,   clear=12422
-        (0.08, 0.66, 0.25),  # value/clear for green, clear=37328
-        (0.01, 0.22, 0.77),  # value/clear for blue,  clear=42840
-      )))
-
-      #rgb_to_tcs = rgb_to_tcs_datasheet
-      #rgb_to_tcs = (rgb_to_tcs__sensor0_a + rgb_to_tcs__sensor1_a + rgb_to_tcs__sensor2_a + rgb_to_tcs__sensor0_b + rgb_to_tcs__sensor1_b + rgb_to_tcs__sensor2_b
-      #  + rgb_to_tcs__sensor0_c + rgb_to_tcs__sensor1_c + rgb_to_tcs__sensor2_c + rgb_to_tcs__sensor0_d + rgb_to_tcs__sensor1_d + rgb_to_tcs__sensor2_d) / 12
-      rgb_to_tcs = (rgb_to_tcs__sensor0_a + rgb_to_tcs__sensor1_a + rgb_to_tcs__sensor2_a + rgb_to_tcs__sensor0_b + rgb_to_tcs__sensor1_b + rgb_to_tcs__sensor2_b
-        + rgb_to_tcs__sensor0_c + rgb_to_tcs__sensor1_c + rgb_to_tcs__sensor2_c) / 9
-      tcs_to_rgb = numpy.linalg.inv(rgb_to_tcs)
-      #NOTE All of the above need only be done once.
-
-      red, green, blue = numpy.dot(tcs_to_rgb, (red, green, blue))
-      #print("%d: %r -> %r" % (sensor_index, raw, (red, green, blue)))
-
-    update_csvgen(sensor_index, raw, (clear, red, green, blue))
-
-    if logscale.get() != 0:
-      #disp_clear = math.log(clear)/math.log(1<<16)
-      #disp_red   = math.log(red)  /math.log(1<<16)
-      #disp_green = math.log(green)/math.log(1<<16)
-      #disp_blue  = math.log(blue) /math.log(1<<16)
-      #disp_sum   = math.log(red + green + blue)/math.log(1<<16)
-
-      #factor = 1e-4
-      #min = 1
-      #disp_clear = (-math.log(factor*min) + math.log(factor*max(min, clear)))             /math.log(factor*(1<<16))
-      #disp_red   = (-math.log(factor*min) + math.log(factor*max(min, red)))               /math.log(factor*(1<<16))
-      #disp_green = (-math.log(factor*min) + math.log(factor*max(min, green)))             /math.log(factor*(1<<16))
-      #disp_blue  = (-math.log(factor*min) + math.log(factor*max(min, blue)))              /math.log(factor*(1<<16))
-      #disp_sum   = (-math.log(factor*min) + math.log(factor*max(min, red + green + blue)))/math.log(factor*(1<<16))
-
-      #FIXME This is still not really useful...
-      power = 200
-      min_limit = 1
-      vmin       = math.log(min_limit,                          power)
-      vmax       = math.log(1<<16,                              power)
-      disp_clear = math.log(max(min_limit, clear),              power)
-      disp_red   = math.log(max(min_limit, red),                power)
-      disp_green = math.log(max(min_limit, green),              power)
-      disp_blue  = math.log(max(min_limit, blue),               power)
-      disp_sum   = math.log(max(min_limit, red + green + blue), power)
-      disp_clear = (disp_clear-vmin)/(vmax-vmin)
-      disp_red   = (disp_red  -vmin)/(vmax-vmin)
-      disp_green = (disp_green-vmin)/(vmax-vmin)
-      disp_blue  = (disp_blue -vmin)/(vmax-vmin)
-      disp_sum   = (disp_sum  -vmin)/(vmax-vmin)
-    else:
-      disp_clear = clear/(1<<16)
-      disp_red   = red  /(1<<16)
-      disp_green = green/(1<<16)
-      disp_blue  = blue /(1<<16)
-      disp_sum = disp_red + disp_green + disp_blue
-
+  def on_sensor_data(samples, traces=()):
+    now = time.time()
+    for i in numpy.unique(samples["sensor"]).tolist():
+      last_seen[i] = now
+    raw, values = pipeline.compensate(samples, raw_values.get() == 0, gain.get(), integration_time.get())
+    if traces:
+      latency.record("compensated", traces)
+
+    if collect_ratios.get() != 0:
+      # ratios are always calculated from the raw values because we use them for calibration
+      valid = raw[:, 0] > 0
+      sensors = samples["sensor"][valid]
+      clear = raw[valid, 0].astype(float)
+      ratio_stats.update(sensors, numpy.stack((raw[valid, 1]/clear, raw[valid, 2]/clear, raw[valid, 3]/clear, clear), axis=1),
+        samples["time"][-1])
+      if time.monotonic() - last_ratio_display >= ratio_display_interval:
+        show_ratios()
+
+    if update_csvgen(samples, raw, values) and traces:
+      latency.record("recorded", traces)
+
+    pipeline.display(samples, raw, values)
+
+  # one set of bars per sensor: clear, sum of red+green+blue, red, green, blue
+  bar_params = ((5, 15, "white"), (8, 12, "orange"), (15, 25, "red"), (25, 35, "green"), (35, 45, "blue"))
+  bar_items = [[canvas.create_rectangle(-1, -1, -1, -1, tags=("bars", "bars%d" % i), fill=color, outline=color)
+    for _, _, color in bar_params] for i in range(tcs_count)]
+
+  def render():
+    # only draw the latest state, i.e. at most once per refresh
     global prevs
-    prevs[sensor_index] = raw
+    w = canvas.winfo_width()
+    h = canvas.winfo_height() - 45*tcs_count - 5
+    chart.redraw(w, h)
+
+    for sensor_index, (raw, disp) in pipeline.latest.items():
+      prevs[sensor_index] = raw
+      h0 = h + 45*sensor_index
+      wbar = w*0.8
+      offset = w*0.1
+      for item, (y0, y1, _), d in zip(bar_items[sensor_index], bar_params, (disp[0], disp[4], disp[1], disp[2], disp[3])):
+        canvas.coords(item, offset, h0+y0, d*wbar + offset, h0+y1)
+    pipeline.latest.clear()
+
     color_as_text.configure(state = "normal")
     color_as_text.delete(0, "end")
     color_as_text.insert(0, ", ".join("(%04x, %04x, %04x, %04x)" % x for x in prevs))
     color_as_text.configure(state = "readonly")
 
-    step = 1
-    w = canvas.winfo_width()
-    h = canvas.winfo_height() - 45*tcs_count - 5
-    if sensor_index == 0:
-      global prev
-      canvas.move("lines", -step, 0)
-      canvas.create_line(w-step-1, h+2-prev[0]*h, w-1, h+2-disp_clear*h, tags=("clear", "lines"), fill="white", width=2)
-      canvas.create_line(w-step-1, h+2-prev[1]*h, w-1, h+2-disp_red*h,   tags=("red", "lines"), fill="red", width=2)
-      canvas.create_line(w-step-1, h+2-prev[2]*h, w-1, h+2-disp_green*h, tags=("green", "lines"), fill="green", width=2)
-      canvas.create_line(w-step-1, h+2-prev[3]*h, w-1, h+2-disp_blue*h,  tags=("blue", "lines"), fill="blue", width=2)
-      prev = (disp_clear, disp_red, disp_green, disp_blue)
-
-    bars_tag = "bars%d" % sensor_index
-    canvas.delete(bars_tag)
-    h0 = h + 45*sensor_index
-    wbar = w*0.8
-    offset = w*0.1
-    canvas.create_rectangle(offset, h0+5,  disp_clear*wbar + offset, h0+15, tags=("clear", bars_tag), fill="white",  outline="white")
-    canvas.create_rectangle(offset, h0+8,  disp_sum  *wbar + offset, h0+12, tags=("clear", bars_tag), fill="orange", outline="orange")
-    canvas.create_rectangle(offset, h0+15, disp_red  *wbar + offset, h0+25, tags=("red",   bars_tag), fill="red",    outline="red")
-    canvas.create_rectangle(offset, h0+25, disp_green*wbar + offset, h0+35, tags=("green", bars_tag), fill="green",  outline="green")
-    canvas.create_rectangle(offset, h0+35, disp_blue *wbar + offset, h0+45, tags=("blue",  bars_tag), fill="blue",   outline="blue")
+  refresh_interval = 33  # ms, i.e. about 30 Hz
+  sample_queue = queue.Queue(maxsize=256)
+  # functions that other threads want to run in the GUI thread because they change Tk variables
+  gui_calls = queue.SimpleQueue()
+  frame_counters = { "frames": 0, "coalesced": 0, "dropped": 0 }
+  global last_refresh_time
+  last_refresh_time = time.monotonic()
+  def refresh():
+    global last_refresh_time
+    # frames that haven't been drawn because the GUI thread was busy (their samples are in the next one)
+    now = time.monotonic()
+    frame_counters["dropped"] += max(0, int((now - last_refresh_time) * 1000 / refresh_interval) - 1)
+    last_refresh_time = now
+    try:
+      while True:
+        gui_calls.get_nowait()()
+    except queue.Empty:
+      pass
+
+    batches = []
+    try:
+      while True:
+        batches.append(sample_queue.get_nowait())
+    except queue.Empty:
+      pass
+    if batches:
+      # every sample goes to the recorder and statistics but we draw only once
+      frame_counters["frames"] += 1
+      frame_counters["coalesced"] += len(batches) - 1
+      traces = [trace for _, batch_traces in batches for trace in batch_traces]
+      if traces:
+        latency.record("gui", traces)
+      on_sensor_data(numpy.concatenate([samples for samples, _ in batches]), traces)
+      render()
+      if traces:
+        # Tk redraws the canvas in an idle callback that has been scheduled by the changes in render()
+        # so this one runs after it.
+        root.after_idle(latency.record, "drawn", traces)
+      frame_stats_text.set("frames: %(frames)d, coalesced: %(coalesced)d, dropped: %(dropped)d" % frame_counters)
+    root.after(refresh_interval, refresh)
+  root.after(refresh_interval, refresh)
+
+  vars = ledvars + slider_vars
+  var_names = [b"tcs%d.led"%i for i in range(tcs_count)] + [p[4] for p in slider_params]
+  # the sliders show the values of the first board
+  var_sensors = list(range(tcs_count)) + [0] * len(slider_params)
+
+  def apply_values(values, sensors=range(tcs_count)):
+    # only for the variables of these sensors, i.e. one board
+    # The Arduino already has these values so on_var_changed() mustn't send them back (and "%d" names would
+    # send the values of tcs0 to all sensors).
+    global applying_values
+    for i in sensors:
+      if b"tcs%d.present" % i in values:
+        sensor_present[i] = bool(values[b"tcs%d.present" % i])
+    applying_values = True
+    try:
+      for var, name, sensor in zip(vars, var_names, var_sensors):
+        if sensor not in sensors:
+          continue
+        if b"%d" in name:
+          name = name%0
+        if name in values:
+          print("%r is %r" % (name, values[name]))
+          var.set(values[name])
+        else:
+          print("value not sent by Arduino for %r" % name)
+    finally:
+      applying_values = False
+
+  overflow = []  # batches that didn't fit into sample_queue
+  def handle_batch(samples, events, block=False, trace=None):
+    # replies to our commands are handled by BoardSet and are not in the events
+    for kind, arg in events:
+      if kind == "ok":
+        print("%ok")
+      elif kind == "present":
+        print("tcs%d.present=%d" % arg)
+        if arg[0] < tcs_count:
+          sensor_present[arg[0]] = arg[1]
+      elif kind in ("comment", "status"):
+        print(arg)
+      else:
+        print("line not recognized: %r" % arg)
+    if samples is None or len(samples) == 0:
+      return
+    traces = [trace] if trace is not None else []
+    if block:
+      # replay: wait for the GUI
+      while not mainloop_done:
+        try:
+          sample_queue.put((samples, traces), timeout=0.1)
+          break
+        except queue.Full:
+          pass
+      return
+    # GUI is too slow -> the batches wait here and go to the GUI together (in order) when there is space
+    # in the queue, i.e. all samples still go to the recorder and statistics
+    overflow.append((samples, traces))
+    try:
+      if len(overflow) == 1:
+        sample_queue.put_nowait(overflow[0])
+      else:
+        sample_queue.put_nowait((numpy.concatenate([s for s, _ in overflow]), [t for _, ts in overflow for t in ts]))
+        frame_counters["coalesced"] += len(overflow) - 1
+      overflow.clear()
+    except queue.Full:
+      pass
 
   mainloop_done = False
-  def query_sensor():
-    ser = serial.serial_for_url(serial_device, timeout=2)
-    ser.write(b":echo=0\r\n:auto=1\r\n?\r\n")
-    state = 0
-    values = {}
-    while True:
-      line = b""
-      while len(line) == 0 or line[-1] != b"\n"[0]:
-        line += ser.read()
-      line = line.strip()
-      if line == b"":
-        pass
-      if state == 0:
-        # first line is most likely only a partial one -> ignore it
-        state = 1
-      elif line in [b"%ok"]:
-        pass
-      elif state == 1 and line == b"%values":
-        state = 2
-      elif state == 2 and line == b"%end":
-        state = 3
-        break
-      elif state == 2 and line[0] == b":"[0]:
-        eq = line.find(b"=")
-        if eq >= 0:
-          k = line[1:eq]
-          v = line[eq+1:]
-          if k.endswith(b".type"):
-            values[k] = v
-          else:
-            values[k] = int(v)
+  def setting_done(ok, t):
+    global pending_commands
+    global last_setting_time
+    pending_commands -= 1
+    last_setting_time = max(last_setting_time, t)
+
+  def on_var_changed(name, var):
+    # called by Tk for any change, i.e. by the user or by apply_values() (which is ignored)
+    global pending_commands
+    if boards is not None and not applying_values:
+      print("update %s" % name)
+      pending_commands += 1
+      # the time of the reply is taken in the event loop because the GUI will only see it with the next refresh
+      boards.set(name, var.get(), callback=lambda ok: gui_calls.put(functools.partial(setting_done, ok, time.time())))
+  for var, name in zip(vars, var_names):
+    var.trace_variable("w", lambda *args, name=name, var=var: on_var_changed(name, var))
+
+  def apply_board_values(board):
+    # The sliders show the values of the first board, i.e. changing them sends them to all boards. The
+    # others get the current values of the sliders when they connect.
+    apply_values(board.values, range(board.offset, board.offset + board.sensor_count))
+    if board.offset != 0:
+      for var, p in zip(slider_vars, slider_params):
+        boards.set(p[4], var.get(), board.index)
+
+  def on_board_batch(board, samples, events, read_time):
+    # called by the event loop of the boards, samples are already merged
+    trace = None
+    if latency is not None and samples is not None:
+      trace = latency.trace(read_time, len(samples))
+      latency.record("parsed", (trace,))
+    handle_batch(samples, events, trace=trace)
+
+  def report_rates():
+    for board in boards.boards:
+      if board.connected:
+        print("%s: %.0f bytes/s, %.1f lines/s" % ((board,) + board.framer.rates()))
       else:
-        print("unexpected line: %r" % line)
+        print("%s: not connected" % board)
+    root.after(10000, report_rates)
 
-    vars = ledvars + slider_vars
-    var_names = [b"tcs%d.led"%i for i in range(tcs_count)] + [p[4] for p in slider_params]
-
-    for var, name in zip(vars, var_names):
-      if b"%d" in name:
-        name = name%0
-      if name in values:
-        print("%r is %r" % (name, values[name]))
-        var.set(values[name])
-      else:
-        print("value not sent by Arduino for %r" % name)
-
-    prev_values = [v.get() for v in vars]
-
-    line = b""
-    while not mainloop_done:
-      #FIXME wait for reply
-      current_values = [v.get() for v in vars]
-      for name, prev, current in zip(var_names, prev_values, current_values):
-        if prev != current:
-          print("update %s" % name)
-          if b"%d" in name:
-            for i in range(tcs_count):
-              ser.write(b":%s=%d\r\n" % (name%i, current))
-          else:
-            ser.write(b":%s=%d\r\n" % (name, current))
-      prev_values = current_values
-
-      line += ser.read()
-      if len(line) > 0 and line[-1] == b"\n"[0]:
-        line = line.strip()
-        if line == b"":
-          pass
-        elif line in [b"%ok"]:
-          global ok_count
-          print(line)
-          ok_count += 1
-        elif line[0] == '#'[0]:
-          print(line)
-        elif re.match(b':tcs(\d+)[.]present=[01]', line):
-          #TODO do something useful
-          print(line)
-        elif re.match(b':tcs(\d+)[.]color=[(]0x([0-9a-fA-F]+), *0x([0-9a-fA-F]+), *0x([0-9a-fA-F]+), *0x([0-9a-fA-F]+)[)]', line):
-          #print("color: %r" % line)
-          m = re.match(b':tcs(\d+)[.]color=[(]0x([0-9a-fA-F]+), *0x([0-9a-fA-F]+), *0x([0-9a-fA-F]+), *0x([0-9a-fA-F]+)[)]', line)
-          tcs_index = int(m[1])
-          if not mainloop_done:
-            root.after_idle(on_sensor_data, tcs_index, int(m[2], 16), int(m[3], 16), int(m[4], 16), int(m[5], 16))
-        else:
-          print("line not recognized: %r" % line)
-        line = b""
-  t = threading.Thread(target=query_sensor)
-  t.start()
+  def replay_sensor():
+    values_applied = False
+    for samples, events in replay:
+      if mainloop_done:
+        break
+      if not values_applied and replay.values:
+        gui_calls.put(lambda: apply_values(replay.values))
+        values_applied = True
+      trace = None
+      if latency is not None and len(samples) > 0:
+        # the replay has already parsed it so we start here
+        trace = latency.trace(time.monotonic(), len(samples))
+        latency.record("parsed", (trace,))
+      handle_batch(samples, events, block=True, trace=trace)
+    print("replay done after %d batches" % replay.batch_count)
+
+  if replay is None:
+    boards.start(lambda board: gui_calls.put(lambda: apply_board_values(board)), on_board_batch)
+    root.after(10000, report_rates)
+  else:
+    t = threading.Thread(target=replay_sensor)
+    t.start()
 
   root.mainloop()
   mainloop_done = True
-  t.join()
+  if replay is None:
+    boards.stop()
+  else:
+    t.join()
+  if capture is not None:
+    capture.close()
+  if latency is not None:
+    print(latency.summary())
+    if latency_dump is not None:
+      latency.dump(latency_dump)
+      print("latency statistics written to %s" % latency_dump)
+
+def run_headless(serial_devices, calibration, settings, output, duration=None, replay=None, capture=None,
+    latency=None, latency_dump=None):
+  # settings: name -> value, names with "%d" are set for all sensors (same names as in the GUI)
+  if replay is None:
+    boards = BoardSet(serial_devices, capture=capture)
+    batches = queue.Queue()
+    def on_values(board):
+      # again after a reconnect
+      for name, value in settings.items():
+        boards.write(name, value, board)
+    boards.start(on_values, lambda board, samples, events, read_time: batches.put((samples, events, read_time)))
+    def read_source():
+      while True:
+        try:
+          yield batches.get(timeout=0.5)
+        except queue.Empty:
+          yield None, [], None  # so we can check the duration
+    source = read_source()
+  else:
+    boards = None
+    source = ((samples, events, time.monotonic()) for samples, events in replay)
+
+  if output is None:
+    time_str = datetime.datetime.now().strftime("%Y-%m-%d--%H-%M-%S")
+    output = "tcs-headless--%s.tsv" % time_str
+  sink = SampleTsvWriter(output)
+  print("samples will be written to %s" % sink.name)
+
+  start = time.monotonic()
+  last_report = start
+  try:
+    for samples, events, read_time in source:
+      if duration is not None and time.monotonic() - start >= duration:
+        break
+      for kind, arg in events:
+        if kind == "present":
+          print("tcs%d.present=%d" % arg)
+        elif kind in ("comment", "status", "unknown"):
+          print(arg)
+      if samples is None or len(samples) == 0:
+        continue
+      trace = None
+      if latency is not None:
+        trace = latency.trace(read_time, len(samples))
+        latency.record("parsed", (trace,))
+      values = replay.values if replay is not None else boards.values
+      gain = settings.get(b"tcs%d.gain", values.get(b"tcs0.gain", 1))
+      itime = settings.get(b"tcs%d.itime", values.get(b"tcs0.itime", 62))
+      compensated = calibration.compensate(samples, gain, itime)
+      if trace is not None:
+        latency.record("compensated", (trace,))
+      sink.write(samples, compensated)
+      if trace is not None:
+        latency.record("recorded", (trace,))
+
+      if time.monotonic() - last_report >= 10:
+        last_report = time.monotonic()
+        print("%d samples" % sink.sample_count)
+        if boards is not None:
+          for board in boards.boards:
+            if board.connected:
+              print("%s: %.0f bytes/s, %.1f lines/s" % ((board,) + board.framer.rates()))
+            else:
+              print("%s: not connected" % board)
+        if latency is not None:
+          print(latency.summary(latency.rates()))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    sink.close()
+    if boards is not None:
+      boards.stop()
+    if capture is not None:
+      capture.close()
+  print("%d samples written to %s" % (sink.sample_count, sink.name))
+  if latency is not None:
+    print(latency.summary())
+    if latency_dump is not None:
+      latency.dump(latency_dump)
+      print("latency statistics written to %s" % latency_dump)
 
 if __name__ == "__main__":
-  run_gui(sys.argv[1])
+  parser = argparse.ArgumentParser(description="Show and record data of the color sensors that are connected to the Arduino")
+  parser.add_argument("serial_devices", nargs="*", metavar="serial_device", help="serial port or any URL that is supported by serial_for_url, "
+    "one for each Arduino (sensor i of the n-th one will be sensor n*%d+i)" % SENSORS_PER_BOARD)
+  parser.add_argument("--calibration", choices=calibration_modes, default="average", help="which calibration matrix to use for compensation")
+  parser.add_argument("--calibration-file", default=DEFAULT_CALIBRATION_FILE, help="calibration data, see tcs3472_calibration.json")
+  parser.add_argument("--headless", action="store_true", help="record samples without GUI")
+  parser.add_argument("--output", help="headless: output file (default: tcs-headless--TIME.tsv)")
+  parser.add_argument("--duration", type=float, help="headless: stop after this many seconds (default: until Ctrl-C)")
+  parser.add_argument("--gain", type=int, choices=range(4), help="headless: gain for all sensors")
+  parser.add_argument("--itime", type=int, choices=range(256), metavar="0..255", help="headless: integration time for all sensors")
+  parser.add_argument("--led", type=int, nargs="*", metavar="INDEX", help="headless: enable the LED of these sensors and disable the others")
+  parser.add_argument("--ws2812", type=int, nargs=3, metavar=("R", "G", "B"), help="headless: color of the WS2812")
+  parser.add_argument("--capture", help="save all bytes that we receive from the Arduino to this file (for --replay)")
+  parser.add_argument("--replay", metavar="FILE", help="use a capture (--capture) or a sample recording (--headless) instead of the Arduino")
+  parser.add_argument("--replay-speed", type=float, default=1.0, help="replay: 1 for original timing, 0 for as fast as possible")
+  parser.add_argument("--replay-start-time", type=float, help="replay: skip this many seconds")
+  parser.add_argument("--replay-start-step", type=int, help="replay: skip this many batches")
+  parser.add_argument("--sweep-tolerance", type=float, default=0.02, help="csvgen: a step is done when the last samples of each sensor are within this (relative) tolerance")
+  parser.add_argument("--sweep-min-samples", type=int, default=2, help="csvgen: number of samples that must be within the tolerance (at least 2)")
+  parser.add_argument("--sweep-max-samples", type=int, default=6, help="csvgen: a step is done after this many samples even if they don't settle")
+  parser.add_argument("--sweep-timeout", type=float, default=5.0, help="csvgen: a step is done after this many seconds even if some sensors don't send anything")
+  parser.add_argument("--display-scale", choices=TRANSFORMS, default="linear", help="scale of the graphs and bars, can be changed in the GUI")
+  parser.add_argument("--log-base", type=float, default=65536, help="log scale: 65536 is logarithmic for all counts, smaller values are closer to linear")
+  parser.add_argument("--log-floor", type=float, default=0, help="log scale: counts that are shown as zero")
+  parser.add_argument("--gamma", type=float, default=0.5, help="gamma scale: exponent")
+  parser.add_argument("--latency", action="store_true", help="measure the latency from serial data to screen (GUI) resp. file (headless)")
+  parser.add_argument("--latency-dump", metavar="FILE", help="write the latency statistics to this file at exit (implies --latency)")
+  args = parser.parse_args()
+  if not args.serial_devices and args.replay is None:
+    parser.error("serial_device is required unless --replay is used")
+  if args.capture is not None and len(args.serial_devices) > 1:
+    parser.error("--capture only works with one Arduino")
+
+  replay = None
+  sensor_count = SENSORS_PER_BOARD * max(1, len(args.serial_devices))
+  if args.replay is not None:
+    replay = Replay(args.replay, speed=args.replay_speed, start_time=args.replay_start_time, start_step=args.replay_start_step)
+    sensor_count = replay.sensor_count
+  calibration = CalibrationRegistry(args.calibration_file, sensor_count=sensor_count, mode=args.calibration)
+  latency = None
+  if args.latency or args.latency_dump is not None:
+    latency = LatencyStats()
+  capture = None
+  if args.capture is not None and replay is None:
+    capture = CaptureWriter(args.capture)
+  if args.headless:
+    settings = {}
+    if args.gain is not None:
+      settings[b"tcs%d.gain"] = args.gain
+    if args.itime is not None:
+      settings[b"tcs%d.itime"] = args.itime
+    if args.led is not None:
+      for i in range(sensor_count):
+        settings[b"tcs%d.led" % i] = 1 if i in args.led else 0
+    if args.ws2812 is not None:
+      settings[b"led0.r"], settings[b"led0.g"], settings[b"led0.b"] = args.ws2812
+    run_headless(args.serial_devices, calibration, settings, args.output, args.duration, replay=replay, capture=capture,
+      latency=latency, latency_dump=args.latency_dump)
+  else:
+    sweep_options = { "tolerance": args.sweep_tolerance, "min_samples": args.sweep_min_samples, "max_samples": args.sweep_max_samples, "timeout": args.sweep_timeout }
+    run_gui(args.serial_devices, calibration, replay=replay, capture=capture, latency=latency, latency_dump=args.latency_dump,
+      sweep_options=sweep_options, display_scale=args.display_scale,
+      display_options=dict(base=args.log_base, floor=args.log_floor, gamma=args.gamma))
@@ -0,0 +1,320 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 -p "python3.withPackages (p: with p; [numpy pyserial pyftdi tkinter])"
+
+# Measures the throughput of the stages of tcs3472_arduino.py and tcs3472_ftdi.py, e.g.:
+#   python3 tcs3472_bench.py --json results.json
+#   python3 tcs3472_bench.py --baseline results.json   # fails if something got slower
+# Metrics ending in "_per_s" are better if higher, the ones ending in "_us" are better if lower.
+
+import io
+import os
+import math
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import numpy
+import serial
+from tcs3472_protocol import SAMPLE_DTYPE, LineFramer, parse_lines
+from tcs3472_calibration import CalibrationRegistry
+from tcs3472_display import StripChart, DisplayPipeline, make_transform
+from tcs3472_recording import StepRecordingWriter, SampleTsvWriter
+
+def random_samples(n, sensor_count=6, seed=1):
+  rng = numpy.random.default_rng(seed)
+  samples = numpy.empty(n, SAMPLE_DTYPE)
+  samples["sensor"] = rng.integers(0, sensor_count, n)
+  for k in ("c", "r", "g", "b"):
+    samples[k] = rng.integers(0, 1<<16, n)
+  samples["time"] = numpy.arange(n) * 0.05
+  return samples
+
+def color_lines(samples):
+  return [b":tcs%d.color=(0x%04X, 0x%04X, 0x%04X, 0x%04X)" % (s[0], s[1], s[2], s[3], s[4]) for s in samples.tolist()]
+
+def timeit(f, *args):
+  start = time.perf_counter()
+  result = f(*args)
+  return time.perf_counter() - start, result
+
+def bench_parse(n=100000):
+  lines = color_lines(random_samples(n))
+  data = b"".join(line + b"\r\n" for line in lines)
+
+  t_parse, (samples, events) = timeit(parse_lines, lines)
+  if len(samples) != n:
+    raise Exception("parse_lines found %d of %d samples" % (len(samples), n))
+
+  # The same data through LineFramer, using a pyserial transport. This is mostly limited by loop:// (one queue
+  # operation per byte) and it blocks if it has more than 4096 bytes.
+  ser = serial.serial_for_url("loop://", timeout=0)
+  framer = LineFramer(ser, bufsize=1<<16)
+  def read_all():
+    count = 0
+    for start in range(0, len(data), 4096):
+      ser.write(data[start:start+4096])
+      while ser.in_waiting:
+        count += len(parse_lines(framer.read_lines())[0])
+    return count
+  t_framed, count = timeit(read_all)
+  if count != n:
+    raise Exception("LineFramer and parse_lines found %d of %d samples" % (count, n))
+  return {
+    "lines_per_s": n / t_parse,
+    "framed_lines_per_s": n / t_framed,
+    "framed_bytes_per_s": len(data) / t_framed,
+  }
+
+def bench_compensation(n=100000):
+  calibration = CalibrationRegistry(mode="per-sensor")
+  samples = random_samples(n)
+  gain, itime = 1, 62
+
+  def per_sample():
+    # this is what on_sensor_data used to do for each sample
+    result = []
+    for s in samples.tolist():
+      tcs_to_rgb = calibration.tcs_to_rgb(s[0], gain, itime)
+      red, green, blue = numpy.dot(tcs_to_rgb, (s[2], s[3], s[4]))
+      result.append((s[1], red, green, blue))
+    return numpy.array(result)
+
+  t_loop, expected = timeit(per_sample)
+  t_batch, values = timeit(calibration.compensate, samples, gain, itime)
+  if not numpy.allclose(expected, values):
+    raise Exception("batch compensation doesn't match per-sample compensation")
+  return {
+    "per_sample_samples_per_s": n / t_loop,
+    "batch_samples_per_s": n / t_batch,
+    "speedup": t_loop / t_batch,
+  }
+
+def bench_display(n=100000):
+  samples = random_samples(n)
+  values = numpy.stack([samples[k] for k in ("c", "r", "g", "b")], axis=1).astype(float)
+  t_build, transform = timeit(make_transform, "log", 6)
+
+  def per_sample():
+    # this is what display_values() used to do for each sample in log scale (with base 200 and floor 1)
+    vmin, vmax = math.log(1, 200), math.log(1<<16, 200)
+    return [tuple((math.log(max(1, x), 200) - vmin)/(vmax - vmin) for x in (c, r, g, b, r + g + b)) for c, r, g, b in values.tolist()]
+
+  t_loop, _ = timeit(per_sample)
+  t_lut, _ = timeit(transform.apply, samples["sensor"], values)
+  return {
+    "per_sample_samples_per_s": n / t_loop,
+    "lut_samples_per_s": n / t_lut,
+    "speedup": t_loop / t_lut,
+    "table_build_us": t_build * 1e6,
+  }
+
+class CanvasStub(object):
+  # used if there is no display, only measures our side of the drawing
+  def create_line(self, *args, **kwargs):
+    return 1
+  def create_rectangle(self, *args, **kwargs):
+    return 1
+  def coords(self, item, *args):
+    pass
+
+def bench_render(frames=200, samples_per_frame=60, sensor_count=6):
+  # the GUI's work for each frame (tcs3472_display.DisplayPipeline as in on_sensor_data: compensation,
+  # log scale, latest values and strip chart) and the redraw of the chart
+  root = None
+  try:
+    import tkinter
+    root = tkinter.Tk()
+    canvas = tkinter.Canvas(root, width=1000, height=600)
+    canvas.pack()
+    root.update()
+  except Exception:
+    canvas = CanvasStub()
+  chart = StripChart(canvas, sensor_count)
+  pipeline = DisplayPipeline(CalibrationRegistry(sensor_count=sensor_count, mode="per-sensor"),
+    make_transform("log", sensor_count), chart, sensor_count)
+  samples = random_samples(frames * samples_per_frame, sensor_count)
+  batches = [samples[i:i+samples_per_frame] for i in range(0, len(samples), samples_per_frame)]
+
+  def run(process):
+    for batch in batches:
+      process(batch)
+      pipeline.latest.clear()
+      chart.redraw(1000, 300)
+      if root is not None:
+        root.update_idletasks()
+  t, _ = timeit(run, lambda batch: pipeline.process(batch, True, 1, 62))
+
+  # only the chart, with display values that have been calculated before
+  disp = {id(batch): pipeline.transform.apply(batch["sensor"], pipeline.calibration.compensate(batch, 1, 62))[:, :4].tolist()
+    for batch in batches}
+  def append(batch):
+    for sensor_index, d in zip(batch["sensor"].tolist(), disp[id(batch)]):
+      chart.append(sensor_index, d)
+  t_chart, _ = timeit(run, append)
+  if root is not None:
+    root.destroy()
+  return {
+    "display": 1 if root is not None else 0,
+    "frame_us": t / frames * 1e6,
+    "samples_per_s": frames * samples_per_frame / t,
+    "chart_frame_us": t_chart / frames * 1e6,
+  }
+
+def bench_recording(steps=20000, samples=200000, sensor_count=6):
+  with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, "bench.tcsrec")
+    writer = StepRecordingWriter(open(path, "wb"), { "sensor_count": sensor_count })
+    record = writer.new_record()
+    record["raw"] = 1234
+    record["values"] = 1234.5
+    record["avg"] = 1234.5
+    def write_steps():
+      for step in range(steps):
+        record["step"] = step
+        writer.write(record)
+      writer.close()
+    t_steps, _ = timeit(write_steps)
+
+    sink = SampleTsvWriter(os.path.join(tmpdir, "bench.tsv"))
+    data = random_samples(samples, sensor_count)
+    values = numpy.random.default_rng(2).random((samples, 4)) * 65535
+    def write_samples():
+      for start in range(0, samples, 1000):
+        sink.write(data[start:start+1000], values[start:start+1000])
+      sink.close()
+    t_samples, _ = timeit(write_samples)
+  return {
+    "csvgen_steps_per_s": steps / t_steps,
+    "headless_samples_per_s": samples / t_samples,
+  }
+
+class MockGpio(object):
+  # Stands in for pyftdi.gpio.GpioSyncController. The slave always acknowledges and returns 0x00.
+  # exchange() is a write and a read on USB, set_direction() is a control transfer.
+  def __init__(self):
+    self.transactions = 0
+    self.direction = 0
+  def configure(self, url, direction=0, frequency=None):
+    pass
+  def set_direction(self, pins, direction):
+    self.transactions += 1
+    self.direction = direction
+  def exchange(self, out):
+    self.transactions += 2
+    return bytes(len(out))
+
+class MockI2cController(object):
+  # Stands in for pyftdi.i2c.I2cController and counts USB transfers like pyftdi does them: the start
+  # condition with the address and each written byte are sent and their ACK is read back, reads are one
+  # command buffer and one read (for up to about 100 bytes) and the stop condition is one more write.
+  class GpioPort(object):
+    def __init__(self, controller):
+      self.controller = controller
+    def set_direction(self, pins, direction):
+      self.controller.transactions += 1
+    def write(self, value):
+      self.controller.transactions += 1
+
+  def __init__(self):
+    self.transactions = 0
+    self.ftdi = self
+  def configure(self, url, **kwargs):
+    pass
+  def get_gpio(self):
+    return self.GpioPort(self)
+  def write_data(self, data):
+    self.transactions += 1
+  def write(self, address, out, relax=True):
+    self.transactions += 2 + 2*len(out) + 1
+  def read(self, address, readlen=1, relax=True):
+    self.transactions += 2 + 2 + 1
+    return bytes(readlen)
+
+def bench_i2c(transfers=200):
+  try:
+    import tcs3472_ftdi
+  except ImportError as exc:
+    print("skipping i2c benchmark: %s" % exc, file=sys.stderr)
+    return {}
+  results = {}
+  parallel = lambda url, dev: tcs3472_ftdi.I2CParallelBitbanging(url, dev, sda_pins=(0x02, 0x04, 0x10, 0x40))
+  sda_in = lambda url, dev: tcs3472_ftdi.I2CBitbanging(url, dev, sda_in_pins=(0x04,))
+  for prefix, dev, i2c_class in (("", MockGpio(), tcs3472_ftdi.I2CBitbanging), ("mpsse_", MockI2cController(), tcs3472_ftdi.I2CMpsse),
+      ("parallel4_", MockGpio(), parallel), ("sda_in_", MockGpio(), sda_in)):
+    i2c = i2c_class("mock://", dev)
+    dev.transactions = 0
+    def run():
+      with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(transfers):
+          i2c.write(0x29, [0xb4])
+          i2c.read(0x29, 8)
+    t, _ = timeit(run)
+    # one color read is a write of the register address and a read of 8 bytes, the metrics of the
+    # bitbang backend have no prefix, parallel4 reads four sensors at once, sda_in reads SDA on a separate pin
+    results[prefix + "color_reads_per_s"] = transfers / t
+    results[prefix + "usb_transactions_per_color_read"] = dev.transactions / transfers
+  # the whole TCS3472.read_color() against simulated sensors (see tcs3472_ftdi_sim.py)
+  import tcs3472_ftdi_sim
+  for sensor_count, sda_in in ((1, False), (4, False), (1, True)):
+    prefix = "sim%d_%s" % (sensor_count, "sda_in_" if sda_in else "")
+    dev, tcs = tcs3472_ftdi_sim.open_virtual(sensor_count, sda_in)
+    dev.transactions = 0
+    t, _ = timeit(lambda: [tcs.read_color() for _ in range(transfers)])
+    results[prefix + "color_reads_per_s"] = transfers / t
+    results[prefix + "usb_transactions_per_color_read"] = dev.transactions / transfers
+  return results
+
+benchmarks = {
+  "parse": bench_parse,
+  "compensation": bench_compensation,
+  "display": bench_display,
+  "render": bench_render,
+  "recording": bench_recording,
+  "i2c": bench_i2c,
+}
+
+def compare(results, baseline, tolerance):
+  regressions = []
+  for name, metrics in results.items():
+    for k, v in metrics.items():
+      old = baseline.get(name, {}).get(k)
+      if old is None or old == 0:
+        continue
+      if k.endswith("_per_s") and v < old * (1 - tolerance):
+        regressions.append("%s.%s: %.6g -> %.6g" % (name, k, old, v))
+      elif k.endswith("_us") and v > old * (1 + tolerance):
+        regressions.append("%s.%s: %.6g -> %.6g" % (name, k, old, v))
+  return regressions
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmarks for the TCS3472 tools")
+  parser.add_argument("names", nargs="*", metavar="NAME", help="benchmarks to run (default: all): " + ", ".join(benchmarks.keys()))
+  parser.add_argument("--json", metavar="FILE", help="write the results to this file")
+  parser.add_argument("--baseline", metavar="FILE", help="compare with results that were written by --json")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown compared to the baseline (default: 0.2 = 20%%)")
+  args = parser.parse_args()
+  unknown = [name for name in args.names if name not in benchmarks]
+  if unknown:
+    parser.error("unknown benchmarks: %s (choose from %s)" % (", ".join(unknown), ", ".join(benchmarks.keys())))
+
+  results = {}
+  for name in args.names or benchmarks.keys():
+    results[name] = benchmarks[name]()
+    for k, v in results[name].items():
+      print("%s.%s: %.6g" % (name, k, v))
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+      print("slower than baseline:")
+      for r in regressions:
+        print("  " + r)
+      sys.exit(1)
+    else:
+      print("no regressions compared to %s" % args.baseline)
@@ -0,0 +1,292 @@
+import re
+import asyncio
+import threading
+import time
+import numpy
+import serial
+from tcs3472_protocol import Handshake, LineFramer, parse_lines, setting_lines
+from tcs3472_commands import CommandChannel
+
+# number of sensors (TCS3472 and APDS9960) that the firmware reports, see TCS_COUNT and APDS_COUNT in src/main.cpp
+SENSORS_PER_BOARD = 6
+
+sensor_name_re = re.compile(rb'tcs(\d+)[.](.*)$')
+
+def global_name(name, offset):
+  # b"tcs1.gain" of a board with offset 6 is b"tcs7.gain"
+  m = sensor_name_re.match(name)
+  if m is None:
+    return name
+  return b"tcs%d.%s" % (int(m[1]) + offset, m[2])
+
+def transport_fileno(ser, loop):
+  # File descriptor that becomes readable when the transport has data or None if there isn't one (e.g.
+  # loop://) or the event loop can't wait for it (Windows).
+  if not hasattr(loop, "add_reader"):
+    return None
+  fd = getattr(ser, "fd", None)  # serial.Serial on POSIX
+  if fd is None:
+    sock = getattr(ser, "_socket", None)  # socket:// and rfc2217://
+    if sock is not None:
+      fd = sock.fileno()
+  return fd
+
+class TimelineMerger(object):
+  # Merges the batches of several boards into one stream that is ordered by time. A batch is held back
+  # until every board has sent (or timed out on) everything up to that time, i.e. until the "watermark".
+  # Boards that haven't said anything for `max_delay` seconds (slow or disconnected) are ignored for the
+  # watermark so they can't stall the others. Batches that they send afterwards are passed on as soon
+  # as possible, i.e. they may be out of order.
+  # Times are time.time() like the timestamps of parse_lines(). Can be used from several threads.
+  __slots__ = ("max_delay", "last_time", "_pending", "_lock")
+
+  def __init__(self, board_count, max_delay=0.2):
+    self.max_delay = max_delay
+    self.last_time = [None] * board_count
+    self._pending = []  # (timestamp, samples, read_time)
+    self._lock = threading.Lock()
+
+  @property
+  def pending(self):
+    return len(self._pending) > 0
+
+  def add(self, board_index, timestamp, samples, read_time=None):
+    # board has sent everything up to `timestamp` (even if samples is empty)
+    # Returns the samples that can be passed on (None if there aren't any) and the earliest read_time of them.
+    with self._lock:
+      self.last_time[board_index] = timestamp
+      if len(samples) > 0:
+        self._pending.append((timestamp, samples, read_time))
+      return self._pop(time.time())
+
+  def flush(self):
+    # like add() without new data, for batches that are waiting for a board that has become silent
+    with self._lock:
+      return self._pop(time.time())
+
+  def _pop(self, now):
+    if not self._pending:
+      return None, None
+    active = [t for t in self.last_time if t is not None and now - t < self.max_delay]
+    watermark = min(active) if active else now
+    ready = [p for p in self._pending if p[0] <= watermark]
+    if not ready:
+      return None, None
+    self._pending = [p for p in self._pending if p[0] > watermark]
+    ready.sort(key=lambda p: p[0])
+    read_times = [p[2] for p in ready if p[2] is not None]
+    return numpy.concatenate([p[1] for p in ready]), min(read_times) if read_times else None
+
+class Board(object):
+  # One Arduino. Its task connects (and reconnects if the connection fails), does the handshake and
+  # reads batches. Sensor indices are mapped to the global ones, i.e. sensor i of board b is
+  # b*sensors_per_board + i. Everything except __init__ runs in the event loop of the BoardSet.
+  __slots__ = ("index", "url", "offset", "sensor_count", "capture", "ser", "framer", "values", "connected", "commands", "_fd", "_readable")
+
+  def __init__(self, index, url, sensor_count=SENSORS_PER_BOARD, capture=None):
+    self.index = index
+    self.url = url
+    self.offset = index * sensor_count
+    self.sensor_count = sensor_count
+    self.capture = capture
+    self.ser = None
+    self.framer = None
+    self.values = {}
+    self.connected = False
+    self.commands = None
+    self._fd = None
+    self._readable = None
+
+  def __str__(self):
+    return "board %d (%s)" % (self.index, self.url)
+
+  def write(self, data):
+    # Returns False if the board is not connected. Use `commands` for anything that has a reply.
+    if not self.connected:
+      return False
+    try:
+      self.ser.write(data)
+      return True
+    except (serial.SerialException, OSError) as exc:
+      print("%s: write failed: %s" % (self, exc))
+      return False
+
+  def _open(self, loop):
+    self.ser = serial.serial_for_url(self.url, timeout=0)
+    self._fd = transport_fileno(self.ser, loop)
+    if self._fd is None:
+      # no way to wait for data -> blocking reads in another thread
+      self.ser.timeout = 0.1
+    else:
+      self._readable = asyncio.Event()
+      loop.add_reader(self._fd, self._readable.set)
+    self.framer = LineFramer(self.ser, capture=self.capture)
+    self.commands = CommandChannel(str(self), self.write, loop)
+
+  def _close(self, loop):
+    self.connected = False
+    if self.commands is not None:
+      self.commands.reset()
+    if self._fd is not None:
+      loop.remove_reader(self._fd)
+      self._fd = None
+    if self.ser is not None:
+      try:
+        self.ser.close()
+      except (serial.SerialException, OSError):
+        pass
+      self.ser = None
+
+  async def _read_lines(self, loop):
+    if self._fd is None:
+      return await loop.run_in_executor(None, self.framer.read_lines)
+    await self._readable.wait()
+    self._readable.clear()
+    return self.framer.read_lines()
+
+  async def run(self, board_set, retry_interval=1.0):
+    loop = asyncio.get_running_loop()
+    try:
+      while True:
+        try:
+          self._open(loop)
+          self.ser.write(Handshake.commands)
+          handshake = Handshake()
+          lines = None
+          while lines is None:
+            lines = handshake.feed(await self._read_lines(loop))
+          self.values = { global_name(k, self.offset): v for k, v in handshake.values.items() }
+          self.connected = True
+          print("%s: connected" % self)
+          board_set.on_values(self)
+          while True:
+            # wakeups without a complete line (e.g. the first bytes of a line) don't make a batch
+            if lines:
+              timestamp = time.time()
+              samples, events = parse_lines(lines, timestamp)
+              if self.offset != 0:
+                samples["sensor"] += self.offset
+                events = [("present", (arg[0] + self.offset, arg[1])) if kind == "present" else (kind, arg) for kind, arg in events]
+              if events:
+                events = self.commands.handle_events(events)
+              board_set.on_data(self, timestamp, samples, events, self.framer.read_time)
+            lines = await self._read_lines(loop)
+        except (serial.SerialException, OSError) as exc:
+          print("%s: %s, trying again in %.0f s" % (self, exc, retry_interval))
+          self._close(loop)
+          await asyncio.sleep(retry_interval)
+    finally:
+      self._close(loop)
+
+class BoardSet(object):
+  # Several Arduinos with one global sensor index space, read by one asyncio event loop in its own thread.
+  # The loop waits for data from the serial ports (or sockets) so it doesn't use any CPU when there is
+  # nothing to do.
+  # on_batch(board, samples, events, read_time) is called with samples of all boards in time order
+  # (samples may be None if nothing is ready, yet, and board is None if the samples were held back for a
+  # board that has become silent) and the events of that board. on_values(board) is called after each
+  # handshake. Both are called in the thread of the event loop so they can call write() but anything
+  # else (e.g. the GUI) must use set(). Replies to commands are not part of the events.
+  __slots__ = ("boards", "merger", "sensors_per_board", "loop", "on_values", "on_batch", "_thread", "_main_task", "_flush_handle")
+
+  def __init__(self, urls, sensors_per_board=SENSORS_PER_BOARD, capture=None, max_delay=0.2):
+    self.sensors_per_board = sensors_per_board
+    self.boards = [Board(i, url, sensors_per_board, capture) for i, url in enumerate(urls)]
+    self.merger = TimelineMerger(len(self.boards), max_delay)
+    self.loop = None
+    self._thread = None
+    self._main_task = None
+    self._flush_handle = None
+
+  @property
+  def sensor_count(self):
+    return len(self.boards) * self.sensors_per_board
+
+  @property
+  def values(self):
+    values = {}
+    for board in self.boards:
+      values.update(board.values)
+    return values
+
+  def start(self, on_values, on_batch):
+    self.on_values = on_values
+    self.on_batch = on_batch
+    self.loop = asyncio.new_event_loop()
+    self._main_task = self.loop.create_task(self._main())
+    self._thread = threading.Thread(target=self._run)
+    self._thread.start()
+
+  def _run(self):
+    asyncio.set_event_loop(self.loop)
+    try:
+      self.loop.run_until_complete(self._main_task)
+    except asyncio.CancelledError:
+      pass
+    finally:
+      self.loop.run_until_complete(self.loop.shutdown_default_executor())
+      self.loop.close()
+
+  async def _main(self):
+    await asyncio.gather(*(board.run(self) for board in self.boards))
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self.loop.call_soon_threadsafe(self._main_task.cancel)
+    self._thread.join()
+    self._thread = None
+
+  def on_data(self, board, timestamp, samples, events, read_time):
+    merged, read_time = self.merger.add(board.index, timestamp, samples, read_time)
+    if merged is not None or events:
+      self.on_batch(board, merged, events, read_time)
+    self._schedule_flush()
+
+  def _schedule_flush(self):
+    if self.merger.pending and self._flush_handle is None:
+      self._flush_handle = self.loop.call_later(self.merger.max_delay, self._flush)
+
+  def _flush(self):
+    self._flush_handle = None
+    merged, read_time = self.merger.flush()
+    if merged is not None:
+      self.on_batch(None, merged, [], read_time)
+    self._schedule_flush()
+
+  def set(self, name, value, board_index=None, callback=None):
+    # Same as write() but can be called from any thread, e.g. by the GUI when a variable has changed.
+    # Returns a concurrent.futures.Future, callback(ok) is called in the thread of the event loop.
+    board = None if board_index is None else self.boards[board_index]
+    async def write():
+      return await self.write(name, value, board, callback)
+    return asyncio.run_coroutine_threadsafe(write(), self.loop)
+
+  def write(self, name, value, board=None, callback=None):
+    # Like setting_command() but with global sensor indices, e.g. b"tcs7.led" goes to sensor 1 of the
+    # second board. Names with "%d" and the WS2812 go to all boards (or only to `board`). Returns a
+    # future that is True if all boards have answered with %ok and calls callback(ok) when it is done.
+    # Boards that are not connected are skipped (and get the values after the handshake).
+    targets = self.boards if board is None else [board]
+    lines = []
+    m = sensor_name_re.match(name)
+    if m is not None and b"%d" not in name:
+      index = int(m[1])
+      target = self.boards[index // self.sensors_per_board]
+      if target in targets:
+        lines.append((target, setting_lines(b"tcs%d.%s" % (index - target.offset, m[2]), value, target.sensor_count)))
+    else:
+      lines.extend((target, setting_lines(name, value, target.sensor_count)) for target in targets)
+    futures = [target.commands.submit(line) for target, target_lines in lines if target.connected for line in target_lines]
+
+    if futures:
+      result = asyncio.ensure_future(all_ok(futures), loop=self.loop)
+    else:
+      result = self.loop.create_future()
+      result.set_result(False)
+    if callback is not None:
+      result.add_done_callback(lambda f: callback(f.result()))
+    return result
+
+async def all_ok(futures):
+  return all(await asyncio.gather(*futures))
@@ -0,0 +1,82 @@
+import os
+import json
+import numpy, numpy.linalg
+from tcs3472_protocol import sample_channels
+
+DEFAULT_CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tcs3472_calibration.json")
+
+GAIN_COUNT = 4
+ITIME_COUNT = 256
+
+# average:    average of all measurements in the sets listed in "average" (the same matrix for all sensors)
+# per-sensor: measurement for that sensor with the closest gain and then the closest integration time,
+#             average for sensors that haven't been measured
+# datasheet:  values from the datasheet
+MODES = ("average", "per-sensor", "datasheet")
+
+class CalibrationRegistry(object):
+  # The inverse matrices (tcs_to_rgb) are computed once for every combination of sensor, gain and
+  # integration time when the mode is changed so looking them up for a sample is a plain array index.
+  __slots__ = ("path", "sensor_count", "mode", "datasheet", "average_sets", "measurements", "_rgb_to_tcs", "_tcs_to_rgb")
+
+  def __init__(self, path=DEFAULT_CALIBRATION_FILE, sensor_count=6, mode="average"):
+    self.path = path
+    self.sensor_count = sensor_count
+    with open(path) as f:
+      data = json.load(f)
+    self.datasheet = numpy.transpose(numpy.array(data["datasheet"]["response"], dtype=float))
+    self.average_sets = data.get("average")
+    self.measurements = []
+    for m in data.get("measurements", []):
+      self.measurements.append((m.get("set"), m["sensor"], m["gain"], m["itime"], numpy.transpose(numpy.array(m["response"], dtype=float))))
+    self.mode = None
+    self.set_mode(mode)
+
+  def _average(self):
+    ms = [m[4] for m in self.measurements if self.average_sets is None or m[0] in self.average_sets]
+    if not ms:
+      return self.datasheet
+    return sum(ms) / len(ms)
+
+  def set_mode(self, mode):
+    if mode not in MODES:
+      raise Exception("unknown calibration mode %r, should be one of %s" % (mode, ", ".join(MODES)))
+    shape = (self.sensor_count, GAIN_COUNT, ITIME_COUNT)
+    if mode == "datasheet":
+      rgb_to_tcs = numpy.broadcast_to(self.datasheet, shape + (3, 3))
+    elif mode == "average":
+      rgb_to_tcs = numpy.broadcast_to(self._average(), shape + (3, 3))
+    else:
+      rgb_to_tcs = numpy.empty(shape + (3, 3))
+      rgb_to_tcs[...] = self._average()
+      gains = numpy.arange(GAIN_COUNT).reshape(-1, 1, 1)
+      itimes = numpy.arange(ITIME_COUNT).reshape(1, -1, 1)
+      for sensor in range(self.sensor_count):
+        ms = [m for m in self.measurements if m[1] == sensor]
+        if not ms:
+          continue
+        m_gain = numpy.array([m[2] for m in ms])
+        m_itime = numpy.array([m[3] for m in ms])
+        distance = numpy.abs(gains - m_gain)*ITIME_COUNT + numpy.abs(itimes - m_itime)
+        nearest = numpy.argmin(distance, axis=-1)
+        rgb_to_tcs[sensor] = numpy.array([m[4] for m in ms])[nearest]
+    # Matrices are the same for many combinations so we only invert the unique ones.
+    unique, index = numpy.unique(rgb_to_tcs.reshape(-1, 9), axis=0, return_inverse=True)
+    inverses = numpy.linalg.inv(unique.reshape(-1, 3, 3))
+    self._rgb_to_tcs = numpy.ascontiguousarray(rgb_to_tcs)
+    self._tcs_to_rgb = inverses[index.reshape(-1)].reshape(shape + (3, 3))
+    self.mode = mode
+
+  def rgb_to_tcs(self, sensor, gain, itime):
+    return self._rgb_to_tcs[sensor, gain, itime]
+
+  def tcs_to_rgb(self, sensor, gain, itime):
+    return self._tcs_to_rgb[sensor, gain, itime]
+
+  def compensate(self, samples, gain, itime):
+    # samples is an array of SAMPLE_DTYPE. Returns an (N, 4) array of clear, red, green and blue
+    # with the matrix of each sample's sensor applied to red, green and blue (clear is not changed).
+    values = sample_channels(samples)
+    matrices = self._tcs_to_rgb[samples["sensor"], gain, itime]
+    values[:, 1:] = numpy.matmul(matrices, values[:, 1:, None])[:, :, 0]
+    return values
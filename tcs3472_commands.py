@@ -0,0 +1,186 @@
+import collections
+import time
+
+class Command(object):
+  __slots__ = ("line", "key", "futures", "callbacks", "tries", "sent_time")
+
+  def __init__(self, line, key):
+    self.line = line
+    self.key = key
+    self.futures = []
+    self.callbacks = []
+    self.tries = 0
+    self.sent_time = None
+
+  def complete(self, ok):
+    for future in self.futures:
+      if not future.done():
+        future.set_result(ok)
+    for callback in self.callbacks:
+      callback(ok)
+
+class CommandChannel(object):
+  # Sends commands to one Arduino and matches them with the replies. The firmware answers each command
+  # with exactly one line (%ok, %failed or %ERR: ...) in the order of the commands, i.e. a reply belongs
+  # to the oldest command that hasn't been answered, yet.
+  #  - Commands are queued and everything that is queued in one iteration of the event loop is written at
+  #    once. At most `window` commands are waiting for a reply; the others stay in the queue.
+  #  - A command for a setting that is still in the queue replaces the queued one, e.g. while a slider is
+  #    being dragged, and completes both of them.
+  #  - If the oldest command hasn't been answered after `timeout` seconds, all commands that are waiting
+  #    are sent again. This is at most `retries` times for each of them. Settings don't change anything
+  #    if they are applied twice. After a timeout, the next commands (the ones that are sent again or new
+  #    ones) are sent after a fence (FENCE, the firmware answers it with %values ... %end) and the replies
+  #    before the end of its answer are late replies to the commands that were sent before so they are
+  #    ignored instead of completing the wrong command. A fence that hasn't been answered when the commands
+  #    after it time out is given up (e.g. its answer got lost) and the next commands get a new one.
+  # submit() returns a future with True for %ok and False for anything else (including a timeout or a
+  # lost connection) and calls `callback(ok)` if there is one. Everything runs in the event loop.
+  __slots__ = ("name", "write", "loop", "window", "timeout", "retries", "_queue", "_waiting", "_fence_next", "_fences",
+    "_in_fence", "_flush_handle", "_timeout_handle")
+
+  FENCE = b"?\r\n"
+
+  def __init__(self, name, write, loop, window=8, timeout=0.5, retries=2):
+    # write(data) must return False if the data couldn't be sent
+    self.name = name
+    self.write = write
+    self.loop = loop
+    self.window = window
+    self.timeout = timeout
+    self.retries = retries
+    self._queue = collections.OrderedDict()  # key -> Command, key is b":tcs0.gain" for b":tcs0.gain=1\r\n"
+    self._waiting = collections.deque()
+    self._fence_next = False  # send a fence before the next commands
+    self._fences = 0  # fences without %values, yet
+    self._in_fence = False  # between %values and %end
+    self._flush_handle = None
+    self._timeout_handle = None
+
+  @property
+  def busy(self):
+    return len(self._queue) > 0 or len(self._waiting) > 0
+
+  def submit(self, line, callback=None):
+    # line is one command including b"\r\n"
+    key = line.split(b"=", 1)[0]
+    command = self._queue.get(key)
+    if command is None:
+      command = Command(line, key)
+      self._queue[key] = command
+    else:
+      command.line = line
+    future = self.loop.create_future()
+    command.futures.append(future)
+    if callback is not None:
+      command.callbacks.append(callback)
+    if self._flush_handle is None:
+      self._flush_handle = self.loop.call_soon(self._flush)
+    return future
+
+  def _flush(self):
+    self._flush_handle = None
+    commands = []
+    while self._queue and len(self._waiting) + len(commands) < self.window:
+      commands.append(self._queue.popitem(last=False)[1])
+    self._send(commands)
+
+  def _send(self, commands):
+    if not commands:
+      return
+    fence = self._fence_next
+    if not self.write((self.FENCE if fence else b"") + b"".join(c.line for c in commands)):
+      for c in commands:
+        c.complete(False)
+      return
+    if fence:
+      self._fence_next = False
+      self._fences += 1
+    now = time.monotonic()
+    for c in commands:
+      c.tries += 1
+      c.sent_time = now
+      self._waiting.append(c)
+    if self._timeout_handle is None:
+      self._timeout_handle = self.loop.call_later(self.timeout, self._check_timeout)
+
+  def _check_timeout(self):
+    self._timeout_handle = None
+    if not self._waiting:
+      return
+    age = time.monotonic() - self._waiting[0].sent_time
+    if age < self.timeout:
+      self._timeout_handle = self.loop.call_later(self.timeout - age, self._check_timeout)
+      return
+    # the replies are lost and so is the answer of the fence before them (if there is one)
+    self._clear_fences()
+    self._fence_next = True
+    retry = []
+    for c in self._waiting:
+      if c.tries > self.retries:
+        print("%s: no reply for %r" % (self.name, c.line.rstrip()))
+        c.complete(False)
+      else:
+        retry.append(c)
+    self._waiting.clear()
+    if retry:
+      print("%s: no reply for %r, sending %d commands again" % (self.name, retry[0].line.rstrip(), len(retry)))
+    self._send(retry)
+    self._flush()
+
+  def _clear_fences(self):
+    if self._fences or self._in_fence:
+      print("%s: no answer for the fence, giving up on it" % self.name)
+    self._fences = 0
+    self._in_fence = False
+
+  def handle_events(self, events):
+    # Completes commands for replies in the events of parse_lines() and returns the other events.
+    rest = []
+    for kind, arg in events:
+      if self._fences or self._in_fence:
+        # the answer of a fence (but "present" is still good to know) and late replies before it
+        if kind == "status" and arg == b"%values" and self._fences:
+          self._fences -= 1
+          self._in_fence = True
+        elif kind == "status" and arg == b"%end" and self._in_fence:
+          self._in_fence = False
+        elif kind == "present":
+          rest.append((kind, arg))
+        elif not self._in_fence and kind in ("ok", "status"):
+          print("%s: ignoring late reply %r" % (self.name, arg or b"%ok"))
+        elif not self._in_fence:
+          rest.append((kind, arg))
+        continue
+      if kind == "ok":
+        ok = True
+      elif kind == "status" and (arg.startswith(b"%failed") or arg.startswith(b"%ERR")):
+        ok = False
+      else:
+        rest.append((kind, arg))
+        continue
+      if not self._waiting:
+        rest.append((kind, arg))  # not for us, e.g. a late reply after a retry
+        continue
+      command = self._waiting.popleft()
+      if not ok:
+        print("%s: %r for %r" % (self.name, arg, command.line.rstrip()))
+      command.complete(ok)
+    if self._queue and self._flush_handle is None:
+      self._flush_handle = self.loop.call_soon(self._flush)
+    return rest
+
+  def reset(self):
+    # connection is lost
+    for c in list(self._waiting) + list(self._queue.values()):
+      c.complete(False)
+    self._waiting.clear()
+    self._queue.clear()
+    self._fence_next = False
+    self._fences = 0
+    self._in_fence = False
+    for handle in (self._flush_handle, self._timeout_handle):
+      if handle is not None:
+        handle.cancel()
+    self._flush_handle = None
+    self._timeout_handle = None
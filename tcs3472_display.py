@@ -0,0 +1,189 @@
+import numpy
+from tcs3472_protocol import sample_channels
+
+CHANNEL_NAMES = ("clear", "red", "green", "blue")
+CHANNEL_COLORS = ("white", "red", "green", "blue")
+# sensor 0 is drawn as a solid line, the others with these patterns
+SENSOR_DASHES = ((), (6, 2), (2, 2), (6, 2, 2, 2), (10, 4), (2, 6))
+
+class StripChart(object):
+  # Keeps the last `capacity` display values (0..1) for each sensor and channel in a ring buffer and draws
+  # each of them as one polyline. The canvas items are created once and only their coordinates are updated
+  # so the cost of a redraw doesn't grow with the runtime.
+  __slots__ = ("canvas", "sensor_count", "capacity", "step", "_values", "_index", "_count", "_items", "_offsets")
+
+  def __init__(self, canvas, sensor_count, capacity=4096, step=1):
+    self.canvas = canvas
+    self.sensor_count = sensor_count
+    self.capacity = capacity
+    self.step = step
+    self._values = numpy.zeros((sensor_count, len(CHANNEL_NAMES), capacity))
+    self._index = [0] * sensor_count
+    self._count = [0] * sensor_count
+    self._offsets = numpy.arange(capacity)
+    self._items = []
+    for sensor_index in range(sensor_count):
+      dash = SENSOR_DASHES[sensor_index % len(SENSOR_DASHES)]
+      self._items.append([canvas.create_line(-1, -1, -1, -1, fill=color, width=2 if sensor_index == 0 else 1, dash=dash,
+          tags=(name, "lines", "lines%d" % sensor_index))
+        for name, color in zip(CHANNEL_NAMES, CHANNEL_COLORS)])
+
+  def clear(self):
+    for sensor_index in range(self.sensor_count):
+      self._index[sensor_index] = 0
+      self._count[sensor_index] = 0
+      for item in self._items[sensor_index]:
+        self.canvas.coords(item, -1, -1, -1, -1)
+
+  def append(self, sensor_index, values):
+    i = self._index[sensor_index]
+    self._values[sensor_index, :, i] = values
+    self._index[sensor_index] = (i + 1) % self.capacity
+    self._count[sensor_index] = min(self._count[sensor_index] + 1, self.capacity)
+
+  def redraw(self, width, height):
+    # newest value at the right edge, height is the height of the chart area (value 1.0 is at the top)
+    max_points = min(self.capacity, int(width) // self.step + 1)
+    for sensor_index in range(self.sensor_count):
+      n = min(self._count[sensor_index], max_points)
+      if n < 2:
+        continue
+      offsets = self._offsets[:n]
+      index = (self._index[sensor_index] - n + offsets) % self.capacity
+      coords = numpy.empty(2*n)
+      coords[0::2] = width - 1 - self.step*(n - 1 - offsets)
+      for item, values in zip(self._items[sensor_index], self._values[sensor_index]):
+        coords[1::2] = height + 2 - values[index]*height
+        self.canvas.coords(item, coords.tolist())
+
+# Display transforms map the values of the sensors (counts 0..65535, raw or compensated) to display
+# values (0..1 is the height of the chart). Each one is a lookup table with TABLE_SIZE entries for each
+# of the display channels (clear, red, green, blue and the sum of red, green and blue; the sum is looked
+# up with the average of red, green and blue so it has the same range). Subclasses only implement
+# curve() and are added to TRANSFORMS to show up in the GUI.
+TABLE_SIZE = 1 << 16
+DISPLAY_CHANNELS = ("clear", "red", "green", "blue", "sum")
+
+class DisplayTransform(object):
+  __slots__ = ("tables",)
+  per_sensor = False  # separate tables for each sensor
+  options = ()  # keyword arguments of __init__ that make_transform() passes on
+
+  def __init__(self, sensor_count=1):
+    x = numpy.arange(TABLE_SIZE, dtype=float)
+    # (channels, TABLE_SIZE) or (sensors, channels, TABLE_SIZE) if the curve depends on the sensor
+    if self.per_sensor:
+      self.tables = numpy.array([[self.curve(x, c, s) for c in range(len(DISPLAY_CHANNELS))] for s in range(sensor_count)], dtype=numpy.float32)
+    else:
+      self.tables = numpy.array([self.curve(x, c, None) for c in range(len(DISPLAY_CHANNELS))], dtype=numpy.float32)
+
+  def curve(self, x, channel, sensor):
+    # x is 0..TABLE_SIZE-1 as floats, returns the display values for them
+    raise NotImplementedError()
+
+  def apply(self, sensors, values):
+    # sensors (n,), values (n, 4) with clear, red, green and blue -> (n, 5) with DISPLAY_CHANNELS
+    index = numpy.empty((len(values), len(DISPLAY_CHANNELS)), dtype=numpy.intp)
+    numpy.clip(numpy.rint(values), 0, TABLE_SIZE - 1, out=index[:, :4], casting="unsafe")
+    numpy.clip(numpy.rint(numpy.mean(values[:, 1:4], axis=1)), 0, TABLE_SIZE - 1, out=index[:, 4], casting="unsafe")
+    channels = numpy.arange(len(DISPLAY_CHANNELS))
+    if self.tables.ndim == 2:
+      return self.tables[channels, index]
+    return self.tables[numpy.minimum(sensors, len(self.tables) - 1)[:, None], channels, index]
+
+class LinearTransform(DisplayTransform):
+  __slots__ = ()
+
+  def curve(self, x, channel, sensor):
+    # the sum is red + green + blue, i.e. up to 3
+    return x * (3 if channel == 4 else 1) / TABLE_SIZE
+
+class LogTransform(DisplayTransform):
+  # log_base(1 + (base-1) * t) where t is 0..1 for floor..65536 counts, i.e. base 65536 with floor 0 is
+  # the logarithm of the counts and the scale is closer to linear for smaller bases.
+  __slots__ = ("base", "floor")
+  options = ("base", "floor")
+
+  def __init__(self, sensor_count=1, base=65536.0, floor=0.0):
+    self.base = max(base, 1.0 + 1e-9)
+    self.floor = floor
+    super().__init__(sensor_count)
+
+  def curve(self, x, channel, sensor):
+    t = numpy.maximum(x - self.floor, 0) / (TABLE_SIZE - self.floor)
+    return numpy.log1p((self.base - 1) * t) / numpy.log(self.base)
+
+class GammaTransform(DisplayTransform):
+  __slots__ = ("gamma",)
+  options = ("gamma",)
+
+  def __init__(self, sensor_count=1, gamma=0.5):
+    self.gamma = gamma
+    super().__init__(sensor_count)
+
+  def curve(self, x, channel, sensor):
+    return (x / TABLE_SIZE) ** self.gamma
+
+class NormalizedTransform(DisplayTransform):
+  # Each channel of each sensor relative to a reference (sensors, 4), e.g. the values at full red, green
+  # and blue like the normalized graphs in the README. Channels without a reference are shown linearly.
+  __slots__ = ("reference",)
+  per_sensor = True
+  options = ("reference",)
+
+  def __init__(self, sensor_count=1, reference=None):
+    self.reference = numpy.zeros((sensor_count, 4)) if reference is None else numpy.asarray(reference, dtype=float)
+    super().__init__(sensor_count)
+
+  def curve(self, x, channel, sensor):
+    if channel == 4:
+      ref = self.reference[sensor, 1:4].mean()
+    else:
+      ref = self.reference[sensor, channel]
+    return x / ref if ref > 0 else x / TABLE_SIZE
+
+# name -> class, the GUI creates them with make_transform()
+TRANSFORMS = {
+  "linear": LinearTransform,
+  "log": LogTransform,
+  "gamma": GammaTransform,
+  "normalized": NormalizedTransform,
+}
+
+def make_transform(name, sensor_count, **options):
+  # options that the transform doesn't have are ignored, e.g. the GUI passes base, floor and gamma to all of them
+  cls = TRANSFORMS[name]
+  return cls(sensor_count, **{ k: v for k, v in options.items() if k in cls.options })
+
+class DisplayPipeline(object):
+  # What the GUI does with each batch of samples, without Tk so it can be benchmarked: compensation, the
+  # display transform, the latest values of each sensor and the strip chart. `transform` is replaced when
+  # the scale changes and `latest` (sensor -> (raw, display values)) is emptied by whoever draws the bars.
+  __slots__ = ("calibration", "transform", "chart", "latest_values", "latest")
+
+  def __init__(self, calibration, transform, chart, sensor_count):
+    self.calibration = calibration
+    self.transform = transform
+    self.chart = chart
+    # latest values (raw or compensated) of each sensor, e.g. for the reference of the normalized scale
+    self.latest_values = numpy.zeros((sensor_count, 4))
+    self.latest = {}
+
+  def compensate(self, samples, compensated, gain, itime):
+    # returns the raw values and the values that are shown (compensated or raw), both (n, 4)
+    raw = sample_channels(samples, numpy.int64)
+    if compensated:
+      return raw, self.calibration.compensate(samples, gain, itime)
+    return raw, raw
+
+  def display(self, samples, raw, values):
+    sensors = samples["sensor"]
+    self.latest_values[sensors] = values
+    for sensor_index, r, disp in zip(sensors.tolist(), raw.tolist(), self.transform.apply(sensors, values).tolist()):
+      self.chart.append(sensor_index, disp[:4])
+      self.latest[sensor_index] = (tuple(r), disp)
+
+  def process(self, samples, compensated, gain, itime):
+    raw, values = self.compensate(samples, compensated, gain, itime)
+    self.display(samples, raw, values)
+    return raw, values
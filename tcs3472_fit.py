@@ -0,0 +1,201 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 -p "python3.withPackages (p: with p; [numpy])"
+
+# Fits the calibration matrices (see tcs3472_calibration.json) to csvgen recordings of WS2812 sweeps, e.g.:
+#   python3 tcs3472_fit.py tcstest1--*.tcsrec --set e --output my_calibration.json
+#   python3 tcs3472_arduino.py COMPORT --calibration-file my_calibration.json --calibration per-sensor
+# Each file is reduced to the normal equations of a linear least squares problem (in a process pool) so
+# only a few small matrices have to be combined and solved at the end.
+
+import sys
+import json
+import argparse
+import datetime
+import concurrent.futures
+import numpy, numpy.linalg
+from tcs3472_recording import RECORDING_MAGIC, MODE_NAMES, read_recording
+from tcs3472_calibration import DEFAULT_CALIBRATION_FILE
+
+GAIN_FACTORS = (1, 4, 16, 60)
+
+def load_steps(path, gain=None, itime=None):
+  # Returns mode (N,), rgb (N, 3), raw (N, S, 4) with the average of the raw values (NaN if the sensor
+  # didn't send any), gain (N,) and itime (N,) for a csvgen recording (.tcsrec) or a TSV file that has
+  # been exported from one (or written by older versions). gain and itime are needed for TSV files and
+  # override the header of recordings, except for the steps of itime and gain sweeps (the step is the
+  # value of the setting).
+  with open(path, "rb") as f:
+    is_recording = f.read(len(RECORDING_MAGIC)) == RECORDING_MAGIC
+  if is_recording:
+    header, records = read_recording(path)
+    sensor_count = header["sensor_count"]
+    settings = header.get("settings", {})
+    mode = numpy.asarray(records["mode"])
+    step = numpy.asarray(records["step"], dtype=int)
+    rgb = records["rgb"].astype(float)
+    raw = records["raw"][:, :, 0].astype(numpy.float32)
+    raw += records["raw"][:, :, 1]
+    raw *= 0.5
+    # StepCollector writes zeros and NaN for sensors that haven't sent anything
+    raw[numpy.isnan(records["avg"][:, :, 0]) | (raw[:, :, 0] == 0)] = numpy.nan
+    gain = settings.get("gain") if gain is None else gain
+    itime = settings.get("itime") if itime is None else itime
+  else:
+    with open(path) as f:
+      columns = f.readline().rstrip("\n").split("\t")
+    sensor_count = sum(1 for c in columns if c.endswith(".raw_c1"))
+    modes = numpy.loadtxt(path, delimiter="\t", skiprows=1, usecols=0, dtype=str, ndmin=1)
+    mode = numpy.array([MODE_NAMES.index(m) if m in MODE_NAMES else 255 for m in modes])
+    data = numpy.loadtxt(path, delimiter="\t", skiprows=1, usecols=range(1, len(columns)), ndmin=2)
+    step = data[:, 0].astype(int)
+    rgb = data[:, 1:4]
+    raw = numpy.empty((len(data), sensor_count, 4))
+    for i in range(sensor_count):
+      first = columns.index("sensor%d.raw_c1" % i) - 1
+      raw[:, i] = (data[:, first:first+4] + data[:, first+4:first+8]) / 2
+    raw[(raw == 0).all(axis=2)] = numpy.nan
+  gains = numpy.where(mode == MODE_NAMES.index("gain"), step, -1 if gain is None else gain)
+  itimes = numpy.where(mode == MODE_NAMES.index("itime"), step, -1 if itime is None else itime)
+  if (gains < 0).any() or (itimes < 0).any():
+    raise Exception("%s: gain and integration time are unknown, use --gain and --itime" % path)
+  return mode, rgb, raw, gains, itimes
+
+def normal_equations(path, modes=(1,), scale=False, gain=None, itime=None, chunk_size=1<<20):
+  # Reduces one file to sums for each (gain, itime): X^T X (S, 3, 3), X^T Y (S, 3, 4), Y^T Y (S, 4) and
+  # the number of rows (S,), where X is the WS2812 color and Y is the raw values of a sensor. With
+  # `scale`, Y is divided by the gain and the number of integration cycles and all rows are in the same
+  # group (None, None).
+  mode, rgb, raw, gains, itimes = load_steps(path, gain, itime)
+  sums = {}
+  for start in range(0, len(mode), chunk_size):
+    end = start + chunk_size
+    use = numpy.isin(mode[start:end], modes)
+    x = rgb[start:end][use]
+    y = raw[start:end][use].astype(float)
+    g = gains[start:end][use]
+    t = itimes[start:end][use]
+    if scale:
+      y /= (numpy.take(GAIN_FACTORS, g) * (t + 1)).reshape(-1, 1, 1)
+      keys = [((None, None), numpy.ones(len(x), dtype=bool))]
+    else:
+      groups = numpy.unique(g * 256 + t)
+      keys = [((int(k // 256), int(k % 256)), g * 256 + t == k) for k in groups]
+    for key, rows in keys:
+      xs = x[rows]
+      ys = y[rows]
+      w = numpy.isfinite(ys).all(axis=2)  # (n, S)
+      ys[~w] = 0
+      # everything as if all sensors were present (a few big matrix products) minus the rows of missing ones
+      xtx = numpy.repeat((xs.T @ xs)[None], ys.shape[1], axis=0)
+      xty = numpy.einsum("ni,nsj->sij", xs, ys, optimize=True)
+      yty = numpy.einsum("nsj,nsj->sj", ys, ys, optimize=True)
+      for s in numpy.flatnonzero(~w.all(axis=0)):
+        xm = xs[~w[:, s]]
+        xtx[s] -= xm.T @ xm
+      if key in sums:
+        for total, part in zip(sums[key], (xtx, xty, yty, w.sum(axis=0))):
+          total += part
+      else:
+        sums[key] = [xtx, xty, yty, w.sum(axis=0)]
+  return sums
+
+def combine(results):
+  total = {}
+  for sums in results:
+    for key, parts in sums.items():
+      if key not in total:
+        total[key] = [p.copy() for p in parts]
+        continue
+      if total[key][0].shape != parts[0].shape:
+        raise Exception("recordings have a different number of sensors")
+      for t, p in zip(total[key], parts):
+        t += p
+  return total
+
+def solve(xtx, xty, yty, count, min_rows=3):
+  # Least squares for each sensor. Returns a list with None or (coefficients (k, 4), rms residual (4,)).
+  result = []
+  for s in range(len(xtx)):
+    if count[s] < max(min_rows, len(xtx[s])) or numpy.linalg.matrix_rank(xtx[s]) < len(xtx[s]):
+      result.append(None)
+      continue
+    b = numpy.linalg.solve(xtx[s], xty[s])
+    rss = yty[s] - 2 * numpy.einsum("kj,kj->j", b, xty[s]) + numpy.einsum("kj,kl,lj->j", b, xtx[s], b)
+    result.append((b, numpy.sqrt(numpy.maximum(rss, 0) / count[s])))
+  return result
+
+def measurements(total, set_name, scale=False):
+  # entries for "measurements" in the calibration file, sorted by sensor, gain and itime
+  result = []
+  for key in sorted(total, key=lambda k: (k[0] is None, k)):
+    gain, itime = key
+    xtx, xty, yty, count = total[key]
+    for sensor, fit in enumerate(solve(xtx, xty, yty, count)):
+      if fit is None:
+        continue
+      b, rms = fit
+      # b[p] is (clear, red, green, blue) of the sensor for one step of WS2812 primary p
+      if (b[:, 0] <= 0).any():
+        print("sensor %d, gain %s, itime %s: clear doesn't increase with all primaries, skipped" % (sensor, gain, itime), file=sys.stderr)
+        continue
+      m = {
+        "set": set_name,
+        "sensor": sensor,
+        # the fit with `scale` is for all of them, the registry uses the nearest one
+        "gain": 0 if gain is None else gain,
+        "itime": 255 if itime is None else itime,
+        "clear": [round(float(c), 3 if scale else 0) for c in 255 * b[:, 0]],
+        "response": [[round(float(v), 4) for v in b[p, 1:] / b[p, 0]] for p in range(3)],
+        "rows": int(count[sensor]),
+        "rms": [round(float(v), 3) for v in rms],
+      }
+      result.append(m)
+  return result
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Fit calibration matrices to csvgen recordings")
+  parser.add_argument("files", nargs="+", help="csvgen recordings (.tcsrec) or TSV files that have been exported from them")
+  parser.add_argument("--base", default=DEFAULT_CALIBRATION_FILE, help="calibration file that the new measurements are added to")
+  parser.add_argument("--output", help="where to write the calibration file (default: print it)")
+  parser.add_argument("--set", default=None, help="name of the set for the new measurements (default: fit-DATE)")
+  parser.add_argument("--replace", action="store_true", help="remove all measurements of the base file")
+  parser.add_argument("--average", action="store_true", help="use only the new set for the average mode")
+  parser.add_argument("--scale", action="store_true", help="divide by gain and integration time so recordings with different settings are fitted together")
+  parser.add_argument("--modes", nargs="+", choices=MODE_NAMES, default=["WS2812"], help="csvgen modes that are used (default: WS2812)")
+  parser.add_argument("--gain", type=int, choices=range(4), help="gain for TSV files (and to override recordings)")
+  parser.add_argument("--itime", type=int, choices=range(256), metavar="0..255", help="integration time for TSV files (and to override recordings)")
+  parser.add_argument("--jobs", type=int, help="number of processes (default: number of CPUs)")
+  args = parser.parse_args()
+
+  set_name = args.set or "fit-" + datetime.date.today().isoformat()
+  modes = [MODE_NAMES.index(m) for m in args.modes]
+  options = dict(modes=modes, scale=args.scale, gain=args.gain, itime=args.itime)
+  if len(args.files) == 1:
+    results = [normal_equations(args.files[0], **options)]
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+      futures = [pool.submit(normal_equations, path, **options) for path in args.files]
+      results = [f.result() for f in futures]
+  new = measurements(combine(results), set_name, args.scale)
+  if not new:
+    print("nothing to fit, are there any %s steps in the files?" % "/".join(args.modes), file=sys.stderr)
+    sys.exit(1)
+
+  with open(args.base) as f:
+    data = json.load(f)
+  data.setdefault("sets", {})[set_name] = "fitted by tcs3472_fit.py from %s (modes %s%s)" % (
+    ", ".join(args.files), ", ".join(args.modes), ", scaled to gain 1x and one cycle" if args.scale else "")
+  data["measurements"] = ([] if args.replace else data.get("measurements", [])) + new
+  if args.average or args.replace:
+    data["average"] = [set_name]
+
+  for m in new:
+    print("sensor %d, gain %d, itime %3d: %7d rows, rms %s, response %s" % (m["sensor"], m["gain"], m["itime"], m["rows"], m["rms"], m["response"]),
+      file=sys.stderr)
+  text = json.dumps(data, indent=2)
+  if args.output is None:
+    print(text)
+  else:
+    with open(args.output, "w") as f:
+      f.write(text + "\n")
+    print("written to %s" % args.output, file=sys.stderr)
@@ -8,36 +8,196 @@ url = 'ftdi://ftdi:2232h/1'
 # datasheet: https://cdn-shop.adafruit.com/datasheets/TCS34725.pdf
 
 import sys
+import time
+import logging
+import argparse
 import pyftdi.gpio
+import pyftdi.i2c
 from time import sleep
 
-class I2CBitbanging(object):
-	__slots__ = ("dev", "_gpio_direction", "_gpio_value", "_i2c_direction", "_i2c_value")
+# --log-level debug shows every byte that is read
+log = logging.getLogger("tcs3472_ftdi")
+
+# pins of the FTDI port: bit 0 is SCL, bit 1 is SDA, the others are GPIOs (e.g. 0x08 is the LED)
+SCL = 0x1
+SDA = 0x2
+
+# The FTDI pins are push-pull so plain bitbanging releases SDA by making its pin an input. Each change of
+# direction is a USB transfer: a color read takes 22 calls of exchange() and set_direction(), i.e. 64 USB
+# transactions in tcs3472_bench.py (70 in tcs3472_ftdi_sim.py).
+# --sda-in-pins needs extra hardware: SDA is also connected to an input pin (e.g. ADBUS2, like for
+# --backend mpsse) and a Schottky diode goes from SDA to the SDA pin (cathode at ADBUS1). The SDA pin then
+# stays an output that can only pull SDA low (high is released) and each I2C transfer is one exchange(),
+# i.e. 4 USB transactions for a color read. pyftdi splits the 285 bytes of the read into writes of the
+# FIFO size and reads of 64 byte packets so that is about 10 USB transfers on an FT2232D.
+
+# output bytes (i.e. pin changes) per second in synchronous bitbang mode, one SCL period takes about
+# four of them
+BITBANG_FREQUENCY = 400e3
+
+def pin_mask(pins):
+	# OR of the pins, which must be different bits
+	mask = 0
+	for pin in pins:
+		if mask & pin or pin == 0 or pin & (pin - 1) or pin > 0xff:
+			raise Exception("pins must be different bits of the port: %s" % ", ".join("0x%02x" % p for p in pins))
+		mask |= pin
+	return mask
+
+class BitbangProgram(object):
+	# Pin states for a whole I2C transaction so it can be sent with a few calls of exchange() instead of
+	# one USB transfer for each edge. SDA is open-drain, i.e. we release it by making it an input (or by
+	# setting it high with the diode, see above), and the direction can't be changed in the middle of an
+	# exchange() so the program is split into segments with the same direction. Each sample() is an extra
+	# byte that repeats the current state; its input byte is the state of the pins after the previous
+	# byte. Everything is only appended because this runs for each transfer.
+	__slots__ = ("segments", "samples")
+
+	def __init__(self):
+		self.segments = []  # (SDA is an output, bytearray)
+		self.samples = []  # (segment index, byte index)
+
+	def out(self, sda_output, *values):
+		if not self.segments or self.segments[-1][0] != sda_output:
+			self.segments.append((sda_output, bytearray()))
+		self.segments[-1][1].extend(values)
+
+	def sample(self):
+		data = self.segments[-1][1]
+		data.append(data[-1])
+		self.samples.append((len(self.segments) - 1, len(data) - 1))
+		return len(self.samples) - 1
+
+	def start(self):
+		# SCL and SDA are high when the bus is idle, SDA goes low while SCL is high
+		self.out(True, SCL | SDA, SCL, 0)
+
+	def stop(self):
+		# SDA goes high while SCL is high
+		self.out(True, 0, SCL, SCL | SDA)
+
+	def write_byte(self, byte):
+		# returns the index of the sample that is the ACK bit (low = ACK)
+		for i in range(7, -1, -1):
+			v = SDA if (byte >> i) & 1 else 0
+			self.out(True, v, v | SCL, v)
+		self.out(False, 0, SCL)
+		ack = self.sample()
+		self.out(False, 0)
+		return ack
+
+	def read_byte(self, ack):
+		# returns the indices of the samples of the bits (MSB first), we send an ACK if `ack` is True
+		bits = []
+		self.out(False, 0)
+		for _ in range(8):
+			self.out(False, SCL)
+			bits.append(self.sample())
+			self.out(False, 0)
+		if ack:
+			self.out(True, 0, SCL, 0)
+		else:
+			self.out(False, SCL, 0)
+		return bits
+
+class I2CBus(object):
+	# What TCS3472 needs from an I2C master: transfer() returns the data for reads, True for writes and
+	# False if the slave didn't acknowledge, fix_i2c() recovers from a slave that holds SDA low and
+	# gpio_direction/gpio_value are the other pins of the port (e.g. the LED). See BACKENDS.
+	__slots__ = ()
+
+	def transfer(self, address, read, readlen_or_data):
+		raise NotImplementedError()
 
-	def __init__(self, url):
-		self.dev = pyftdi.gpio.GpioAsyncController()
-		self.dev.open_from_url(url=url)
-		self.dev.set_direction(0xff, 0x1)
+	def fix_i2c(self, always_generate_stop=False):
+		raise NotImplementedError()
+
+	def read(self, address, length):
+		data = self.transfer(address, True, length)
+		if data and log.isEnabledFor(logging.DEBUG):
+			for i, d in enumerate(data):
+				log.debug("byte %d: 0x%02x", i, d)
+		return data
+
+	def write(self, address, data):
+		return self.transfer(address, False, data)
+
+	def scan(self):
+		for i in range(128):
+			while True:
+				try:
+					print((i, self.write(i, [])))
+					break
+				except pyftdi.ftdi.FtdiError:
+					print("error")
+
+class I2CBitbanging(I2CBus):
+	# The pins of BitbangProgram are translated to the pins of the port: SDA can be several pins
+	# (`sda_pins`, see I2CParallelBitbanging) and the other ones are GPIOs. With `sda_in_pins` (one for each
+	# of sda_pins), SDA is read on them and sda_pins are always outputs (with the diode, see above).
+	__slots__ = ("dev", "sda_pins", "sda_in_pins", "_sda_mask", "_gpio_pins", "_gpio_direction", "_gpio_value",
+		"_i2c_direction", "_i2c_value", "_sda_output", "_pin_tables", "_programs")
+
+	def __init__(self, url, dev=None, sda_pins=(SDA,), sda_in_pins=None):
+		# dev can be replaced by anything that behaves like GpioSyncController, e.g. for benchmarks
+		self.sda_pins = tuple(sda_pins)
+		self.sda_in_pins = tuple(sda_in_pins) if sda_in_pins is not None else None
+		self._sda_mask = pin_mask(self.sda_pins)
+		i2c_pins = (SCL,) + self.sda_pins + (self.sda_in_pins or ())
+		pin_mask(i2c_pins)
+		if self.sda_in_pins is not None and len(self.sda_in_pins) != len(self.sda_pins):
+			raise Exception("there must be one SDA input pin for each SDA pin")
+		self._gpio_pins = 0xff & ~pin_mask(i2c_pins)
+		self.dev = dev if dev is not None else pyftdi.gpio.GpioSyncController()
+		# SDA is released (input or high)
+		self._i2c_direction = SCL | (self._sda_mask if self.sda_in_pins is not None else 0)
+		self.dev.configure(url, direction=self._i2c_direction, frequency=BITBANG_FREQUENCY)
+		self.dev.set_direction(0xff, self._i2c_direction)
 		self._gpio_direction = 0
 		self._gpio_value = 0
-		self._i2c_direction = 0x1
-		self._i2c_value = 0x3
+		self._i2c_value = SCL | SDA  # as in BitbangProgram, i.e. SDA is all of sda_pins
+		self._sda_output = False
+		self._pin_tables = None
+		self._programs = {}
+
+	@property
+	def gpio_pins(self):
+		# pins that are not used by I2C, e.g. for LEDs
+		return self._gpio_pins
 
 	def _update_direction(self):
-		self.dev.set_direction(0xff, self._i2c_direction | (self._gpio_direction & 0xf8))
+		self.dev.set_direction(0xff, self._i2c_direction | (self._gpio_direction & self._gpio_pins))
 	def _update_gpout(self):
-		self.dev.write(self._i2c_value | (self._gpio_value & 0xf8))
+		return self.dev.exchange(bytes([self._translate_table(self._sda_output)[self._i2c_value]]))[0]
 	def _write(self, value):
 		self._i2c_value = value
 		self._update_gpout()
 	def _sda_in(self):
-		self._i2c_direction = 0x1
-		self._update_direction()
+		self._set_sda_direction(False)
 	def _sda_out(self):
-		self._i2c_direction = 0x3
-		self._update_direction()
+		self._set_sda_direction(True)
+	def _set_sda_direction(self, output):
+		# with sda_in_pins, this only changes the translate table (SDA is high if it is released)
+		self._sda_output = output
+		if self.sda_in_pins is not None:
+			return
+		direction = SCL | self._sda_mask if output else SCL
+		if self._i2c_direction != direction:
+			self._i2c_direction = direction
+			self._update_direction()
 	def _read_sda(self):
-		return (self.dev.read(peek=True) & 0x2) != 0
+		# True if SDA is released on all of sda_pins
+		mask = pin_mask(self.sda_in_pins) if self.sda_in_pins is not None else self._sda_mask
+		return (self._update_gpout() & mask) == mask
+
+	def _translate_table(self, sda_output=True):
+		# for bytes.translate(): pins of BitbangProgram -> pins of the port (with the GPIOs), SDA is high
+		# while it is an input (i.e. released with sda_in_pins)
+		if self._pin_tables is None:
+			gpio = self._gpio_value & self._gpio_pins
+			self._pin_tables = (bytes((i & SCL) | self._sda_mask | gpio for i in range(256)),
+				bytes((i & SCL) | (self._sda_mask if i & SDA else 0) | gpio for i in range(256)))
+		return self._pin_tables[1 if sda_output else 0]
 
 	@property
 	def gpio_direction(self):
@@ -52,113 +212,79 @@ class I2CBitbanging(object):
 	@gpio_value.setter
 	def gpio_value(self, value):
 		self._gpio_value = value
+		self._pin_tables = None
 		self._update_gpout()
 
-	def transfer(self, address, read, readlen_or_data):
-		#NOTE for self._write: bit 0 is SCK, bit 1 is SDA
-		self._sda_out()
-		self._write(0x3)
-		self._write(0x1)  # start condition
-		if read:
-			addr = address*2 | 1
+	def run(self, program):
+		# Executes a BitbangProgram and returns the input bytes of its samples. The GPIOs keep their
+		# values, which are added with bytes.translate().
+		inputs = []
+		if self.sda_in_pins is not None:
+			# no change of direction -> everything in one exchange()
+			data = bytearray()
+			offsets = []
+			for sda_output, segment in program.segments:
+				offsets.append(len(data))
+				data += segment.translate(self._translate_table(sda_output))
+			result = self.dev.exchange(data)
+			inputs = [result[offset:] for offset in offsets]
+			self._sda_output = program.segments[-1][0]
 		else:
-			addr = address*2 | 0
-		prev = 0x0
-		for i in range(8):
-			self._write(prev)
-			if (addr & (1<<(7-i))) != 0:
-				self._write(0x2)
-				self._write(0x3)
-				prev = 0x2
-			else:
-				self._write(0x0)
-				self._write(0x1)
-				prev = 0x0
-		if prev != 0:
-			self._sda_in()
-			self._write(0x0)
-		else:
-			self._write(0x0)
-			self._sda_in()
-		nack = self._read_sda()
-		if not nack:
-			if not read and len(readlen_or_data) == 0:
-				self._write(0x1)
-				self._write(0x0)
-				self._sda_out()
-				self._write(0x1)
-				self._write(0x3)
-				return True
+			table = self._translate_table()
+			for sda_output, data in program.segments:
+				self._set_sda_direction(sda_output)
+				inputs.append(self.dev.exchange(data.translate(table)))
+		self._i2c_value = program.segments[-1][1][-1]
+		return [inputs[segment][index] for segment, index in program.samples]
+
+	def transfer(self, address, read, readlen_or_data):
+		# Returns the data for reads, True for writes and False if the slave didn't acknowledge. We can't
+		# stop in the middle of a program so the rest of it is sent even if the address is not acknowledged.
+		# No slave listens to this so it does no harm (and it is rare anyway).
+		return self.transfer_all(address, read, readlen_or_data)[0]
+
+	def transfer_all(self, address, read, readlen_or_data):
+		# transfer() for each of sda_pins: all of them get the same clocks and data, only the bits that
+		# are read (and ACKs) are different
+		key = (address, read, readlen_or_data if read else tuple(readlen_or_data))
+		compiled = self._programs.get(key)
+		if compiled is None:
+			if len(self._programs) >= 256:
+				self._programs.clear()
+			compiled = self._programs[key] = self._compile(address, read, readlen_or_data)
+		program, address_ack, bits, acks = compiled
+		samples = self.run(program)
+
+		results = []
+		for pin in self.sda_in_pins or self.sda_pins:
+			if samples[address_ack] & pin:
+				results.append(False)
 			elif read:
 				read_data = []
-				self._sda_in()
-				self._write(0x1)
-				for i in range(readlen_or_data):
+				for byte_bits in bits:
 					d = 0
-					for j in range(8):
-						self._write(0x0)
-						self._sda_in()
-						self._write(0x1)
-						d *= 2
-						if self._read_sda():
-							d |= 1
-					print("byte %d: 0x%02x" % (i, d))
+					for bit in byte_bits:
+						d = d*2 | ((samples[bit] & pin) != 0)
 					read_data.append(d)
-					self._write(0x0)
-					if i == readlen_or_data-1:
-						#pass  # nack
-						# stop condition
-						self._write(0x0)
-						self._sda_out()
-						self._write(0x1)
-						self._write(0x3)
-					else:
-						# send ack
-						self._write(0x0)
-						self._sda_out()
-						self._write(0x1)
-				return read_data
+				results.append(read_data)
 			else:
-				self._write(0x1)
-				for byte in readlen_or_data:
-					prev = 0x0
-					self._sda_out()
-					for j in range(8):
-						self._write(prev)
-						if (byte & (1<<(7-j))) != 0:
-							self._write(0x2)
-							self._write(0x3)
-							prev = 0x2
-						else:
-							self._write(0x0)
-							self._write(0x1)
-							prev = 0x0
-					if prev != 0:
-						self._sda_in()
-						self._write(0x0)
-					else:
-						self._write(0x0)
-						self._sda_in()
-					nack = self._read_sda()
-					if not nack:
-						self._write(0x1)
-					else:
-						self._write(0x0)
-						self._sda_out()
-						self._write(0x1)
-						self._write(0x3)  # stop condition
-						return False
-				self._write(0x0)
-				self._sda_out()
-				self._write(0x1)
-				self._write(0x3)  # stop condition
-				return True
+				results.append(not any(samples[ack] & pin for ack in acks))
+		return results
+
+	@staticmethod
+	def _compile(address, read, readlen_or_data):
+		# programs only depend on the arguments of transfer() so they are cached
+		program = BitbangProgram()
+		program.start()
+		address_ack = program.write_byte(address*2 | (1 if read else 0))
+		bits = []
+		acks = []
+		if read:
+			bits = [program.read_byte(ack=i < readlen_or_data-1) for i in range(readlen_or_data)]
 		else:
-			self._write(0x0)
-			self._sda_out()
-			self._write(0x1)
-			self._write(0x3)  # stop condition
-			return False
+			acks = [program.write_byte(byte) for byte in readlen_or_data]
+		program.stop()
+		return program, address_ack, bits, acks
 
 	def fix_i2c(self, always_generate_stop=False):
 		while True:
@@ -188,20 +314,102 @@ class I2CBitbanging(object):
 				else:
 					raise
 
+class I2CParallelBitbanging(I2CBitbanging):
+	# Several I2C buses that share SCL, e.g. for sensors that have the same address: one SDA pin for
+	# each of them, all are clocked with the same exchange() calls so they take as long as one. transfer()
+	# returns a list with the result for each of sda_pins (and read() and write() as well). fix_i2c() clocks
+	# until all of them have released SDA.
+	__slots__ = ()
+
+	def transfer(self, address, read, readlen_or_data):
+		return self.transfer_all(address, read, readlen_or_data)
+
 	def read(self, address, length):
-		return self.transfer(address, True, length)
+		results = self.transfer(address, True, length)
+		if log.isEnabledFor(logging.DEBUG):
+			for pin, data in zip(self.sda_pins, results):
+				for i, d in enumerate(data or []):
+					log.debug("SDA 0x%02x, byte %d: 0x%02x", pin, i, d)
+		return results
+
+class I2CMpsse(I2CBus):
+	# Uses the I2C engine of pyftdi in MPSSE mode, which needs an FT232H, FT2232H or FT4232H. The wiring is
+	# the same as for bitbanging but ADBUS2 must also be connected to SDA (pyftdi reads SDA on that pin).
+	__slots__ = ("controller", "gpio", "_gpio_direction", "_gpio_value")
+
+	# pins that are used by I2C: SCL, SDA (out) and SDA (in)
+	I2C_PINS = 0x07
+	GPIO_PINS = 0xf8
+
+	def __init__(self, url, controller=None, frequency=400e3):
+		# controller can be replaced by anything that behaves like I2cController, e.g. for benchmarks
+		self.controller = controller if controller is not None else pyftdi.i2c.I2cController()
+		self.controller.configure(url, frequency=frequency)
+		self.gpio = self.controller.get_gpio()
+		self._gpio_direction = 0
+		self._gpio_value = 0
 
-	def write(self, address, data):
-		return self.transfer(address, False, data)
+	@property
+	def gpio_pins(self):
+		return self.GPIO_PINS
+	@property
+	def gpio_direction(self):
+		return self._gpio_direction
+	@property
+	def gpio_value(self):
+		return self._gpio_value
+	@gpio_direction.setter
+	def gpio_direction(self, value):
+		self._gpio_direction = value
+		self.gpio.set_direction(self.GPIO_PINS, value & self.GPIO_PINS)
+	@gpio_value.setter
+	def gpio_value(self, value):
+		self._gpio_value = value
+		self.gpio.write(value & self._gpio_direction & self.GPIO_PINS)
 
-	def scan(self):
-		for i in range(128):
-			while True:
-				try:
-					print((i, i2c.transfer_autorepeat(i, False, [])))  #FIXME
-					break
-				except pyftdi.ftdi.FtdiError:
-					print("error")
+	def transfer(self, address, read, readlen_or_data):
+		try:
+			if read:
+				return list(self.controller.read(address, readlen_or_data))
+			self.controller.write(address, readlen_or_data)
+			return True
+		except pyftdi.i2c.I2cNackError:
+			return False
+
+	def fix_i2c(self, always_generate_stop=False):
+		# The I2C engine can't do this so we send nine clocks with SDA released and a stop condition with
+		# MPSSE commands ("set data bits low byte": 0x80, value, direction). SCL is bit 0, SDA (out) is bit 1.
+		gpio = self._gpio_value & self._gpio_direction & self.GPIO_PINS
+		gpio_direction = self._gpio_direction & self.GPIO_PINS
+		cmd = bytearray()
+		for _ in range(9):
+			cmd.extend((0x80, gpio, SCL | gpio_direction, 0x80, SCL | gpio, SCL | gpio_direction))
+		cmd.extend((0x80, gpio, SCL | SDA | gpio_direction, 0x80, SCL | gpio, SCL | SDA | gpio_direction,
+			0x80, SCL | SDA | gpio, SCL | SDA | gpio_direction))
+		self.controller.ftdi.write_data(cmd)
+		return True
+
+# name -> class, use open_bus() to get one of them
+BACKENDS = {
+	"bitbang": I2CBitbanging,
+	"mpsse": I2CMpsse,
+}
+
+def open_bus(url, backend=None, sda_pins=None, sda_in_pins=None):
+	# The backend can also be a prefix of the URL, e.g. "mpsse+ftdi://ftdi:2232h/1". Default is bitbang.
+	# More than one SDA pin is an I2CParallelBitbanging.
+	prefix, sep, rest = url.partition("+")
+	if sep and prefix in BACKENDS:
+		backend = prefix
+		url = rest
+	if sda_pins is None and sda_in_pins is None:
+		return BACKENDS[backend or "bitbang"](url)
+	if (backend or "bitbang") != "bitbang":
+		raise Exception("SDA pins can only be chosen for the bitbang backend")
+	sda_pins = sda_pins or (SDA,)
+	if len(sda_pins) > 1:
+		return I2CParallelBitbanging(url, sda_pins=sda_pins, sda_in_pins=sda_in_pins)
+	return I2CBitbanging(url, sda_pins=sda_pins, sda_in_pins=sda_in_pins)
 
 class I2CAutoRetry(object):
 	__slots__ = ("i2c", "retry",)
@@ -226,14 +434,34 @@ class I2CAutoRetry(object):
 			self.retry = False
 			return False
 
+# ENABLE, ATIME, WTIME, thresholds, PERS, CONFIG and CONTROL (and some reserved ones): they only change
+# when we write them so TCS3472 keeps a copy and doesn't write them again if they already have the value
+CONFIG_REGS = range(0x00, 0x10)
+# bits of the STATUS register: AINT is set at the end of each RGBC cycle if PERS is 0 (and cleared by
+# clear_interrupt()), AVALID stays set after the first cycle
+AVALID = 0x01
+AINT = 0x10
+CYCLE_TIME = 0.0024  # seconds per step of ATIME and WTIME
+
+def check_led_pins(i2c, led_pins):
+	# LED pins must be different GPIO pins of the bus, i.e. not SCL or any of the SDA pins
+	mask = pin_mask(led_pins)
+	if mask & ~i2c.gpio_pins:
+		raise Exception("LED pins %s are used by I2C" % ", ".join("0x%02x" % p for p in led_pins if p & ~i2c.gpio_pins))
+	return mask
+
 class TCS3472(object):
-	__slots__ = ("i2c", "address", "_regs")
-	
-	def __init__(self, i2c, address):
+	# led_pin is 0 if the sensor has no LED
+	__slots__ = ("i2c", "address", "led_pin", "_regs")
+
+	def __init__(self, i2c, address, led_pin=0x08):
 		self.i2c = i2c
 		self.address = address
-		self.i2c.gpio_direction |= 0x08
-		
+		self.led_pin = check_led_pins(i2c, (led_pin,) if led_pin else ())
+		# registers 0x00 to 0x1b, None if we don't know the value (only CONFIG_REGS are kept up to date)
+		self._regs = [None] * 0x1c
+		self.i2c.gpio_direction |= self.led_pin
+
 		id_reg = self.read_regs(0x12)
 		if not id_reg:
 			self.i2c.fix_i2c(True)
@@ -241,39 +469,270 @@ class TCS3472(object):
 			if not id_reg:
 				raise Exception("not found (I2C NACK)")
 		elif id_reg[0] != 0x44:
-			raise Exception("Reg 0x12 should be 0x44 but it is 0x%02x" % regs[0x12])
+			raise Exception("Reg 0x12 should be 0x44 but it is 0x%02x" % id_reg[0])
 
-		self._regs = self.read_regs(0x00, 0x1c)
-		if not self._regs:
+		regs = self.read_regs(0x00, 0x1c)
+		if not regs:
 			raise Exception("not found (I2C NACK)")
-		elif self._regs[0x12] != 0x44:
+		elif regs[0x12] != 0x44:
 			raise Exception("Reg 0x12 should be 0x44 but it is 0x%02x (as part of larger read)" % regs[0x12])
+		self._regs = list(regs)
 
 	@property
 	def led(self):
-		return (self.i2c.gpio_value & 0x08) != 0
+		return (self.i2c.gpio_value & self.led_pin) != 0
 	@led.setter
 	def led(self, value):
 		if value:
-			self.i2c.gpio_value |= 0x08
+			self.i2c.gpio_value |= self.led_pin
 		else:
-			self.i2c.gpio_value &= ~0x08
+			self.i2c.gpio_value &= ~self.led_pin
+
+	def reg(self, regaddr):
+		# cached value of a config register (see CONFIG_REGS), None if unknown
+		return self._regs[regaddr]
 
 	def read_regs(self, regaddr, length=1):
 		retry = I2CAutoRetry(self.i2c)
 		while retry:
 			with retry:
 				if self.i2c.write(self.address, [0xa0 | (regaddr & 0x1f)]):
-					return self.i2c.read(self.address, length)
-	def write_regs(self, regaddr, data):
+					data = self.i2c.read(self.address, length)
+					if data:
+						for i, value in enumerate(data):
+							if regaddr + i in CONFIG_REGS:
+								self._regs[regaddr + i] = value
+					return data
+
+	def write_regs(self, regaddr, data, force=False):
+		# Only the part from the first to the last register that doesn't have the value, yet, is written
+		# (nothing if they all have it) unless `force` is True. Returns False for a NACK.
+		first = 0
+		last = len(data)
+		if not force:
+			changed = [i for i, value in enumerate(data) if regaddr + i not in CONFIG_REGS or self._regs[regaddr + i] != value]
+			if not changed:
+				return True
+			first = changed[0]
+			last = changed[-1] + 1
+		ok = False
+		try:
+			retry = I2CAutoRetry(self.i2c)
+			while retry:
+				with retry:
+					ok = self.i2c.write(self.address, [0xa0 | ((regaddr + first) & 0x1f)] + data[first:last])
+			return ok
+		finally:
+			for i in range(first, last):
+				if regaddr + i in CONFIG_REGS:
+					self._regs[regaddr + i] = data[i] if ok else None
+
+	def read_color(self):
+		# STATUS and CDATA..BDATAH in one auto-increment read. Returns (STATUS, (clear, red, green, blue))
+		# or None for a NACK.
+		# The datasheet says to use two byte reads with "read word protocol bit set" but there is no such bit
+		# in the command register -> auto-increment read should be good enough to trigger the shadow register
+		# behavior, I guess
+		data = self.read_regs(0x13, 9)
+		if not data:
+			return None
+		return data[0], tuple(data[i] | (data[i+1] << 8) for i in range(1, 9, 2))
+
+	def clear_interrupt(self):
+		# special function: clear RGBC interrupt (like the firmware)
+		retry = I2CAutoRetry(self.i2c)
+		while retry:
+			with retry:
+				return self.i2c.write(self.address, [0xe6])
+
+	def cycle_time(self):
+		return cycle_time(self._regs)
+
+	def read_new(self):
+		# (clear, red, green, blue) if there is a new sample since the last call (AINT), None otherwise
+		result = self.read_color()
+		if result is None or not (result[0] & AINT):
+			return None
+		self.clear_interrupt()
+		return result[1]
+
+def cycle_time(regs):
+	# seconds from one sample to the next according to ENABLE, ATIME, WTIME and CONFIG (see "RGBC
+	# operation" in the datasheet): wait time (if WEN is set, 12 times longer with WLONG) + integration time
+	enable, atime, wtime, config = (regs[i] or 0 for i in (0x00, 0x01, 0x03, 0x0d))
+	t = (256 - atime) * CYCLE_TIME
+	if enable & 0x08:
+		t += (256 - wtime) * CYCLE_TIME * (12 if config & 0x02 else 1)
+	return t
+
+class TCS3472Array(TCS3472):
+	# The same as TCS3472 for several sensors on an I2CParallelBitbanging bus: read_regs(), write_regs(),
+	# read_color() and clear_interrupt() return lists with one entry per sensor (None or False for the ones
+	# that didn't acknowledge) and each sensor can have an LED pin. All sensors get the same register
+	# writes so their samples are ready at the same time (apart from the tolerance of their oscillators).
+	__slots__ = ("led_pins",)  # led_pin is the mask of all of them
+
+	def __init__(self, i2c, address, led_pins=()):
+		self.i2c = i2c
+		self.address = address
+		self.led_pins = tuple(led_pins)
+		self.led_pin = check_led_pins(i2c, self.led_pins)
+		self._regs = [[None] * 0x1c for _ in i2c.sda_pins]
+		self.i2c.gpio_direction |= self.led_pin
+
+		regs = self.read_regs(0x00, 0x1c)
+		if not all(regs):
+			self.i2c.fix_i2c(True)
+			regs = self.read_regs(0x00, 0x1c)
+		for i, data in enumerate(regs):
+			if not data:
+				raise Exception("sensor %d (SDA 0x%02x) not found (I2C NACK)" % (i, self.i2c.sda_pins[i]))
+			elif data[0x12] != 0x44:
+				raise Exception("sensor %d: Reg 0x12 should be 0x44 but it is 0x%02x" % (i, data[0x12]))
+			self._regs[i] = list(data)
+
+	@property
+	def led(self):
+		return any(self.i2c.gpio_value & pin for pin in self.led_pins)
+	@led.setter
+	def led(self, value):
+		self.i2c.gpio_value = (self.i2c.gpio_value | self.led_pin) if value else (self.i2c.gpio_value & ~self.led_pin)
+
+	def reg(self, regaddr):
+		# None unless all sensors have the same value
+		values = set(regs[regaddr] for regs in self._regs)
+		return values.pop() if len(values) == 1 else None
+
+	def read_regs(self, regaddr, length=1):
 		retry = I2CAutoRetry(self.i2c)
 		while retry:
 			with retry:
-				return self.i2c.write(self.address, [0xa0 | (regaddr & 0x1f)] + data)
-		
-def run():
-	i2c = I2CBitbanging(url)
-	tcs = TCS3472(i2c, 0x29)
+				acks = self.i2c.write(self.address, [0xa0 | (regaddr & 0x1f)])
+				results = self.i2c.read(self.address, length)
+				for i, data in enumerate(results):
+					if not acks[i] or not data:
+						results[i] = None
+						continue
+					for j, value in enumerate(data):
+						if regaddr + j in CONFIG_REGS:
+							self._regs[i][regaddr + j] = value
+				return results
+
+	def write_regs(self, regaddr, data, force=False):
+		# see TCS3472.write_regs(), the changed part is the same for all sensors
+		first = 0
+		last = len(data)
+		if not force:
+			changed = [i for i, value in enumerate(data)
+				if regaddr + i not in CONFIG_REGS or any(regs[regaddr + i] != value for regs in self._regs)]
+			if not changed:
+				return [True] * len(self._regs)
+			first = changed[0]
+			last = changed[-1] + 1
+		oks = [False] * len(self._regs)
+		try:
+			retry = I2CAutoRetry(self.i2c)
+			while retry:
+				with retry:
+					oks = self.i2c.write(self.address, [0xa0 | ((regaddr + first) & 0x1f)] + data[first:last])
+			return oks
+		finally:
+			for regs, ok in zip(self._regs, oks):
+				for i in range(first, last):
+					if regaddr + i in CONFIG_REGS:
+						regs[regaddr + i] = data[i] if ok else None
+
+	def read_color(self):
+		return [None if not data else (data[0], tuple(data[i] | (data[i+1] << 8) for i in range(1, 9, 2)))
+			for data in self.read_regs(0x13, 9)]
+
+	def cycle_time(self):
+		return max(cycle_time(regs) for regs in self._regs)
+
+	def read_new(self):
+		# a list with (clear, red, green, blue) or None for each sensor when all sensors that answer have a
+		# new sample, None otherwise
+		results = self.read_color()
+		answered = [result for result in results if result is not None]
+		if not answered or not all(result[0] & AINT for result in answered):
+			return None
+		self.clear_interrupt()
+		return [result and result[1] for result in results]
+
+class PollScheduler(object):
+	# Decides when to read the sensor instead of reading it all the time: the next sample is expected one
+	# cycle (TCS3472.cycle_time()) after the previous one so we sleep until `margin` (relative to the
+	# cycle) before that and then poll with exponential backoff from `min_backoff` to `max_backoff`.
+	# TCS3472.read_new() decides if there is a new sample (AINT). report() compares the samples/s with the
+	# maximum for the settings.
+	__slots__ = ("tcs", "margin", "min_backoff", "max_backoff", "next_time", "samples", "polls",
+		"_backoff", "_report_time", "_report_samples", "_report_polls")
+
+	def __init__(self, tcs, margin=0.05, min_backoff=0.0005, max_backoff=0.02):
+		self.tcs = tcs
+		self.margin = margin
+		self.min_backoff = min_backoff
+		self.max_backoff = max_backoff
+		self.next_time = time.monotonic()
+		self.samples = 0
+		self.polls = 0
+		self._backoff = min_backoff
+		self._report_time = self.next_time
+		self._report_samples = 0
+		self._report_polls = 0
+
+	def wait(self, max_wait=None):
+		# Sleeps until the next poll, at most max_wait seconds (e.g. to react to the GUI). Returns True if
+		# it is time to poll.
+		delay = self.next_time - time.monotonic()
+		if max_wait is not None and delay > max_wait:
+			sleep(max_wait)
+			return False
+		if delay > 0:
+			sleep(delay)
+		return True
+
+	def poll(self):
+		# Returns the result of read_new(), i.e. None if there is no new sample (or a NACK).
+		self.polls += 1
+		result = self.tcs.read_new()
+		now = time.monotonic()
+		if result is None:
+			self.next_time = now + self._backoff
+			self._backoff = min(2 * self._backoff, self.max_backoff)
+			return None
+		self.samples += 1
+		cycle = self.tcs.cycle_time()
+		self.next_time = now + cycle * (1 - self.margin)
+		self._backoff = self.min_backoff
+		return result
+
+	def report(self):
+		# samples/s and polls per sample since the last call
+		now = time.monotonic()
+		dt = max(now - self._report_time, 1e-9)
+		samples = self.samples - self._report_samples
+		polls = self.polls - self._report_polls
+		self._report_time = now
+		self._report_samples = self.samples
+		self._report_polls = self.polls
+		cycle = self.tcs.cycle_time()
+		return "%.2f samples/s (max %.2f for %.1f ms per cycle), %.1f polls per sample" % (
+			samples / dt, 1 / cycle, cycle * 1e3, polls / samples if samples else float(polls))
+
+def open_sensor(url, backend=None, sda_pins=None, led_pins=None, sda_in_pins=None):
+	# TCS3472 or TCS3472Array if there is more than one SDA pin, led_pins default to 0x08 (an empty list is no LED)
+	if led_pins is None:
+		led_pins = (0x08,)
+	elif len(led_pins) > len(sda_pins or (SDA,)):
+		raise Exception("more LED pins than sensors")
+	i2c = open_bus(url, backend, sda_pins, sda_in_pins)
+	if isinstance(i2c, I2CParallelBitbanging):
+		return TCS3472Array(i2c, 0x29, led_pins)
+	return TCS3472(i2c, 0x29, led_pins[0] if led_pins else 0)
+
+def run(url, backend=None, report_interval=10.0, sda_pins=None, led_pins=None, sda_in_pins=None):
+	tcs = open_sensor(url, backend, sda_pins, led_pins, sda_in_pins)
 
 	tcs.led = True
 	sleep(0.5)
@@ -287,18 +746,27 @@ def run():
 	tcs.write_regs(0x0f, [0x01])  # gain
 	sleep(0.0024)
 	tcs.write_regs(0x00, [0x0b])
+	scheduler = PollScheduler(tcs)
+	report_time = time.monotonic() + report_interval
 	while True:
-		valid = tcs.read_regs(0x13)
-		if (valid[0] & 1) != 0:
-			# datasheet says to use two byte reads with "read word protocol bit set" but there is no such bit in the command register
-			# -> auto-increment read should be good enough to trigger the shadow register behavior, I guess
-			data = tcs.read_regs(0x14, 8)
-			print("clear: %04x" % (data[0] | (data[1] << 8)))
-			print("red:   %04x" % (data[2] | (data[3] << 8)))
-			print("green: %04x" % (data[4] | (data[5] << 8)))
-			print("blue:  %04x" % (data[6] | (data[7] << 8)))
-
-def run_gui():
+		scheduler.wait()
+		color = scheduler.poll()
+		if isinstance(color, list):
+			for i, c in enumerate(color):
+				if c is not None:
+					print("sensor %d: clear %04x, red %04x, green %04x, blue %04x" % ((i,) + c))
+		elif color is not None:
+			clear, red, green, blue = color
+			print("clear: %04x" % clear)
+			print("red:   %04x" % red)
+			print("green: %04x" % green)
+			print("blue:  %04x" % blue)
+		if time.monotonic() >= report_time:
+			report_time += report_interval
+			print(scheduler.report())
+
+def run_gui(url, backend=None, report_interval=10.0, sda_pins=None, led_pins=None, sda_in_pins=None):
+	# with several sensors (sda_pins), the first one is shown
 	import tkinter
 	from tkinter import N, E, W, S, IntVar, Label
 	import threading
@@ -370,43 +838,40 @@ def run_gui():
 
 	mainloop_done = False
 	def query_sensor():
-		prev_integration_time = integration_time.get()
-		prev_gain = gain.get()
-
-		i2c = I2CBitbanging(url)
-		tcs = TCS3472(i2c, 0x29)
+		tcs = open_sensor(url, backend, sda_pins, led_pins, sda_in_pins)
 
 		tcs.write_regs(0x00, [0x01, 0xff - integration_time.get(), 0x80, 0x12, 0x34, 0x56, 0x78])
 		tcs.write_regs(0x0d, [0x00])
 		tcs.write_regs(0x0f, [gain.get()])  # gain
 		sleep(0.0024)
 		tcs.write_regs(0x00, [0x0b])
+		scheduler = PollScheduler(tcs)
+		report_time = time.monotonic() + report_interval
 
 		while not mainloop_done:
 			if tcs.led  != (led.get() != 0):
 				print("update LED")
 				tcs.led = (led.get() != 0)
-			if prev_integration_time != integration_time.get():
-				print("update integration_time")
-				tcs.write_regs(0x01, [0xff - integration_time.get()])
-				prev_integration_time = integration_time.get()
-			if prev_gain != gain.get():
-				print("update gain")
-				tcs.write_regs(0x0f, [gain.get()])
-				prev_gain = gain.get()
-
-			valid = tcs.read_regs(0x13)
-			if (valid[0] & 1) != 0:
-				# datasheet says to use two byte reads with "read word protocol bit set" but there is no such bit in the command register
-				# -> auto-increment read should be good enough to trigger the shadow register behavior, I guess
-				data = tcs.read_regs(0x14, 8)
-				print("clear: %04x" % (data[0] | (data[1] << 8)))
-				print("red:   %04x" % (data[2] | (data[3] << 8)))
-				print("green: %04x" % (data[4] | (data[5] << 8)))
-				print("blue:  %04x" % (data[6] | (data[7] << 8)))
-				if not mainloop_done:
-					root.after_idle(on_sensor_data,  (data[0] | (data[1] << 8)), (data[2] | (data[3] << 8)),
-						(data[4] | (data[5] << 8)), (data[6] | (data[7] << 8)))
+			# these are only written if they have changed
+			tcs.write_regs(0x01, [0xff - integration_time.get()])
+			tcs.write_regs(0x0f, [gain.get()])
+
+			# wake up now and then for changes in the GUI
+			if not scheduler.wait(max_wait=0.1):
+				continue
+			color = scheduler.poll()
+			if isinstance(color, list):
+				for i, c in enumerate(color):
+					if c is not None:
+						log.info("sensor %d: clear: %04x, red: %04x, green: %04x, blue: %04x", i, *c)
+				color = color[0]
+			elif color is not None:
+				log.info("clear: %04x, red: %04x, green: %04x, blue: %04x", *color)
+			if color is not None and not mainloop_done:
+				root.after_idle(on_sensor_data, *color)
+			if time.monotonic() >= report_time:
+				report_time += report_interval
+				print(scheduler.report())
 	t = threading.Thread(target=query_sensor)
 	t.start()
 
@@ -415,6 +880,19 @@ def run_gui():
 	t.join()
 
 if __name__ == "__main__":
-	#run()
-	run_gui()
+	parser = argparse.ArgumentParser(description="Read one TCS3472 that is connected to an FTDI adapter")
+	parser.add_argument("url", nargs="?", default=url, help="pyftdi URL, can start with a backend, e.g. mpsse+ftdi://ftdi:2232h/1 (default: %(default)s)")
+	parser.add_argument("--backend", choices=BACKENDS, help="bitbang works with any FTDI adapter, mpsse needs FT232H/FT2232H/FT4232H (default: bitbang)")
+	parser.add_argument("--console", action="store_true", help="print the values instead of showing the GUI")
+	parser.add_argument("--sda-pins", nargs="+", type=lambda x: int(x, 0), help="bitbang with one SDA pin per sensor, e.g. 0x02 0x04 0x10 for three sensors that share SCL (0x01) (default: 0x02)")
+	parser.add_argument("--sda-in-pins", nargs="+", type=lambda x: int(x, 0), help="bitbang: read SDA on these pins (one for each SDA pin, e.g. 0x04), needs a diode from SDA to the SDA pin, see the top of this file")
+	parser.add_argument("--led-pins", nargs="*", type=lambda x: int(x, 0), help="LED pins, at most one for each of --sda-pins (default: 0x08)")
+	parser.add_argument("--log-level", choices=("debug", "info", "warning"), default="warning", help="debug shows every byte, info every sample")
+	parser.add_argument("--report-interval", type=float, default=10.0, help="seconds between reports of samples/s")
+	args = parser.parse_args()
+	logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+	if args.console:
+		run(args.url, args.backend, args.report_interval, args.sda_pins, args.led_pins, args.sda_in_pins)
+	else:
+		run_gui(args.url, args.backend, args.report_interval, args.sda_pins, args.led_pins, args.sda_in_pins)
 
@@ -0,0 +1,390 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 -p "python3.withPackages (p: with p; [pyftdi])"
+
+# Simulates the FTDI adapter of tcs3472_ftdi.py with TCS3472 sensors on its pins so the bitbanging, the
+# retries and the TCS3472 class can be tested and profiled without hardware, e.g.:
+#   python3 tcs3472_ftdi_sim.py            # checks, fails if something doesn't work
+#   python3 tcs3472_ftdi_sim.py --sensors 3
+# In Python:
+#   dev = VirtualGpio({tcs3472_ftdi.SDA: SimulatedTCS3472()})
+#   tcs = tcs3472_ftdi.TCS3472(tcs3472_ftdi.I2CBitbanging("virtual://", dev), 0x29)
+# VirtualGpio counts USB transactions like MockGpio in tcs3472_bench.py (per operation with operation()).
+
+import sys
+import argparse
+import contextlib
+import collections
+import pyftdi.ftdi
+import tcs3472_ftdi
+from tcs3472_ftdi import SCL, SDA, AVALID, AINT, cycle_time
+
+GAIN_FACTORS = (1, 4, 16, 60)
+TIMEOUT_MESSAGE = "UsbError: [Errno 110] Operation timed out"  # what pyftdi raises, see I2CAutoRetry
+
+class VirtualClock(object):
+  # Time of the simulation in seconds: VirtualGpio advances it for each USB transaction and byte so
+  # integration times are the same as with the real adapter but the tests don't have to wait.
+  __slots__ = ("now",)
+
+  def __init__(self, now=0.0):
+    self.now = now
+
+  def __call__(self):
+    return self.now
+
+  def advance(self, dt):
+    self.now += dt
+
+class SimulatedTCS3472(object):
+  # I2C slave with the registers of a TCS3472 at address 0x29. It sees SCL and its SDA pin after each byte
+  # of VirtualGpio.exchange(), i.e. it is clocked like the real one. `light` is (clear, red, green, blue)
+  # counts per integration cycle at gain 1x, plus `led_counts` if its LED pin is high.
+  # Faults: inject_nack() doesn't acknowledge the next addresses, inject_stuck_sda() holds SDA low for some
+  # clocks like a slave that has been interrupted in the middle of a read.
+  __slots__ = ("address", "regs", "light", "led_counts", "led_pin", "led", "clock", "nacks", "stuck_clocks",
+    "log", "_state", "_bits", "_count", "_reading", "_pointer", "_auto_increment", "_first", "_byte", "_master_ack",
+    "_drive", "_scl", "_sda", "_start_time", "_cycles")
+
+  def __init__(self, light=(40.0, 16.0, 14.0, 12.0), led_counts=(20.0, 7.0, 7.0, 6.0), led_pin=0x08, address=0x29):
+    self.address = address
+    # reset values from the datasheet
+    self.regs = [0] * 0x20
+    self.regs[0x01] = 0xff
+    self.regs[0x03] = 0xff
+    self.regs[0x12] = 0x44
+    self.light = light
+    self.led_counts = led_counts
+    self.led_pin = led_pin
+    self.led = False
+    self.clock = VirtualClock()  # replaced by the one of VirtualGpio
+    self.nacks = 0
+    self.stuck_clocks = 0
+    # the last events: ("start",), ("stop",), ("write", byte), ("read", byte), ("nack", address byte)
+    self.log = collections.deque(maxlen=1000)
+    self._pointer = 0
+    self._auto_increment = True
+    self._start_time = None  # running since
+    self._cycles = 0
+    self._drive = 1
+    self._scl = 1
+    self._sda = 1
+    self._reset_state("idle")
+
+  def inject_nack(self, count=1):
+    self.nacks += count
+
+  def inject_stuck_sda(self, clocks=5):
+    self.stuck_clocks = clocks
+
+  def sda(self):
+    # what the slave does to SDA: 0 is pulling it low
+    return 0 if self.stuck_clocks else self._drive
+
+  def _reset_state(self, state):
+    self._state = state
+    self._bits = 0
+    self._count = 0
+    self._reading = False
+    self._first = True
+    self._drive = 1
+
+  def _update(self):
+    # RGBC cycles that have finished since the last call: new data, AVALID and AINT (PERS is ignored)
+    if self._start_time is None:
+      return
+    cycles = int((self.clock() - self._start_time) / cycle_time(self.regs))
+    if cycles > self._cycles:
+      self._cycles = cycles
+      itime = 256 - self.regs[0x01]
+      gain = GAIN_FACTORS[self.regs[0x0f] & 0x03]
+      for i in range(4):
+        light = self.light[i] + (self.led_counts[i] if self.led else 0)
+        value = min(int(light * gain * itime), 1024 * itime, 0xffff)
+        self.regs[0x14 + 2*i] = value & 0xff
+        self.regs[0x15 + 2*i] = value >> 8
+      self.regs[0x13] |= AVALID | AINT
+
+  def _write_byte(self, byte):
+    if self._first:
+      # command register: type 0 is repeated byte, 1 auto-increment and 3 special function
+      self._first = False
+      command_type = (byte >> 5) & 0x03
+      if command_type == 3:
+        if byte & 0x1f == 0x06:
+          self.regs[0x13] &= ~AINT
+      else:
+        self._pointer = byte & 0x1f
+        self._auto_increment = command_type == 1
+      return
+    if self._pointer in (0x00, 0x01, 0x03, 0x04, 0x05, 0x06, 0x07, 0x0c, 0x0d, 0x0f):
+      self._update()
+      if self._pointer == 0x00:
+        running = byte & 0x03 == 0x03
+        if running and self._start_time is None:
+          self._start_time = self.clock()
+          self._cycles = 0
+        elif not running:
+          self._start_time = None
+          self.regs[0x13] &= ~(AVALID | AINT)
+      self.regs[self._pointer] = byte
+    if self._auto_increment:
+      self._pointer = (self._pointer + 1) & 0x1f
+
+  def _read_byte(self):
+    self._update()
+    byte = self.regs[self._pointer]
+    if self._auto_increment:
+      self._pointer = (self._pointer + 1) & 0x1f
+    self.log.append(("read", byte))
+    return byte
+
+  def _start_read_byte(self):
+    self._state = "read"
+    self._count = 0
+    self._byte = self._read_byte()
+    self._drive = self._byte >> 7
+
+  def step(self, scl, sda):
+    # one state of the bus: SCL and SDA are 0 or 1, SDA is the bus (i.e. already low if we pull it low)
+    if self._scl and scl and self._sda and not sda:
+      self.log.append(("start",))
+      self._reset_state("address")
+    elif self._scl and scl and not self._sda and sda:
+      self.log.append(("stop",))
+      self._reset_state("idle")
+    elif not self._scl and scl:
+      # rising edge: the master or we have put the bit on SDA
+      if self.stuck_clocks:
+        self.stuck_clocks -= 1
+        if not self.stuck_clocks:
+          self._reset_state("idle")
+      elif self._state in ("address", "write"):
+        self._bits = self._bits*2 | sda
+        self._count += 1
+      elif self._state == "read":
+        self._count += 1
+      elif self._state == "master_ack":
+        self._master_ack = not sda
+    elif self._scl and not scl and not self.stuck_clocks:
+      # falling edge: next bit
+      if self._state in ("address", "write") and self._count == 8:
+        if self._state == "address":
+          ok = (self._bits >> 1) == self.address
+          if ok and self.nacks:
+            self.nacks -= 1
+            self.log.append(("nack", self._bits))
+            ok = False
+          self._reading = bool(self._bits & 1)
+        else:
+          ok = True
+          self.log.append(("write", self._bits))
+          self._write_byte(self._bits)
+        if ok:
+          self._state = "ack"
+          self._drive = 0
+        else:
+          self._state = "ignore"
+      elif self._state == "ack":
+        if self._reading:
+          self._start_read_byte()
+        else:
+          self._state = "write"
+          self._bits = 0
+          self._count = 0
+          self._drive = 1
+      elif self._state == "read":
+        if self._count == 8:
+          self._state = "master_ack"
+          self._drive = 1
+        else:
+          self._drive = (self._byte >> (7 - self._count)) & 1
+      elif self._state == "master_ack":
+        if self._master_ack:
+          self._start_read_byte()
+        else:
+          self._state = "ignore"
+    self._scl = scl
+    self._sda = sda
+
+class VirtualGpio(object):
+  # Stands in for pyftdi.gpio.GpioSyncController: each byte of exchange() sets the outputs and the
+  # returned byte is the state of the pins before that (like the real one). `sensors` maps SDA pins to
+  # SimulatedTCS3472s, SDA pins without a sensor are pulled up. `sda_in_pins` maps SDA pins to input pins
+  # that are connected to the same line (with a diode, see tcs3472_ftdi.py). A transaction is one USB transfer:
+  # exchange() is a write and a read, set_direction() is a control transfer. inject_timeout() makes the
+  # next calls fail with the FtdiError that pyftdi raises for a USB timeout.
+  __slots__ = ("sensors", "sda_in_pins", "clock", "usb_latency", "frequency", "direction", "output", "transactions",
+    "operations", "timeouts")
+
+  def __init__(self, sensors=None, clock=None, usb_latency=0.001, sda_in_pins=None):
+    self.sensors = sensors if sensors is not None else {SDA: SimulatedTCS3472()}
+    self.sda_in_pins = sda_in_pins or {}
+    self.clock = clock if clock is not None else VirtualClock()
+    for sensor in self.sensors.values():
+      sensor.clock = self.clock
+    self.usb_latency = usb_latency
+    self.frequency = tcs3472_ftdi.BITBANG_FREQUENCY
+    self.direction = 0
+    self.output = 0xff
+    self.transactions = 0
+    self.operations = {}  # name -> [calls, transactions]
+    self.timeouts = 0
+
+  def inject_timeout(self, count=1):
+    self.timeouts += count
+
+  @contextlib.contextmanager
+  def operation(self, name):
+    # counts calls and transactions, e.g. `with dev.operation("read_color"): tcs.read_color()`
+    before = self.transactions
+    try:
+      yield
+    finally:
+      counts = self.operations.setdefault(name, [0, 0])
+      counts[0] += 1
+      counts[1] += self.transactions - before
+
+  def _transaction(self):
+    self.transactions += 1
+    if isinstance(self.clock, VirtualClock):
+      self.clock.advance(self.usb_latency)
+    if self.timeouts:
+      self.timeouts -= 1
+      raise pyftdi.ftdi.FtdiError(TIMEOUT_MESSAGE)
+
+  def configure(self, url, direction=0, frequency=None, **kwargs):
+    self.direction = direction
+    if frequency is not None:
+      self.frequency = frequency
+
+  def set_direction(self, pins, direction):
+    self._transaction()
+    self.direction = (self.direction & ~pins) | (direction & pins)
+
+  def _pins(self):
+    # outputs have their value, inputs are pulled up unless a sensor pulls SDA low
+    pins = (self.output & self.direction) | (0xff & ~self.direction)
+    for pin, sensor in self.sensors.items():
+      if not sensor.sda():
+        pins &= ~pin
+      in_pin = self.sda_in_pins.get(pin, 0)
+      if in_pin & ~self.direction:
+        # SDA is low if the slave or (through the diode) the output pin pulls it low
+        pins = (pins & ~in_pin) | (in_pin if pins & pin else 0)
+    return pins
+
+  def exchange(self, out):
+    self._transaction()
+    self._transaction()
+    result = bytearray()
+    for value in out:
+      result.append(self._pins())
+      self.output = value
+      pins = self._pins()
+      for pin, sensor in self.sensors.items():
+        sensor.led = bool(pins & sensor.led_pin)
+        sensor.step(pins & SCL, 1 if pins & pin else 0)
+    if isinstance(self.clock, VirtualClock):
+      self.clock.advance(len(out) / self.frequency)
+    return bytes(result)
+
+  def close(self):
+    pass
+
+# pins for open_virtual(): SDA, LED and (with `sda_in`) SDA input of each sensor
+PIN_LAYOUT = ((0x02, 0x04, 0x10, 0x40), (0x08, 0x20, 0x80), None)
+PIN_LAYOUT_SDA_IN = ((0x02, 0x10), (0x08, 0x40), (0x04, 0x20))
+
+def open_virtual(sensor_count=1, sda_in=False):
+  # VirtualGpio with sensor_count sensors and the TCS3472 (or TCS3472Array) for them
+  sda_pins, led_pins, sda_in_pins = PIN_LAYOUT_SDA_IN if sda_in else PIN_LAYOUT
+  if sensor_count > len(sda_pins):
+    raise Exception("at most %d sensors" % len(sda_pins))
+  pins = sda_pins[:sensor_count]
+  in_pins = sda_in_pins[:sensor_count] if sda_in else None
+  sensors = {pin: SimulatedTCS3472(led_pin=led_pins[i] if i < len(led_pins) else 0) for i, pin in enumerate(pins)}
+  dev = VirtualGpio(sensors, sda_in_pins=dict(zip(pins, in_pins)) if sda_in else None)
+  if sensor_count == 1:
+    return dev, tcs3472_ftdi.TCS3472(tcs3472_ftdi.I2CBitbanging("virtual://", dev, pins, in_pins), 0x29, led_pins[0])
+  i2c = tcs3472_ftdi.I2CParallelBitbanging("virtual://", dev, pins, in_pins)
+  return dev, tcs3472_ftdi.TCS3472Array(i2c, 0x29, led_pins[:sensor_count])
+
+def check(sensor_count=1, sda_in=False):
+  # Runs the TCS3472 class against the simulation (with faults) and returns a list of failures. The
+  # counts of USB transactions are in dev.operations.
+  failures = []
+  def expect(name, ok):
+    if not ok:
+      failures.append(name)
+  def each(result):
+    return result if sensor_count > 1 else [result]
+
+  dev, tcs = open_virtual(sensor_count, sda_in)
+  sensors = list(dev.sensors.values())
+  with dev.operation("write_regs"):
+    tcs.write_regs(0x00, [0x01, 0xff - 0x40, 0xff])
+  with dev.operation("write_regs (unchanged)"):
+    tcs.write_regs(0x00, [0x01, 0xff - 0x40, 0xff])
+  expect("write_regs", all(s.regs[0x01] == 0xbf for s in sensors) and tcs.reg(0x01) == 0xbf)
+  expect("unchanged registers are not written", dev.operations["write_regs (unchanged)"][1] == 0)
+  tcs.write_regs(0x0f, [0x01])
+  tcs.write_regs(0x00, [0x0b])
+  with dev.operation("read_color"):
+    color = tcs.read_color()
+  expect("no AVALID before the first cycle", all(c is not None and not (c[0] & AVALID) for c in each(color)))
+
+  polls = 0
+  sample = None
+  while sample is None and polls < 1000:
+    with dev.operation("read_new"):
+      sample = tcs.read_new()
+    polls += 1
+  expect("sample after one cycle", sample is not None and dev.clock() >= tcs.cycle_time())
+  expected = int(40.0 * 4 * (0x40 + 1))  # gain 4x, ATIME 0xbf is 65 cycles
+  expect("color data", sample is not None and all(c is not None and c[0] == expected for c in each(sample)))
+  with dev.operation("read_new (no new sample)"):
+    expect("AINT is cleared", tcs.read_new() is None)
+
+  tcs.led = True
+  dev.clock.advance(tcs.cycle_time())
+  with dev.operation("read_new"):
+    sample = tcs.read_new()
+  # sensors without an LED pin (e.g. the fourth one) don't get brighter
+  expect("LED", sample is not None and all(c is not None and (c[0] > expected) == bool(sensor.led_pin)
+    for c, sensor in zip(each(sample), sensors)))
+
+  sensors[0].inject_nack()
+  with dev.operation("read_regs (NACK)"):
+    result = tcs.read_regs(0x12)
+  expect("NACK", not each(result)[0] and all(r == [0x44] for r in each(result)[1:]))
+
+  dev.inject_timeout()
+  with dev.operation("read_regs (USB timeout)"):
+    result = tcs.read_regs(0x12)
+  expect("retry after USB timeout", all(r == [0x44] for r in each(result)))
+
+  for sensor in sensors:
+    sensor.inject_stuck_sda(5)
+  with dev.operation("fix_i2c (stuck SDA)"):
+    tcs.i2c.fix_i2c()
+  expect("fix_i2c releases SDA", not any(s.stuck_clocks for s in sensors) and all(r == [0x44] for r in each(tcs.read_regs(0x12))))
+  return failures, dev
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Check tcs3472_ftdi.py against simulated TCS3472s on a virtual FTDI adapter")
+  parser.add_argument("--sensors", type=int, default=None, help="number of sensors on the parallel bus (default: check 1 and 3, 1 and 2 with --sda-in)")
+  parser.add_argument("--sda-in", action="store_true", help="only check separate SDA input pins (default: both)")
+  args = parser.parse_args()
+
+  configurations = [(n, True) for n in ([args.sensors] if args.sensors else [1, 2])]
+  if not args.sda_in:
+    configurations = [(n, False) for n in ([args.sensors] if args.sensors else [1, 3])] + configurations
+  ok = True
+  for sensor_count, sda_in in configurations:
+    with contextlib.redirect_stdout(sys.stderr):
+      failures, dev = check(sensor_count, sda_in)
+    print("%d sensor(s)%s: %s" % (sensor_count, ", SDA input pins" if sda_in else "", "ok" if not failures else "FAILED: " + ", ".join(failures)))
+    for name, (calls, transactions) in dev.operations.items():
+      print("  %-26s %6.1f USB transactions" % (name, transactions / calls))
+    ok = ok and not failures
+  sys.exit(0 if ok else 1)
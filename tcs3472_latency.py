@@ -0,0 +1,102 @@
+import bisect
+import json
+import math
+import threading
+import time
+
+# Stages of a batch of samples in the order in which they happen in the GUI. Headless mode only has
+# "read", "parsed", "compensated" and "recorded".
+#   read:        bytes were returned by the serial port (LineFramer.read_time)
+#   parsed:      parse_lines() is done
+#   gui:         the GUI has taken the batch from the queue
+#   compensated: calibration has been applied
+#   recorded:    a csvgen record (GUI) resp. the samples (headless) have been written
+#   drawn:       Tk has redrawn the canvas with the new values
+STAGES = ("read", "parsed", "gui", "compensated", "recorded", "drawn")
+
+class LatencyStats(object):
+  # Histograms of the time from "read" to each stage and the number of samples that have reached each
+  # stage. The latency of a batch is tracked by a trace, which is just the read time and the number of
+  # samples. Use None instead of a LatencyStats object to disable this; the callers only check for that.
+  # Can be used from several threads.
+  __slots__ = ("edges", "histograms", "sample_counts", "batch_counts", "_lock", "_start_time", "_rate_time", "_rate_counts")
+
+  def __init__(self, min_latency=1e-5, max_latency=10.0, bins_per_decade=10):
+    # logarithmic bins, the first one is everything below min_latency and the last one everything above max_latency
+    bin_count = round(bins_per_decade * math.log10(max_latency / min_latency))
+    self.edges = [min_latency * 10**(i / bins_per_decade) for i in range(bin_count + 1)]
+    self.histograms = { stage: [0] * (len(self.edges) + 1) for stage in STAGES }
+    self.sample_counts = dict.fromkeys(STAGES, 0)
+    self.batch_counts = dict.fromkeys(STAGES, 0)
+    self._lock = threading.Lock()
+    self._start_time = time.monotonic()
+    self._rate_time = self._start_time
+    self._rate_counts = dict(self.sample_counts)
+
+  def trace(self, read_time, sample_count):
+    trace = (read_time, sample_count)
+    self.record("read", (trace,), now=read_time)
+    return trace
+
+  def record(self, stage, traces, now=None):
+    if now is None:
+      now = time.monotonic()
+    edges = self.edges
+    histogram = self.histograms[stage]
+    with self._lock:
+      for read_time, sample_count in traces:
+        histogram[bisect.bisect_right(edges, now - read_time)] += 1
+        self.sample_counts[stage] += sample_count
+        self.batch_counts[stage] += 1
+
+  def percentile(self, stage, p):
+    # upper edge of the bin that contains the p-th percentile, None if there is no data
+    histogram = self.histograms[stage]
+    total = sum(histogram)
+    if total == 0:
+      return None
+    limit = total * p / 100
+    count = 0
+    for i, n in enumerate(histogram):
+      count += n
+      if count >= limit:
+        return self.edges[min(i, len(self.edges) - 1)]
+
+  def rates(self):
+    # samples/s for each stage since the last call
+    now = time.monotonic()
+    dt = max(now - self._rate_time, 1e-9)
+    with self._lock:
+      counts = dict(self.sample_counts)
+    result = { stage: (counts[stage] - self._rate_counts[stage]) / dt for stage in STAGES }
+    self._rate_time = now
+    self._rate_counts = counts
+    return result
+
+  def summary(self, rates=None):
+    # one line per stage that has seen any data
+    lines = []
+    for stage in STAGES:
+      if self.batch_counts[stage] == 0:
+        continue
+      text = "%-11s" % stage
+      if stage == "read":
+        text += " %d batches, %d samples" % (self.batch_counts[stage], self.sample_counts[stage])
+      else:
+        text += " p50 %7.2f ms, p95 %7.2f ms, p99 %7.2f ms" % tuple(self.percentile(stage, p) * 1e3 for p in (50, 95, 99))
+      if rates is not None:
+        text += ", %7.1f samples/s" % rates[stage]
+      lines.append(text)
+    return "\n".join(lines)
+
+  def dump(self, path):
+    with self._lock:
+      data = {
+        "duration": time.monotonic() - self._start_time,
+        "bin_edges_s": self.edges,
+        "histograms": { stage: list(h) for stage, h in self.histograms.items() },
+        "sample_counts": dict(self.sample_counts),
+        "batch_counts": dict(self.batch_counts),
+      }
+    with open(path, "w") as f:
+      json.dump(data, f, indent=2)
@@ -0,0 +1,219 @@
+import re
+import time
+import numpy
+
+# one row per color sample, as produced by parse_lines()
+SAMPLE_DTYPE = numpy.dtype([("sensor", numpy.uint8), ("c", numpy.uint16), ("r", numpy.uint16), ("g", numpy.uint16),
+  ("b", numpy.uint16), ("time", numpy.float64)])
+
+present_re = re.compile(rb':tcs(\d+)[.]present=([01])$')
+color_re = re.compile(rb':tcs(\d+)[.]color=[(]0x([0-9a-fA-F]{1,4}), *0x([0-9a-fA-F]{1,4}), *0x([0-9a-fA-F]{1,4}), *0x([0-9a-fA-F]{1,4})[)]$')
+
+class LineFramer(object):
+  # Reads everything that is available from a pyserial transport (anything returned by serial_for_url)
+  # into one reusable buffer and splits it into lines. The lines are memoryviews into that buffer so
+  # they are only valid until the next call to read_lines(). `read_time` is the time.monotonic() of the
+  # last read that returned any data.
+  __slots__ = ("ser", "capture", "_buf", "_view", "_start", "_end", "byte_count", "line_count", "read_time",
+    "_rate_time", "_rate_bytes", "_rate_lines")
+
+  def __init__(self, ser, bufsize=4096, capture=None):
+    # capture: CaptureWriter that gets a copy of all bytes that we receive
+    self.ser = ser
+    self.capture = capture
+    self._buf = bytearray(bufsize)
+    self._view = memoryview(self._buf)
+    self._start = 0
+    self._end = 0
+    self.byte_count = 0
+    self.line_count = 0
+    self.read_time = None
+    self._rate_time = time.monotonic()
+    self._rate_bytes = 0
+    self._rate_lines = 0
+
+  def _fill(self):
+    if self._start > 0:
+      # move the partial line to the front of the buffer
+      n = self._end - self._start
+      self._buf[0:n] = self._buf[self._start:self._end]
+      self._start = 0
+      self._end = n
+    if self._end >= len(self._buf):
+      print("line too long, dropping %d bytes" % self._end)
+      self._end = 0
+
+    # Read as much as fits without blocking if anything is available (in_waiting is only 0 or 1 for some
+    # transports, e.g. socket://) and block for at most one byte (i.e. until the timeout of the port) if
+    # nothing is.
+    free = self._view[self._end:]
+    timeout = getattr(self.ser, "timeout", 0)
+    if timeout == 0:
+      n = self.ser.readinto(free)
+    elif self.ser.in_waiting:
+      self.ser.timeout = 0
+      try:
+        n = self.ser.readinto(free)
+      finally:
+        self.ser.timeout = timeout
+    else:
+      n = self.ser.readinto(free[:1])
+    if n:
+      self.read_time = time.monotonic()
+      if self.capture is not None:
+        self.capture.write(time.time(), self._buf[self._end:self._end+n])
+      self._end += n
+      self.byte_count += n
+    return n
+
+  def read_lines(self):
+    self._fill()
+    buf = self._buf
+    view = self._view
+    start = self._start
+    end = self._end
+    lines = []
+    while True:
+      nl = buf.find(b"\n", start, end)
+      if nl < 0:
+        break
+      e = nl
+      while e > start and buf[e-1] == 13:  # \r
+        e -= 1
+      lines.append(view[start:e])
+      start = nl + 1
+    self._start = start
+    self.line_count += len(lines)
+    return lines
+
+  def rates(self):
+    # bytes/s and lines/s since the last call
+    now = time.monotonic()
+    dt = max(now - self._rate_time, 1e-9)
+    result = ((self.byte_count - self._rate_bytes) / dt, (self.line_count - self._rate_lines) / dt)
+    self._rate_time = now
+    self._rate_bytes = self.byte_count
+    self._rate_lines = self.line_count
+    return result
+
+def _hex_to_uint16(a):
+  # a is an array of up to four hex digits per item ("S4"), shorter strings are padded with NUL at the end
+  digits = a.astype("S4").view(numpy.uint8).reshape(a.shape + (4,)).astype(numpy.uint16)
+  result = numpy.zeros(a.shape, numpy.uint16)
+  for i in range(4):
+    d = digits[..., i]
+    # '0'..'9' -> 0..9, 'A'..'F' and 'a'..'f' -> 10..15
+    value = (d & 0xf) + 9*(d >> 6)
+    result = numpy.where(d != 0, result*16 + value, result)
+  return result
+
+def parse_lines(lines, timestamp=None):
+  # Returns an array of SAMPLE_DTYPE for all color lines and a list of events for everything else:
+  #   ("ok", None), ("present", (sensor_index, present)), ("status", line), ("comment", line), ("unknown", line)
+  if timestamp is None:
+    timestamp = time.time()
+  fields = []
+  events = []
+  for line in lines:
+    if not line:
+      continue
+    m = color_re.match(line)
+    if m is not None:
+      fields.append(m.groups())
+      continue
+    first = line[0]
+    if first == 0x25:  # '%'
+      if line == b"%ok":
+        events.append(("ok", None))
+      else:
+        events.append(("status", bytes(line)))
+    elif first == 0x23:  # '#'
+      events.append(("comment", bytes(line)))
+    else:
+      m = present_re.match(line)
+      if m is not None:
+        events.append(("present", (int(m[1]), m[2] == b"1")))
+      else:
+        events.append(("unknown", bytes(line)))
+
+  samples = numpy.empty(len(fields), SAMPLE_DTYPE)
+  if fields:
+    a = numpy.array(fields)
+    samples["sensor"] = a[:, 0].astype(numpy.uint8)
+    values = _hex_to_uint16(a[:, 1:])
+    samples["c"] = values[:, 0]
+    samples["r"] = values[:, 1]
+    samples["g"] = values[:, 2]
+    samples["b"] = values[:, 3]
+    samples["time"] = timestamp
+  return samples, events
+
+def sample_channels(samples, dtype=numpy.float64):
+  # (N, 4) array with clear, red, green and blue
+  return numpy.stack((samples["c"], samples["r"], samples["g"], samples["b"]), axis=-1).astype(dtype)
+
+class Handshake(object):
+  # The part of start_session() that processes the lines, for callers that read them by themselves.
+  # feed() returns None until the values are complete and then the lines that we have received after them.
+  __slots__ = ("state", "values")
+
+  commands = b":echo=0\r\n:auto=1\r\n?\r\n"
+
+  def __init__(self):
+    self.state = 0
+    self.values = {}
+
+  def feed(self, lines):
+    values = self.values
+    for i, line in enumerate(lines):
+      if self.state == 0:
+        # first line is most likely only a partial one -> ignore it
+        self.state = 1
+      elif line == b"" or line == b"%ok":
+        pass
+      elif self.state == 1 and line == b"%values":
+        self.state = 2
+      elif self.state == 2 and line == b"%end":
+        self.state = 3
+        return [bytes(l) for l in lines[i+1:]]
+      elif self.state == 2 and line[0] == b":"[0]:
+        line = bytes(line)
+        eq = line.find(b"=")
+        if eq >= 0:
+          k = line[1:eq]
+          v = line[eq+1:]
+          if k.endswith(b".type"):
+            values[k] = v
+          else:
+            values[k] = int(v)
+      else:
+        print("unexpected line: %r" % bytes(line))
+    return None
+
+def start_session(ser, framer):
+  # Disables echo, enables auto-poll and asks for the current values. Returns the values and any lines
+  # that we have received after the end of the values.
+  ser.write(Handshake.commands)
+  handshake = Handshake()
+  while True:
+    rest = handshake.feed(framer.read_lines())
+    if rest is not None:
+      return handshake.values, rest
+
+def setting_lines(name, value, tcs_count):
+  # one command for each sensor if the name contains "%d"
+  if b"%d" in name:
+    return [b":%s=%d\r\n" % (name%i, value) for i in range(tcs_count)]
+  else:
+    return [b":%s=%d\r\n" % (name, value)]
+
+def setting_command(name, value, tcs_count):
+  # names with "%d" are set for all sensors
+  return b"".join(setting_lines(name, value, tcs_count))
+
+def read_batches(framer, lines=()):
+  # endless stream of parse_lines() results, starting with `lines` (e.g. the rest from start_session)
+  if lines:
+    yield parse_lines(lines)
+  while True:
+    yield parse_lines(framer.read_lines())
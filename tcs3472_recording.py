@@ -0,0 +1,179 @@
+import io
+import sys
+import json
+import struct
+import time
+import numpy
+
+# csvgen modes, same values as the radio buttons in the GUI
+MODE_NAMES = ("itime", "WS2812", "monitor", "gain")
+
+RECORDING_MAGIC = b"TCSREC1\n"
+CAPTURE_MAGIC = b"TCSRAW1\n"
+
+class SampleTsvWriter(object):
+  # One row per sample with the raw and compensated values. The file is flushed every `flush_interval`
+  # seconds instead of after every row.
+  __slots__ = ("file", "flush_interval", "sample_count", "_last_flush")
+
+  columns = ("time", "sensor", "raw_c", "raw_r", "raw_g", "raw_b", "c", "r", "g", "b")
+  formats = ("%.6f", "%d", "%d", "%d", "%d", "%d", "%.3f", "%.3f", "%.3f", "%.3f")
+
+  def __init__(self, path, flush_interval=1.0):
+    self.file = open(path, "w")
+    self.flush_interval = flush_interval
+    self.sample_count = 0
+    self._last_flush = time.monotonic()
+    self.file.write("\t".join(self.columns) + "\n")
+
+  @property
+  def name(self):
+    return self.file.name
+
+  def write(self, samples, values):
+    if len(samples) == 0:
+      return
+    rows = numpy.empty((len(samples), len(self.columns)))
+    rows[:, 0] = samples["time"]
+    rows[:, 1] = samples["sensor"]
+    rows[:, 2] = samples["c"]
+    rows[:, 3] = samples["r"]
+    rows[:, 4] = samples["g"]
+    rows[:, 5] = samples["b"]
+    rows[:, 6:10] = values
+    numpy.savetxt(self.file, rows, fmt=self.formats, delimiter="\t")
+    self.sample_count += len(samples)
+
+    now = time.monotonic()
+    if now - self._last_flush >= self.flush_interval:
+      self._last_flush = now
+      self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+# Raw capture of the serial data: magic (8 bytes), followed by one frame for each read:
+# host time (float64, little endian), length (uint32, little endian), data
+class CaptureWriter(object):
+  __slots__ = ("file",)
+
+  def __init__(self, path):
+    self.file = open(path, "wb")
+    self.file.write(CAPTURE_MAGIC)
+
+  @property
+  def name(self):
+    return self.file.name
+
+  def write(self, timestamp, data):
+    self.file.write(struct.pack("<dI", timestamp, len(data)))
+    self.file.write(data)
+
+  def close(self):
+    self.file.close()
+
+# Binary csvgen recording:
+#   magic (8 bytes), length of header (uint32, little endian), header (JSON, padded with spaces to a multiple of 8 bytes),
+#   followed by fixed-size records of step_dtype(header["sensor_count"]).
+# The two samples of each sensor are the same as "1" and "2" in the TSV columns and "avg" is "c", "r", "g" and "b".
+def step_dtype(sensor_count):
+  return numpy.dtype([
+    ("mode", "u1"),
+    ("step", "<u2"),
+    ("rgb", "<u2", (3,)),
+    ("raw", "<u2", (sensor_count, 2, 4)),
+    ("values", "<f4", (sensor_count, 2, 4)),
+    ("avg", "<f4", (sensor_count, 4)),
+  ])
+
+class StepRecordingWriter(object):
+  __slots__ = ("file", "header", "dtype", "flush_interval", "step_count", "_last_flush")
+
+  def __init__(self, file, header, flush_interval=2.0):
+    # file must be opened in binary mode, header must contain "sensor_count"
+    self.file = file
+    self.header = header
+    self.dtype = step_dtype(header["sensor_count"])
+    self.flush_interval = flush_interval
+    self.step_count = 0
+    self._last_flush = time.monotonic()
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-(len(RECORDING_MAGIC) + 4 + len(header_bytes)) % 8)
+    self.file.write(RECORDING_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+    self.file.flush()
+
+  @property
+  def name(self):
+    return self.file.name
+
+  def new_record(self):
+    return numpy.zeros((), self.dtype)
+
+  def write(self, record):
+    self.file.write(record.tobytes())
+    self.step_count += 1
+    now = time.monotonic()
+    if now - self._last_flush >= self.flush_interval:
+      self._last_flush = now
+      self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+def read_recording(path):
+  # Returns the header and a read-only memmap of the records. A partial record at the end (e.g. the
+  # program was killed while writing it) is ignored.
+  with open(path, "rb") as f:
+    magic = f.read(len(RECORDING_MAGIC))
+    if magic != RECORDING_MAGIC:
+      raise Exception("%s is not a csvgen recording" % path)
+    header_length, = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(header_length).decode("utf-8"))
+    offset = f.tell()
+    f.seek(0, io.SEEK_END)
+    size = f.tell()
+  dtype = step_dtype(header["sensor_count"])
+  count = (size - offset) // dtype.itemsize
+  if count == 0:
+    return header, numpy.zeros(0, dtype)
+  return header, numpy.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+def tsv_columns(sensor_count):
+  cells = ["mode", "step", "r", "g", "b"]
+  for i in range(sensor_count):
+    cells.extend(("sensor%d.raw_c1"%i, "sensor%d.raw_r1"%i, "sensor%d.raw_g1"%i, "sensor%d.raw_b1"%i, "sensor%d.raw_c2"%i, "sensor%d.raw_r2"%i, "sensor%d.raw_g2"%i, "sensor%d.raw_b2"%i))
+    cells.extend(("sensor%d.c1"%i, "sensor%d.r1"%i, "sensor%d.g1"%i, "sensor%d.b1"%i, "sensor%d.c2"%i, "sensor%d.r2"%i, "sensor%d.g2"%i, "sensor%d.b2"%i))
+    cells.extend(("sensor%d.c"%i, "sensor%d.r"%i, "sensor%d.g"%i, "sensor%d.b"%i))
+  return cells
+
+def export_tsv(path, out_path, chunk_size=65536):
+  # writes the same columns as the csvgen TSV files of older versions
+  header, records = read_recording(path)
+  sensor_count = header["sensor_count"]
+  formats = ["%d"] * 4
+  for i in range(sensor_count):
+    formats.extend(["%d"] * 8 + ["%.7g"] * 12)
+  with open(out_path, "w") as f:
+    f.write("\t".join(tsv_columns(sensor_count)) + "\n")
+    for start in range(0, len(records), chunk_size):
+      chunk = records[start:start+chunk_size]
+      n = len(chunk)
+      per_sensor = numpy.concatenate((chunk["raw"].reshape(n, sensor_count, 8), chunk["values"].reshape(n, sensor_count, 8), chunk["avg"]), axis=2)
+      numbers = numpy.concatenate((chunk["step"].reshape(n, 1), chunk["rgb"], per_sensor.reshape(n, -1)), axis=1)
+      buf = io.StringIO()
+      numpy.savetxt(buf, numbers, fmt=formats, delimiter="\t")
+      for mode, line in zip(chunk["mode"].tolist(), buf.getvalue().splitlines()):
+        f.write(MODE_NAMES[mode] if mode < len(MODE_NAMES) else "??")
+        f.write("\t")
+        f.write(line)
+        f.write("\n")
+
+if __name__ == "__main__":
+  if len(sys.argv) not in (2, 3):
+    print("usage: %s recording.tcsrec [output.csv]" % sys.argv[0])
+    print("  converts a csvgen recording to the TSV format of older versions")
+    sys.exit(1)
+  out_path = sys.argv[2] if len(sys.argv) > 2 else sys.argv[1] + ".csv"
+  export_tsv(sys.argv[1], out_path)
+  print("written to %s" % out_path)
@@ -0,0 +1,139 @@
+import struct
+import time
+import numpy
+from tcs3472_protocol import LineFramer, SAMPLE_DTYPE, parse_lines, start_session
+from tcs3472_recording import CAPTURE_MAGIC
+from tcs3472_boards import SENSORS_PER_BOARD
+
+class Replay(object):
+  # Plays back a raw capture (--capture) or a sample recording (--headless) as batches of (samples, events),
+  # i.e. the same thing that parse_lines() returns for live data.
+  #   speed:      1.0 for original timing, 2.0 for twice as fast, 0 for as fast as possible
+  #   start_time: skip everything before this many seconds after the start of the recording
+  #   start_step: skip this many batches (one batch is one read on the original system)
+  # For captures, the values of the handshake are available in `values` after the first batch.
+  __slots__ = ("path", "speed", "start_time", "start_step", "values", "batch_count",
+    "_file", "_frame", "_frame_pos", "_frame_time", "_first_time", "_wall_start", "_eof", "_samples")
+
+  def __init__(self, path, speed=1.0, start_time=None, start_step=None):
+    self.path = path
+    self.speed = speed
+    self.start_time = start_time
+    self.start_step = start_step
+    self.values = {}
+    self.batch_count = 0
+    self._samples = None
+
+  def _is_capture(self):
+    with open(self.path, "rb") as f:
+      return f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+  @property
+  def sensor_count(self):
+    # number of sensors of all boards in the recording, captures are always from one board
+    if self._is_capture():
+      return SENSORS_PER_BOARD
+    sensors = self._load_samples()["sensor"]
+    board_count = int(sensors.max()) // SENSORS_PER_BOARD + 1 if len(sensors) > 0 else 1
+    return board_count * SENSORS_PER_BOARD
+
+  def _skipping(self, timestamp):
+    if self.start_step is not None and self.batch_count < self.start_step:
+      return True
+    if self.start_time is not None and timestamp - self._first_time < self.start_time:
+      return True
+    return False
+
+  def _wait_until(self, timestamp):
+    if self.speed <= 0:
+      return
+    now = time.monotonic()
+    if self._wall_start is None:
+      self._wall_start = now - (timestamp - self._first_time) / self.speed
+    delay = self._wall_start + (timestamp - self._first_time) / self.speed - now
+    if delay > 0:
+      time.sleep(delay)
+
+  def __iter__(self):
+    self._wall_start = None
+    self._first_time = None
+    self.batch_count = 0
+    if self._is_capture():
+      return self._iter_capture()
+    else:
+      return self._iter_samples()
+
+  def _load_samples(self):
+    # the whole recording as SAMPLE_DTYPE, parsed only once (sensor_count needs it before the replay starts)
+    if self._samples is None:
+      data = numpy.loadtxt(self.path, delimiter="\t", skiprows=1, ndmin=2)
+      samples = numpy.empty(len(data), SAMPLE_DTYPE)
+      if len(data) > 0:
+        samples["time"] = data[:, 0]
+        samples["sensor"] = data[:, 1]
+        for i, k in enumerate(("c", "r", "g", "b")):
+          samples[k] = data[:, 2+i]
+      self._samples = samples
+    return self._samples
+
+  def _iter_samples(self):
+    samples = self._load_samples()
+    if len(samples) == 0:
+      return
+    # all samples of one read have the same timestamp
+    boundaries = numpy.flatnonzero(numpy.diff(samples["time"]) != 0) + 1
+    self._first_time = samples["time"][0]
+    for batch in numpy.split(samples, boundaries):
+      timestamp = batch["time"][0]
+      if not self._skipping(timestamp):
+        self._wait_until(timestamp)
+        yield batch, []
+      self.batch_count += 1
+
+  # The capture is read through LineFramer and start_session so this object acts as the serial port.
+  @property
+  def in_waiting(self):
+    while self._frame_pos >= len(self._frame):
+      header = self._file.read(12)
+      if len(header) < 12:
+        self._eof = True
+        return 0
+      self._frame_time, length = struct.unpack("<dI", header)
+      self._frame = self._file.read(length)
+      self._frame_pos = 0
+      if self._first_time is None:
+        self._first_time = self._frame_time
+    return len(self._frame) - self._frame_pos
+
+  def readinto(self, b):
+    n = min(len(b), self.in_waiting)
+    if n == 0 and self._eof:
+      raise EOFError()
+    b[:n] = self._frame[self._frame_pos:self._frame_pos+n]
+    self._frame_pos += n
+    return n
+
+  def write(self, data):
+    pass  # commands are not replayed
+
+  def _iter_capture(self):
+    self._file = open(self.path, "rb")
+    self._file.read(len(CAPTURE_MAGIC))
+    self._frame = b""
+    self._frame_pos = 0
+    self._frame_time = 0
+    self._eof = False
+    framer = LineFramer(self)
+    try:
+      self.values, lines = start_session(self, framer)
+      while True:
+        timestamp = self._frame_time
+        if not self._skipping(timestamp):
+          self._wait_until(timestamp)
+          yield parse_lines(lines, timestamp)
+        self.batch_count += 1
+        lines = framer.read_lines()
+    except EOFError:
+      pass
+    finally:
+      self._file.close()
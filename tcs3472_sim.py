@@ -0,0 +1,334 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 -p "python3.withPackages (p: with p; [numpy])"
+
+# Simulates the Arduino with src/main.cpp so tcs3472_arduino.py can be tested without hardware, e.g.:
+#   python3 tcs3472_sim.py --socket 7777 &
+#   python3 tcs3472_arduino.py socket://localhost:7777
+
+import os
+import sys
+import time
+import asyncio
+import select
+import socket
+import argparse
+import numpy
+from tcs3472_calibration import CalibrationRegistry
+from tcs3472_commands import CommandChannel
+from tcs3472_protocol import parse_lines
+
+GAIN_FACTORS = (1, 4, 16, 60)
+# like src/main.cpp: sensors 0 to TCS_COUNT-1 are TCS3472, the others are APDS9960 (no LED and no settings)
+TCS_COUNT = 3
+APDS_COUNT = 3
+CYCLE_TIME = 0.0024  # seconds per integration cycle
+
+class SimulatedSensor(object):
+  __slots__ = ("index", "present", "gain", "itime", "led", "response", "ready_time")
+
+  def __init__(self, index, present, response):
+    self.index = index
+    self.present = present
+    self.gain = 1
+    self.itime = 63
+    self.led = 0
+    self.response = response  # rows: sensor response (r, g, b)/clear for each WS2812 primary
+    self.ready_time = 0
+
+class SimulatedFirmware(object):
+  # Speaks the same line protocol as src/main.cpp, including its errors for invalid settings, with at
+  # most TCS_COUNT + APDS_COUNT sensors. Times are in seconds (e.g. time.monotonic()) and `time_scale` > 1
+  # makes integration and polling faster than the real hardware.
+  __slots__ = ("sensors", "ws2812", "echo", "auto_poll", "poll_interval", "time_scale", "noise", "ambient",
+    "ws2812_counts", "led_counts", "rng", "_inbuf", "_prev_char", "_last_poll", "_reported_present")
+
+  def __init__(self, sensor_count=6, absent=(), poll_interval=0.05, time_scale=1.0, noise=1.0, ambient=0.2,
+      ws2812_counts=(66, 52, 55), led_counts=20, seed=None):
+    if sensor_count > TCS_COUNT + APDS_COUNT:
+      raise ValueError("the firmware has at most %d sensors" % (TCS_COUNT + APDS_COUNT))
+    calibration = CalibrationRegistry(sensor_count=sensor_count, mode="per-sensor")
+    self.sensors = [SimulatedSensor(i, i not in absent, numpy.transpose(calibration.rgb_to_tcs(i, 0, 255)))
+      for i in range(sensor_count)]
+    self.ws2812 = [0, 0, 0]
+    self.echo = True
+    self.auto_poll = False
+    self.poll_interval = poll_interval
+    self.time_scale = time_scale
+    self.noise = noise
+    self.ambient = ambient  # counts per cycle at gain 1
+    self.ws2812_counts = numpy.array(ws2812_counts, dtype=float)  # clear counts per cycle at gain 1 for each primary at 255
+    self.led_counts = led_counts  # clear counts per cycle at gain 1 if the LED of the sensor is on
+    self.rng = numpy.random.default_rng(seed)
+    self._inbuf = b""
+    self._prev_char = 0
+    self._last_poll = 0
+    self._reported_present = [False] * sensor_count
+
+  def _conversion_time(self, sensor):
+    return (sensor.itime + 1) * CYCLE_TIME / self.time_scale
+
+  def measure(self, sensor):
+    light = numpy.array(self.ws2812) / 255 * self.ws2812_counts
+    per_cycle = numpy.zeros(4)
+    per_cycle[0] = light.sum()
+    per_cycle[1:] = numpy.dot(light, sensor.response)
+    per_cycle += self.ambient * numpy.array((1, 0.3, 0.35, 0.3))
+    if sensor.led:
+      per_cycle += self.led_counts * numpy.array((1, 0.35, 0.35, 0.3))
+    cycles = sensor.itime + 1
+    expected = per_cycle * GAIN_FACTORS[min(sensor.gain, 3)] * cycles
+    values = expected + self.rng.normal(0, 1, 4) * self.noise * numpy.sqrt(expected + 1)
+    # The counter saturates at 1024 counts per cycle and it is only 16 bits.
+    return numpy.clip(numpy.round(values), 0, min(0xffff, 1024*cycles)).astype(int)
+
+  def poll(self, now):
+    out = []
+    for sensor in self.sensors:
+      if sensor.present != self._reported_present[sensor.index]:
+        self._reported_present[sensor.index] = sensor.present
+        out.append(b":tcs%d.present=%d\r\n" % (sensor.index, sensor.present))
+      if sensor.present and now >= sensor.ready_time:
+        sensor.ready_time = now + self._conversion_time(sensor)
+        out.append(b":tcs%d.color=(0x%04X, 0x%04X, 0x%04X, 0x%04X)\r\n" % tuple([sensor.index] + list(self.measure(sensor))))
+    return b"".join(out)
+
+  def update(self, now):
+    if not self.auto_poll:
+      self._last_poll = now
+      return b""
+    if now - self._last_poll >= self.poll_interval / self.time_scale:
+      self._last_poll = now
+      return self.poll(now)
+    return b""
+
+  def next_event_time(self, now):
+    if not self.auto_poll:
+      return now + 0.1
+    t = self._last_poll + self.poll_interval / self.time_scale
+    if self.poll_interval == 0:
+      t = min(s.ready_time for s in self.sensors if s.present) if any(s.present for s in self.sensors) else now + 0.1
+    return t
+
+  def values(self):
+    out = [b"%values\r\n"]
+    for s in self.sensors:
+      apds = s.index >= TCS_COUNT
+      out.append(b":tcs%d.present=%d\r\n" % (s.index, s.present))
+      out.append(b":tcs%d.type=%s\r\n" % (s.index, b"APDS9960" if apds else b"TCS34721"))
+      out.append(b":tcs%d.gain=%d\r\n" % (s.index, s.gain))
+      out.append(b":tcs%d.itime=%d\r\n" % (s.index, s.itime))
+      out.append(b":tcs%d.partnum=%d\r\n" % (s.index, 0xab if apds else 0x44))
+      if not apds:
+        out.append(b":tcs%d.led=%d\r\n" % (s.index, s.led))
+    for name, value in zip(b"rgb", self.ws2812):
+      out.append(b":led0.%c=%d\r\n" % (name, value))
+    out.append(b"%end\r\n")
+    return b"".join(out)
+
+  def error(self, line, message):
+    # the firmware also prints the line that it didn't understand
+    return b"%%ERR: %s\r\n#DEBUG: %s|, %d\r\n" % (message, line, len(line))
+
+  def handle_input(self, line, now):
+    if line == b"?":
+      return self.values()
+    elif line == b":poll":
+      return self.poll(now)
+    elif line.startswith(b":"):
+      eq = line.find(b"=", 5)
+      if eq < 0:
+        return self.error(line, b"invalid command")
+      digits = line[eq+1:]
+      if not digits or not digits.isdigit():
+        return self.error(line, b"invalid format")
+      value = int(digits) & 0xff  # uint8_t in the firmware
+      key = line[1:eq]
+      ok = True
+      if key == b"auto":
+        self.auto_poll = value != 0
+      elif key == b"echo":
+        self.echo = value != 0
+      elif key.startswith(b"tcs") and len(key) > 5 and key[3:4].isdigit() and key[4:5] == b"." and int(key[3:4]) < min(TCS_COUNT, len(self.sensors)):
+        sensor = self.sensors[int(key[3:4])]
+        name = key[5:]
+        if name == b"gain":
+          ok = value <= 4
+          if ok:
+            sensor.gain = value
+        elif name == b"itime":
+          sensor.itime = value
+          sensor.ready_time = now + self._conversion_time(sensor)
+        elif name == b"led":
+          sensor.led = 1 if value else 0
+        else:
+          return self.error(line, b"invalid command")
+      elif key in (b"led0.r", b"led0.g", b"led0.b"):
+        self.ws2812[b"rgb".index(key[5:6])] = value
+      else:
+        return self.error(line, b"invalid command")
+      return b"%ok\r\n" if ok else b"%failed\r\n"
+    else:
+      return self.error(line, b"invalid command")
+
+  def receive(self, data, now):
+    out = []
+    for c in data:
+      echo_this_one = self.echo
+      if c in (0x0d, 0x0a):
+        echo_this_one = False
+        if not self._inbuf:
+          if self._prev_char != 0x0d or c != 0x0a:
+            out.append(b"\r\n")
+        else:
+          if self.echo:
+            out.append(b"\r\n")
+          if len(self._inbuf) < 19:
+            out.append(self.handle_input(self._inbuf, now))
+          else:
+            out.append(b"%ERR: too long\r\n")
+        self._inbuf = b""
+      elif c in (0, 27):
+        self._inbuf = b""
+        echo_this_one = False
+        if self.echo:
+          out.append(b"\r\n")
+      elif c == 8:
+        if self._inbuf:
+          self._inbuf = self._inbuf[:-1]
+          out.append(b"\x08 \x08")
+        echo_this_one = False
+      elif c < 32 or c > 128:
+        out.append(b"# char code: 0x%02X" % c)
+      elif len(self._inbuf) < 20:
+        self._inbuf += bytes((c,))
+      else:
+        echo_this_one = False
+      if echo_this_one:
+        out.append(bytes((c,)))
+      self._prev_char = c
+    return b"".join(out)
+
+def serve(firmware, fd):
+  # until the other side closes the connection
+  while True:
+    now = time.monotonic()
+    timeout = max(0, firmware.next_event_time(now) - now)
+    readable, _, _ = select.select([fd], [], [], timeout)
+    now = time.monotonic()
+    out = b""
+    if readable:
+      try:
+        data = os.read(fd, 4096)
+      except OSError:
+        data = b""  # pty without any client
+      if not data:
+        return
+      out += firmware.receive(data, now)
+    out += firmware.update(now)
+    if out:
+      os.write(fd, out)
+
+def run(args):
+  firmware = SimulatedFirmware(sensor_count=args.sensors, absent=args.absent, poll_interval=args.poll_interval,
+    time_scale=args.time_scale, noise=args.noise, ambient=args.ambient, seed=args.seed)
+  if args.pty:
+    import pty, tty
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    print("simulated Arduino is at %s" % os.ttyname(slave))
+    sys.stdout.flush()
+    while True:
+      serve(firmware, master)
+      time.sleep(0.1)
+  else:
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", args.socket))
+    server.listen(1)
+    print("simulated Arduino is at socket://localhost:%d" % args.socket)
+    sys.stdout.flush()
+    while True:
+      conn, _ = server.accept()
+      with conn:
+        try:
+          serve(firmware, conn.fileno())
+        except (ConnectionResetError, BrokenPipeError):
+          pass
+      # the firmware keeps its state like the real one but a new client starts with echo
+      firmware.echo = True
+
+def check_commands(timeout=0.05):
+  # Runs the CommandChannel of tcs3472_arduino.py against the simulation with late and lost replies and
+  # returns a list of failures. The replies are only delivered by deliver(), i.e. they are late if there
+  # is a timeout before that.
+  failures = []
+  def expect(name, ok):
+    if not ok:
+      failures.append(name)
+
+  async def run():
+    loop = asyncio.get_running_loop()
+    firmware = SimulatedFirmware(seed=0)
+    firmware.receive(b":echo=0\r\n", 0)
+    replies = []
+    def write(data):
+      replies.append(firmware.receive(data, time.monotonic()))
+      return True
+    channel = CommandChannel("sim", write, loop, timeout=timeout)
+    def deliver(lose_fence=False):
+      lines = b"".join(replies).split(b"\r\n")
+      replies.clear()
+      if lose_fence:
+        lines = lines[:lines.index(b"%values")] + lines[lines.index(b"%end") + 1:]
+      channel.handle_events(parse_lines(lines)[1])
+    async def result(future):
+      try:
+        return await asyncio.wait_for(future, 10 * timeout)
+      except asyncio.TimeoutError:
+        return None
+
+    # late replies after a retry don't complete the commands that are sent after it
+    failed = channel.submit(b":tcs0.gain=9\r\n")
+    ok = channel.submit(b":tcs1.gain=1\r\n")
+    await asyncio.sleep(1.5 * timeout)
+    new = channel.submit(b":led0.r=5\r\n")
+    await asyncio.sleep(0)
+    deliver()
+    expect("late replies", [await result(f) for f in (failed, ok, new)] == [False, True, True])
+
+    # the answer of the fence is lost: the command is sent again after a new fence and new commands still work
+    lost = channel.submit(b":tcs0.gain=2\r\n")
+    await asyncio.sleep(1.5 * timeout)
+    deliver(lose_fence=True)
+    await asyncio.sleep(timeout)
+    deliver()
+    new = channel.submit(b":led0.g=5\r\n")
+    await asyncio.sleep(0)
+    deliver()
+    expect("lost fence", [await result(f) for f in (lost, new)] == [True, True] and not channel.busy)
+    expect("settings", firmware.sensors[0].gain == 2 and firmware.ws2812 == [5, 5, 0])
+
+  asyncio.run(run())
+  return failures
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Simulate the Arduino firmware (src/main.cpp) for tcs3472_arduino.py")
+  group = parser.add_mutually_exclusive_group(required=True)
+  group.add_argument("--socket", type=int, metavar="PORT", help="listen on localhost:PORT (use socket://localhost:PORT)")
+  group.add_argument("--pty", action="store_true", help="create a pseudo terminal")
+  group.add_argument("--check", action="store_true", help="check the command channel of tcs3472_arduino.py with late and lost replies")
+  parser.add_argument("--sensors", type=int, default=6, help="number of sensors (at most %d, the first %d are TCS3472 and the others APDS9960)" % (TCS_COUNT + APDS_COUNT, TCS_COUNT))
+  parser.add_argument("--absent", type=int, nargs="*", default=(), metavar="INDEX", help="sensors that are not connected")
+  parser.add_argument("--poll-interval", type=float, default=0.05, help="seconds between polls in auto mode, 0 to send values as soon as they are ready")
+  parser.add_argument("--time-scale", type=float, default=1.0, help="run integration and polling this many times faster than real time")
+  parser.add_argument("--noise", type=float, default=1.0, help="noise relative to shot noise")
+  parser.add_argument("--ambient", type=float, default=0.2, help="ambient light in clear counts per integration cycle at gain 1x")
+  parser.add_argument("--seed", type=int, help="seed for the noise")
+  args = parser.parse_args()
+  if not 1 <= args.sensors <= TCS_COUNT + APDS_COUNT:
+    parser.error("--sensors must be between 1 and %d" % (TCS_COUNT + APDS_COUNT))
+  if args.check:
+    failures = check_commands()
+    print("commands: %s" % ("ok" if not failures else "FAILED: " + ", ".join(failures)))
+    sys.exit(1 if failures else 0)
+  run(args)
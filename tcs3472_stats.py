@@ -0,0 +1,115 @@
+import collections
+import numpy
+
+class Moments(object):
+  # count, mean, sum of squared differences from the mean (Welford's M2), min and max for each sensor
+  # and channel. Batches are combined with the parallel version of Welford's algorithm (Chan et al.) so
+  # this doesn't lose precision like sums of squares would.
+  __slots__ = ("count", "mean", "m2", "min", "max")
+
+  def __init__(self, sensor_count, channel_count):
+    self.count = numpy.zeros(sensor_count, dtype=numpy.int64)
+    self.mean = numpy.zeros((sensor_count, channel_count))
+    self.m2 = numpy.zeros((sensor_count, channel_count))
+    self.min = numpy.full((sensor_count, channel_count), numpy.inf)
+    self.max = numpy.full((sensor_count, channel_count), -numpy.inf)
+
+  @classmethod
+  def from_batch(cls, sensor_count, sensors, values):
+    # sensors (n,) and values (n, channel_count)
+    channel_count = values.shape[1]
+    m = cls(sensor_count, channel_count)
+    m.count = numpy.bincount(sensors, minlength=sensor_count)
+    present = m.count > 0
+    n = numpy.maximum(m.count, 1)
+    for j in range(channel_count):
+      m.mean[:, j] = numpy.bincount(sensors, weights=values[:, j], minlength=sensor_count) / n
+      m.m2[:, j] = numpy.bincount(sensors, weights=(values[:, j] - m.mean[sensors, j])**2, minlength=sensor_count)
+    order = numpy.argsort(sensors, kind="stable")
+    starts = numpy.concatenate(([0], numpy.cumsum(m.count)[:-1]))[present]
+    m.min[present] = numpy.minimum.reduceat(values[order], starts)
+    m.max[present] = numpy.maximum.reduceat(values[order], starts)
+    m.mean[~present] = 0
+    return m
+
+  def merge(self, other):
+    n = self.count + other.count
+    nonzero = numpy.maximum(n, 1)[:, None]
+    delta = other.mean - self.mean
+    self.m2 += other.m2 + delta**2 * (self.count * other.count)[:, None] / nonzero
+    self.mean += delta * other.count[:, None] / nonzero
+    self.count = n
+    numpy.minimum(self.min, other.min, out=self.min)
+    numpy.maximum(self.max, other.max, out=self.max)
+
+  def std(self):
+    # sample standard deviation, NaN if there are less than two values
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+      return numpy.sqrt(self.m2 / (self.count - 1)[:, None])
+
+  def stderr(self):
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+      return self.std() / numpy.sqrt(self.count)[:, None]
+
+class StreamingStats(object):
+  # Statistics of each sensor and channel since the last clear() ("cumulative") and for the last `window`
+  # seconds ("window"). The window consists of buckets of `window / buckets` seconds so it moves in these
+  # steps and only a few Moments have to be merged to get it. Times are the timestamps of the samples so
+  # this also works for replays that are faster than real time.
+  __slots__ = ("sensor_count", "channels", "window", "bucket_length", "cumulative", "_buckets")
+
+  WINDOWS = ("cumulative", "window")
+
+  def __init__(self, sensor_count, channels, window=10.0, buckets=20):
+    self.sensor_count = sensor_count
+    self.channels = channels
+    self.window = window
+    self.bucket_length = window / buckets
+    self.clear()
+
+  def clear(self):
+    self.cumulative = Moments(self.sensor_count, len(self.channels))
+    self._buckets = collections.deque()  # (start time, Moments)
+
+  def update(self, sensors, values, timestamp):
+    # one batch, sensors (n,) and values (n, len(channels)), timestamp is the time of the newest sample
+    if len(sensors) == 0:
+      return
+    batch = Moments.from_batch(self.sensor_count, sensors, values)
+    self.cumulative.merge(batch)
+    if self._buckets and timestamp < self._buckets[-1][0] + self.bucket_length:
+      self._buckets[-1][1].merge(batch)
+    else:
+      self._buckets.append((timestamp, batch))
+    while self._buckets and self._buckets[0][0] + self.bucket_length < timestamp - self.window:
+      self._buckets.popleft()
+
+  def get(self, window="cumulative"):
+    if window == "cumulative":
+      return self.cumulative
+    m = Moments(self.sensor_count, len(self.channels))
+    for _, bucket in self._buckets:
+      m.merge(bucket)
+    return m
+
+  def text(self, window="cumulative", formats=None):
+    # one "(mean±std, ...)" per sensor that has any values
+    m = self.get(window)
+    std = m.std()
+    if formats is None:
+      formats = ["%.4g"] * len(self.channels)
+    return ", ".join("(%s)" % ", ".join((f + "±" + f) % (mean, s) for f, mean, s in zip(formats, m.mean[i], std[i]))
+      for i in numpy.flatnonzero(m.count))
+
+  def export(self, path):
+    # TSV with one row per window, sensor and channel
+    with open(path, "w") as f:
+      f.write("window\tsensor\tchannel\tcount\tmean\tstd\tstderr\tmin\tmax\n")
+      for window in self.WINDOWS:
+        m = self.get(window)
+        std = m.std()
+        stderr = m.stderr()
+        for i in numpy.flatnonzero(m.count):
+          for j, channel in enumerate(self.channels):
+            f.write("%s\t%d\t%s\t%d\t%.9g\t%.9g\t%.9g\t%.9g\t%.9g\n" % (window, i, channel, m.count[i],
+              m.mean[i, j], std[i, j], stderr[i, j], m.min[i, j], m.max[i, j]))
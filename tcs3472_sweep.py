@@ -0,0 +1,85 @@
+import numpy
+
+CYCLE_TIME = 0.0024  # seconds per integration cycle, ATIME is 255-itime so there are itime+1 cycles
+
+def integration_seconds(itime):
+  return (itime + 1) * CYCLE_TIME
+
+class StepCollector(object):
+  # Collects the samples of one csvgen step and decides when the step is done. Only samples whose
+  # integration has started after the actuator has been changed are used (`valid_after`, a time.time()
+  # like the timestamps of the samples). The step is done when each of the sensors that are present
+  #  - has at least `min_samples` samples and the last `min_samples` of them are within `tolerance`
+  #    (relative to their average but at least `min_counts`) for all channels, or
+  #  - has `max_samples` samples,
+  # or when the step has taken `timeout` seconds. A sensor that sends samples is added to the expected
+  # ones even if we didn't know that it is present.
+  __slots__ = ("sensor_count", "tolerance", "min_counts", "min_samples", "max_samples", "timeout",
+    "expected", "valid_after", "start_time", "_raw", "_values", "_done")
+
+  def __init__(self, sensor_count, tolerance=0.02, min_counts=8, min_samples=2, max_samples=6, timeout=5.0):
+    self.sensor_count = sensor_count
+    self.tolerance = tolerance
+    self.min_counts = min_counts
+    self.min_samples = max(2, min_samples)  # we always write two samples for each sensor
+    self.max_samples = max(self.min_samples, max_samples)
+    self.timeout = timeout
+    self.expected = set()
+    self.valid_after = 0
+    self.start_time = 0
+    self._raw = [[] for _ in range(sensor_count)]
+    self._values = [[] for _ in range(sensor_count)]
+    self._done = [False] * sensor_count
+
+  @property
+  def settings(self):
+    # for the header of the recording
+    return { name: getattr(self, name) for name in ("tolerance", "min_counts", "min_samples", "max_samples", "timeout") }
+
+  def start(self, sensors, valid_after, now):
+    self.expected = set(sensors)
+    self.valid_after = valid_after
+    self.start_time = now
+    for i in range(self.sensor_count):
+      self._raw[i].clear()
+      self._values[i].clear()
+      self._done[i] = False
+
+  def add(self, sensor_index, timestamp, raw, values):
+    if timestamp < self.valid_after or self._done[sensor_index]:
+      return
+    self.expected.add(sensor_index)
+    raws = self._raw[sensor_index]
+    raws.append(raw)
+    self._values[sensor_index].append(values)
+    n = len(raws)
+    if n >= self.max_samples:
+      self._done[sensor_index] = True
+    elif n >= self.min_samples:
+      last = numpy.array(raws[-self.min_samples:], dtype=float)
+      spread = last.max(axis=0) - last.min(axis=0)
+      limit = numpy.maximum(self.tolerance * last.mean(axis=0), self.min_counts)
+      self._done[sensor_index] = bool((spread <= limit).all())
+
+  def done(self, now):
+    if now - self.start_time >= self.timeout:
+      return True
+    return len(self.expected) > 0 and all(self._done[i] for i in self.expected)
+
+  def timed_out(self):
+    # sensors that were expected but are not done
+    return sorted(i for i in self.expected if not self._done[i])
+
+  def fill_record(self, record):
+    # last two samples and average of all samples for each sensor, zeros resp. NaN if there aren't any
+    record["raw"] = 0
+    record["values"] = numpy.nan
+    record["avg"] = numpy.nan
+    for i in range(self.sensor_count):
+      raws = self._raw[i]
+      if not raws:
+        continue
+      values = self._values[i]
+      record["raw"][i, 2-min(2, len(raws)):] = raws[-2:]
+      record["values"][i, 2-min(2, len(values)):] = values[-2:]
+      record["avg"][i] = numpy.mean(values, axis=0)